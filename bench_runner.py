@@ -0,0 +1,870 @@
+#! /bin/env python3
+
+# pylint: disable=too-many-locals
+
+''' Runs the benchmarks for MiniKV '''
+
+import os
+import glob
+import json
+import asyncio
+import tempfile
+import subprocess
+
+from enum import Enum
+import argparse
+import itertools
+import multiprocessing
+
+from time import monotonic
+from random import Random
+
+from aiohttp import ClientSession, ClientError, ClientTimeout, TCPConnector
+
+from test_runner import TestRunner
+
+from minikv.constants import DISPATCH_LANES, PEER_START_PORT, SCAN_CHUNK_SIZE
+from minikv.db import Database
+from minikv.snapshot import fork_snapshot, SnapshotReader
+from minikv.networking import Connector, NetworkShape
+from minikv.chain_replication.logic import ChainReplication, MessageType
+from minikv.client import RequestSender
+from minikv.hotkeys import HotKeys
+from minikv.simulation import SimulatedCluster, run_simulation
+from minikv.profiling import Profiler
+from minikv import dump
+
+def percentile(values: list[float], pct: float) -> float:
+    ''' Get the specified percentile (0-100) of a list of measurements '''
+
+    if len(values) == 0:
+        return float('nan')
+
+    values = sorted(values)
+    index = min(len(values)-1, int(len(values) * pct / 100))
+    return values[index]
+
+async def _watch_all(address: str, num_watchers: int, num_updates: int, ready, result):
+    ''' Runs the watchers of watch-fanout and reports when each update arrived '''
+
+    received_at: list[tuple[str, float]] = []
+
+    async def watch(response):
+        async for line in response.content:
+            received_at.append((json.loads(line)["key"], monotonic()))
+
+    async with ClientSession(connector=TCPConnector(limit=0)) as session:
+        responses = [await session.get(f"http://{address}/watch")
+                     for _ in range(num_watchers)]
+        watchers = [asyncio.create_task(watch(r)) for r in responses]
+        ready.set()
+
+        for _ in range(600):
+            if len(received_at) >= num_watchers * num_updates:
+                break
+            await asyncio.sleep(0.05)
+
+        for task in watchers:
+            task.cancel()
+        for response in responses:
+            response.close()
+
+    result.put(received_at)
+
+def _run_watchers(*args):
+    asyncio.run(_watch_all(*args))
+
+async def bench_watch_fanout(args):
+    '''
+        Measures write throughput and delivery latency with many concurrent watchers.
+        Watchers run in a separate process, so they do not compete with the writer.
+    '''
+
+    address = "localhost:8080"
+
+    for num_watchers in [0, args.watchers]:
+        runner = TestRunner(1, "none", args.loglevel)
+
+        try:
+            async with ClientSession() as session:
+                ready = multiprocessing.Event()
+                result: multiprocessing.Queue = multiprocessing.Queue()
+                watcher_proc = multiprocessing.Process(target=_run_watchers,
+                        args=(address, num_watchers, args.num_ops, ready, result))
+                watcher_proc.start()
+                await asyncio.to_thread(ready.wait)
+
+                sent_at: dict[str, float] = {}
+                start = monotonic()
+                for i in range(args.num_ops):
+                    key = f"key{i}"
+                    sent_at[key] = monotonic()
+                    async with session.post(f"http://{address}/put?key={key}",
+                            json={"value": f"value{i}"}) as resp:
+                        resp.raise_for_status()
+                elapsed = monotonic() - start
+
+                received_at = await asyncio.to_thread(result.get)
+                await asyncio.to_thread(watcher_proc.join)
+
+            latencies = [recv - sent_at[key] for key, recv in received_at]
+            print(f"watchers={num_watchers:5} writes/s={args.num_ops/elapsed:9.1f} "
+                  f"delivered={len(received_at)}/{num_watchers * args.num_ops} "
+                  f"p50={percentile(latencies, 50)*1000:.2f}ms "
+                  f"p99={percentile(latencies, 99)*1000:.2f}ms")
+        finally:
+            runner.shutdown()
+
+async def _step(session: ClientSession, address: str, rate: int, duration: float):
+    ''' Issue writes at a fixed rate (open loop) and collect the outcomes '''
+
+    latencies: list[float] = []
+    outcomes = {"ok": 0, "rejected": 0, "failed": 0}
+
+    async def write(idx):
+        start = monotonic()
+        try:
+            async with session.post(f"http://{address}/put?key=key{idx}",
+                    json={"value": f"value{idx}"}) as resp:
+                if resp.status == 503:
+                    outcomes["rejected"] += 1
+                    return
+                resp.raise_for_status()
+        except (ClientError, asyncio.TimeoutError):
+            outcomes["failed"] += 1
+            return
+        latencies.append(monotonic() - start)
+        outcomes["ok"] += 1
+
+    tasks = []
+    start = monotonic()
+    for idx in range(int(rate * duration)):
+        delay = start + idx / rate - monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(write(idx)))
+
+    await asyncio.gather(*tasks)
+    return latencies, outcomes
+
+async def bench_step_load(args):
+    '''
+        Increases the offered write load step by step on a five node chain,
+        with and without admission control at the head
+    '''
+
+    address = "localhost:8080"
+    configs = {
+        "no admission control": ["--max-inflight=0", "--max-queued-bytes=0"],
+        "admission control": [],
+    }
+
+    for conf_name, extra_args in configs.items():
+        print(f"# {conf_name}")
+        runner = TestRunner(5, "chain", args.loglevel, extra_args=extra_args)
+
+        try:
+            timeout = ClientTimeout(total=2.0)
+            async with ClientSession(connector=TCPConnector(limit=0), timeout=timeout) as session:
+                for rate in args.rates:
+                    latencies, outcomes = await _step(session, address, rate, args.step_duration)
+                    print(f"offered={rate:5}/s goodput={outcomes['ok']/args.step_duration:7.1f}/s "
+                          f"rejected={outcomes['rejected']:5} failed={outcomes['failed']:5} "
+                          f"p50={percentile(latencies, 50)*1000:7.2f}ms "
+                          f"p99={percentile(latencies, 99)*1000:7.2f}ms")
+        finally:
+            runner.shutdown()
+
+async def bench_tracing_overhead(args):
+    ''' Compares write latency on a five node chain at different trace sample rates '''
+
+    address = "localhost:8080"
+
+    for sample_rate in [0.0, 0.01, 1.0]:
+        with tempfile.TemporaryDirectory() as trace_dir:
+            runner = TestRunner(5, "chain", args.loglevel, extra_args=[
+                f"--trace-sample-rate={sample_rate}", f"--trace-dir={trace_dir}"])
+
+            try:
+                async with ClientSession() as session:
+                    latencies = []
+                    start = monotonic()
+                    for i in range(args.num_ops):
+                        op_start = monotonic()
+                        async with session.post(f"http://{address}/put?key=key{i}",
+                                json={"value": f"value{i}"}) as resp:
+                            resp.raise_for_status()
+                        latencies.append(monotonic() - op_start)
+                    elapsed = monotonic() - start
+            finally:
+                runner.shutdown()
+
+            num_spans = 0
+            for path in glob.glob(os.path.join(trace_dir, "*.jsonl")):
+                with open(path, encoding='utf-8') as ifile:
+                    num_spans += sum(1 for _ in ifile)
+
+        print(f"sample-rate={sample_rate:<5} writes/s={args.num_ops/elapsed:8.1f} "
+              f"p50={percentile(latencies, 50)*1000:.3f}ms "
+              f"p99={percentile(latencies, 99)*1000:.3f}ms spans={num_spans}")
+
+class _SlowHop(ChainReplication):
+    ''' A chain node that takes a while to apply each forwarded update '''
+
+    def __init__(self, identifier: int, delay: float, **kwargs):
+        super().__init__(identifier, **kwargs)
+        self._delay = delay
+
+    async def _process_message(self, peer, msg_type, message, trace_id):
+        if msg_type == MessageType.FORWARD_PASS:
+            await asyncio.sleep(self._delay)
+        await super()._process_message(peer, msg_type, message, trace_id)
+
+async def bench_slow_hop(args):
+    '''
+        Runs a three node chain in-process, where the middle node takes 1ms per update,
+        and compares inline message handling with the dispatch stage
+    '''
+
+    for config, lanes in enumerate([0, DISPATCH_LANES]):
+        base = 10 * (config + 1)
+        options = {"dispatch_lanes": lanes, "max_inflight": 0, "max_queued_bytes": 0}
+        nodes = [ChainReplication(base, **options),
+                 _SlowHop(base+1, 0.001, **options),
+                 ChainReplication(base+2, **options)]
+
+        for idx, node in enumerate(nodes):
+            await node.start(base+idx-1 if idx > 0 else None)
+        # Wait for the last node to register with its predecessor
+        await asyncio.sleep(0.1)
+
+        next_op = 0
+
+        async def client():
+            nonlocal next_op
+            while next_op < args.num_ops:
+                idx = next_op
+                next_op += 1
+                await nodes[0].put(f"key{idx}", f"value{idx}")
+
+        start = monotonic()
+        try:
+            await asyncio.wait_for(asyncio.gather(*[client() for _ in range(args.concurrency)]),
+                                   timeout=60)
+            result = f"writes/s={args.num_ops/(monotonic()-start):8.1f}"
+        except asyncio.TimeoutError:
+            result = f"stalled after {next_op} writes"
+
+        print(f"dispatch-lanes={lanes:<3} concurrency={args.concurrency} {result}")
+
+        for node in nodes:
+            await node.stop()
+
+class _BenchMessage(Enum):
+    PING = 1
+    PONG = 2
+    DATA = 3
+
+class _EchoLogic:
+    ''' Answers pings and counts one-way messages '''
+
+    def __init__(self):
+        self.received = 0
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    async def handle_incoming_connection(self, _peer):
+        ''' Nothing to set up '''
+
+    async def handle_disconnect(self, _peer):
+        ''' Nothing to clean up '''
+
+    async def handle_message(self, peer, msg_type, message):
+        ''' Reply to pings, count everything else '''
+
+        if msg_type == _BenchMessage.PING:
+            await peer.send(_BenchMessage.PONG, message)
+            return
+
+        self.received += 1
+        if self.received >= self.expected:
+            self.done.set()
+
+async def bench_transports(args):
+    ''' Compares per-hop latency and message rate of the peer transports '''
+
+    payload = {"key": "key0", "value": "x" * 100}
+
+    for config, transport in enumerate(["tcp", "unix", "shm"]):
+        port = PEER_START_PORT + 900 + 2*config
+        server_logic, client_logic = _EchoLogic(), _EchoLogic()
+        server = Connector(900, "localhost", port, _BenchMessage, server_logic,
+                           transport=transport)
+        client = Connector(901, "localhost", port+1, _BenchMessage, client_logic,
+                           transport=transport)
+        await server.start()
+        await client.start()
+        peer = await client.connect_to_peer("localhost", port)
+
+        # Ping-pong, one message in flight at a time
+        client_logic.expected = args.num_ops
+        start = monotonic()
+        for _ in range(args.num_ops):
+            client_logic.done.clear()
+            client_logic.expected = client_logic.received + 1
+            await peer.send(_BenchMessage.PING, payload)
+            await client_logic.done.wait()
+        hop_latency = (monotonic() - start) / args.num_ops / 2
+
+        # Stream messages one way as fast as possible
+        await asyncio.sleep(0.1)
+        server_logic.expected = args.num_ops * 10
+        start = monotonic()
+        for _ in range(server_logic.expected):
+            await peer.send(_BenchMessage.DATA, payload)
+        await server_logic.done.wait()
+        rate = server_logic.expected / (monotonic() - start)
+
+        print(f"transport={transport:<5} hop-latency={hop_latency*1e6:8.1f}us "
+              f"messages/s={rate:10.1f}")
+
+        await client.stop()
+        await server.stop()
+
+async def _max_loop_lag(task) -> float:
+    ''' Wait for a task and report the longest time the event loop was blocked meanwhile '''
+
+    max_lag = 0.0
+    interval = 0.001
+
+    while not task.done():
+        start = monotonic()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, monotonic() - start - interval)
+
+    return max_lag
+
+async def bench_snapshot(args):
+    '''
+        Compares the pause of copying the database with get_all() to that of a
+        fork-based snapshot, and measures time-to-first-request when restarting from it
+    '''
+
+    database = Database()
+    for i in range(args.num_keys):
+        database.put(f"key{i}", f"value{i}")
+
+    start = monotonic()
+    database.get_all()
+    print(f"keys={args.num_keys} get_all pause={(monotonic()-start)*1000:.1f}ms")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "bench.snap")
+
+        task = asyncio.create_task(fork_snapshot(database, path))
+        max_lag = await _max_loop_lag(task)
+        result = task.result()
+        print(f"snapshot duration={result['duration_ms']:.1f}ms fork={result['fork_ms']:.1f}ms "
+              f"longest loop stall={max_lag*1000:.1f}ms "
+              f"size={os.path.getsize(path)/1024/1024:.1f}MiB")
+
+        start = monotonic()
+        restored = Database.from_snapshot(path)
+        value = restored.get(f"key{args.num_keys // 2}")
+        lazy_time = monotonic() - start
+        assert value == f"value{args.num_keys // 2}"
+
+        start = monotonic()
+        loaded = dict(SnapshotReader(path).items())
+        eager_time = monotonic() - start
+        assert len(loaded) == args.num_keys
+
+        print(f"time to first request: lazy={lazy_time*1000:.2f}ms "
+              f"(loading all entries first: {eager_time*1000:.1f}ms)")
+
+def _zipf_keys(num_keys: int, count: int, skew: float, seed: int) -> list[str]:
+    ''' Draw keys so that the i-th most popular one is picked with probability ~ 1/i^skew '''
+
+    weights = [1.0 / (rank ** skew) for rank in range(1, num_keys+1)]
+    rng = Random(seed)
+    return [f"key{idx}" for idx in rng.choices(range(num_keys), k=count,
+            cum_weights=list(itertools.accumulate(weights)))]
+
+def _zipf_reads(head: str, tail: str, args, cache_size: int) -> dict:
+    ''' Run the read-mostly workload of read-cache with one client '''
+
+    reader = RequestSender(tail, cache_size=cache_size)
+    writer = RequestSender(head)
+    rng = Random(1)
+
+    if reader.cache is not None:
+        assert reader.cache.wait_connected(timeout=5.0)
+
+    latencies = []
+    for key in _zipf_keys(args.key_range, args.num_ops, args.zipf_skew, seed=0):
+        if rng.random() < args.write_ratio:
+            writer.write(key, "updated")
+            continue
+
+        start = monotonic()
+        reader.read(key)
+        latencies.append(monotonic() - start)
+
+    if reader.cache is not None:
+        server_reads = reader.cache.misses
+        hit_rate = reader.cache.hits / max(1, len(latencies))
+    else:
+        server_reads = len(latencies)
+        hit_rate = 0.0
+
+    reader.close()
+    writer.close()
+
+    return {"reads": len(latencies), "server_reads": server_reads, "hit_rate": hit_rate,
+            "p50": percentile(latencies, 50), "p99": percentile(latencies, 99)}
+
+async def bench_read_cache(args):
+    '''
+        Compares reads with and without the lease-based client cache
+        on a Zipfian read-mostly workload against a three node chain (reading at the tail)
+    '''
+
+    runner = TestRunner(3, "chain", args.loglevel)
+
+    try:
+        loader = RequestSender(runner.address(0))
+        for idx in range(args.key_range):
+            await asyncio.to_thread(loader.write, f"key{idx}", "value")
+
+        baseline = None
+        for cache_size in [0, args.key_range // 10, args.key_range]:
+            result = await asyncio.to_thread(_zipf_reads, runner.address(0), runner.address(2),
+                    args, cache_size)
+            if baseline is None:
+                baseline = result["server_reads"]
+
+            print(f"cache-size={cache_size:6} hit-rate={result['hit_rate']*100:5.1f}% "
+                  f"p50={result['p50']*1000:.3f}ms p99={result['p99']*1000:.3f}ms "
+                  f"server-reads={result['server_reads']:6} "
+                  f"(-{(1 - result['server_reads'] / baseline)*100:.1f}%)")
+    finally:
+        runner.shutdown()
+
+def _timed_writes(sender: RequestSender, num_ops: int) -> list[float]:
+    latencies = []
+    for idx in range(num_ops):
+        start = monotonic()
+        sender.write(f"key{idx}", f"value{idx}")
+        latencies.append(monotonic() - start)
+    return latencies
+
+async def bench_forwarding(args):
+    '''
+        Compares write latency on a five node chain when clients send writes
+        to the head, to other nodes that forward them, or look the head up in the topology
+    '''
+
+    runner = TestRunner(5, "chain", args.loglevel)
+
+    try:
+        configs = {
+            "head": RequestSender(runner.address(0), route_writes=False),
+            "node 2 (forwarded)": RequestSender(runner.address(2), route_writes=False),
+            "tail (forwarded)": RequestSender(runner.address(4), route_writes=False),
+            "tail (via topology)": RequestSender(runner.address(4)),
+        }
+
+        for name, sender in configs.items():
+            latencies = await asyncio.to_thread(_timed_writes, sender, args.num_ops)
+            sender.close()
+            print(f"{name:<20} p50={percentile(latencies, 50)*1000:.3f}ms "
+                  f"p99={percentile(latencies, 99)*1000:.3f}ms")
+    finally:
+        runner.shutdown()
+
+async def bench_hotkeys(args):
+    '''
+        Microbenchmark of the hot-key sketches: cost per recorded access
+        compared to an exact (unbounded) counter, and how well they find the top keys
+    '''
+
+    num_ops = args.num_ops * 100
+    workloads = {
+        f"zipf s={args.zipf_skew}": _zipf_keys(args.key_range, num_ops, args.zipf_skew, seed=0),
+        "uniform": [f"key{idx}" for idx in Random(0).choices(range(args.key_range), k=num_ops)],
+    }
+
+    for name, keys in workloads.items():
+        hotkeys = HotKeys()
+        start = monotonic()
+        for key in keys:
+            hotkeys.record_read(key)
+        sketch_time = monotonic() - start
+
+        exact: dict[str, int] = {}
+        start = monotonic()
+        for key in keys:
+            exact[key] = exact.get(key, 0) + 1
+        exact_time = monotonic() - start
+
+        true_top = {key for key, _ in sorted(exact.items(), key=lambda i: -i[1])[:10]}
+        found_top = {entry["key"] for entry in hotkeys.report(10)["reads"]}
+
+        print(f"{name:<12} sketch={sketch_time/num_ops*1e9:6.0f}ns/op "
+              f"exact counter={exact_time/num_ops*1e9:4.0f}ns/op "
+              f"top-10 recall={len(true_top & found_top)}/10 "
+              f"distinct keys={len(exact)}")
+
+async def _chain_writes(nodes, num_ops: int, concurrency: int) -> float:
+    ''' Write num_ops updates through the head with concurrent clients; returns the duration '''
+
+    next_op = 0
+
+    async def client():
+        nonlocal next_op
+        while next_op < num_ops:
+            idx = next_op
+            next_op += 1
+            await nodes[0].put(f"key{idx}", f"value{idx}")
+
+    start = monotonic()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return monotonic() - start
+
+def _simulated_writes(args) -> tuple[float, float]:
+    async def main():
+        start = monotonic()
+        cluster = SimulatedCluster(5, max_inflight=0, max_queued_bytes=0)
+        await cluster.start()
+        startup = monotonic() - start
+
+        duration = await _chain_writes(cluster.nodes, args.num_ops, args.concurrency)
+        await cluster.stop()
+        return startup, duration
+
+    return run_simulation(main)
+
+async def bench_simulated(args):
+    '''
+        Compares a five node chain on the simulated network with the real one:
+        time to start it, and write throughput (which on the simulated network
+        only measures the protocol logic)
+    '''
+
+    start = monotonic()
+    runner = TestRunner(5, "chain", args.loglevel)
+    print(f"processes:  startup={(monotonic()-start)*1000:8.1f}ms")
+    runner.shutdown()
+
+    options = {"max_inflight": 0, "max_queued_bytes": 0}
+    start = monotonic()
+    nodes = [ChainReplication(idx, **options) for idx in range(5)]
+    for idx, node in enumerate(nodes):
+        await node.start(idx-1 if idx > 0 else None)
+    startup = monotonic() - start
+
+    duration = await _chain_writes(nodes, args.num_ops, args.concurrency)
+    print(f"in-process: startup={startup*1000:8.1f}ms writes/s={args.num_ops/duration:8.1f}")
+
+    for node in nodes:
+        await node.stop()
+
+    startup, duration = await asyncio.to_thread(_simulated_writes, args)
+    print(f"simulated:  startup={startup*1000:8.1f}ms writes/s={args.num_ops/duration:8.1f}")
+
+async def _timed_chain_writes(nodes, duration: float, concurrency: int) -> list[float]:
+    ''' Write through the head with concurrent clients for a while; returns the latencies '''
+
+    latencies = []
+    deadline = monotonic() + duration
+
+    async def client(idx):
+        while monotonic() < deadline:
+            start = monotonic()
+            await nodes[0].put(f"key{idx}", f"value{len(latencies)}")
+            latencies.append(monotonic() - start)
+
+    await asyncio.gather(*[client(idx) for idx in range(concurrency)])
+    return latencies
+
+async def bench_link_shaping(args):
+    '''
+        Runs a three node chain in-process with emulated per-hop latencies, and compares
+        a single client (no pipelining) with concurrent ones, and links that send
+        right away with ones that batch writes for a tenth of the hop latency
+    '''
+
+    config = 0
+    for delay in [0.0001, 0.001, 0.01]:
+        for batch in [0.0, delay / 10]:
+            for concurrency in sorted({1, 8, args.concurrency}):
+                base = 100 + 10 * config
+                config += 1
+
+                shaping = NetworkShape.from_specs([f"delay={delay}s,batch={batch}s"], seed=base)
+                options = {"max_inflight": 0, "max_queued_bytes": 0, "shaping": shaping}
+                nodes = [ChainReplication(base+idx, **options) for idx in range(3)]
+                for idx, node in enumerate(nodes):
+                    await node.start(base+idx-1 if idx > 0 else None)
+
+                latencies = await _timed_chain_writes(nodes, args.step_duration, concurrency)
+                print(f"hop-delay={delay*1000:5.1f}ms batch={batch*1000:5.2f}ms "
+                      f"concurrency={concurrency:<3} "
+                      f"writes/s={len(latencies)/args.step_duration:8.1f} "
+                      f"p50={percentile(latencies, 50)*1000:7.2f}ms "
+                      f"p99={percentile(latencies, 99)*1000:7.2f}ms")
+
+                for node in nodes:
+                    await node.stop()
+
+async def bench_coalescing(args):
+    '''
+        Writes Zipf-distributed keys through the head of a three node chain, with and
+        without write coalescing, and counts the chain messages each client write causes
+    '''
+
+    keys = _zipf_keys(args.key_range, args.num_ops, args.zipf_skew, seed=1)
+
+    config = 0
+    for delay in [0.0, 0.001]:
+        for coalesce in [False, True]:
+            base = 300 + 10 * config
+            config += 1
+
+            shaping = NetworkShape.from_specs([f"delay={delay}s"]) if delay > 0 else None
+            options = {"max_inflight": 0, "max_queued_bytes": 0, "shaping": shaping,
+                       "coalesce_writes": coalesce}
+            nodes = [ChainReplication(base+idx, **options) for idx in range(3)]
+            for idx, node in enumerate(nodes):
+                await node.start(base+idx-1 if idx > 0 else None)
+
+            next_op = 0
+
+            async def client():
+                nonlocal next_op
+                while next_op < len(keys):
+                    idx = next_op
+                    next_op += 1
+                    await nodes[0].put(keys[idx], f"value{idx}")
+
+            start = monotonic()
+            await asyncio.gather(*[client() for _ in range(args.concurrency)])
+            elapsed = monotonic() - start
+
+            stats = nodes[0].coalescing_stats
+            sent = len(keys) - stats["superseded"]
+            # Every update that is sent takes a forward and a backward message per hop
+            messages = sent * 2 * (len(nodes) - 1)
+
+            print(f"hop-delay={delay*1000:3.1f}ms coalesce={str(coalesce):<5} "
+                  f"writes/s={len(keys)/elapsed:8.1f} "
+                  f"chain messages/write={messages/len(keys):5.2f} "
+                  f"superseded={stats['superseded']}")
+
+            for node in nodes:
+                await node.stop()
+
+def _bulk_tool(*tool_args) -> float:
+    ''' Run the bulk loader/exporter and return how long it took '''
+
+    start = monotonic()
+    subprocess.check_call(["python3", "-c", "import minikv; minikv.run_bulk();",
+                           *tool_args, "--loglevel=warn"])
+    return monotonic() - start
+
+async def bench_bulk_load(args):
+    '''
+        Compares seeding a three node chain with the client's fill mode (one request
+        and chain round trip per key) to the bulk loader, and times exporting it again
+    '''
+
+    runner = TestRunner(3, "chain", args.loglevel)
+
+    try:
+        start = monotonic()
+        await asyncio.to_thread(subprocess.check_call,
+            ["python3", "-c", "import minikv; minikv.run_client();", "fill",
+             "--loglevel=warn", f"--server-address={runner.address(0)}",
+             f"--key-range={args.num_ops}", "--value-prefix=fill"])
+        fill_rate = args.num_ops / (monotonic() - start)
+        print(f"fill:          keys={args.num_ops:<8} keys/s={fill_rate:10.1f} "
+              f"(would take {args.num_keys/fill_rate:8.1f}s for {args.num_keys} keys)")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for fmt in ["ndjson", "binary"]:
+                path = os.path.join(tmp_dir, f"bench.{fmt}")
+                items = ((f"key{i}", f"value{i}") for i in range(args.num_keys))
+                with open(path, 'wb') as ofile:
+                    for piece in dump.encode(items, fmt):
+                        ofile.write(piece)
+
+                duration = await asyncio.to_thread(_bulk_tool, "load", path, f"--format={fmt}",
+                    f"--server-address={runner.address(0)}")
+                print(f"load {fmt:<8} keys={args.num_keys:<8} "
+                      f"keys/s={args.num_keys/duration:10.1f} took {duration:8.1f}s")
+
+            for fmt in ["ndjson", "binary"]:
+                path = os.path.join(tmp_dir, f"export.{fmt}")
+                duration = await asyncio.to_thread(_bulk_tool, "export", path, f"--format={fmt}",
+                    f"--server-address={runner.address(2)}")
+                print(f"export {fmt:<6} keys={args.num_keys:<8} "
+                      f"keys/s={args.num_keys/duration:10.1f} took {duration:8.1f}s "
+                      f"size={os.path.getsize(path)/1024/1024:.1f}MiB")
+    finally:
+        runner.shutdown()
+
+async def bench_profiling(args):
+    '''
+        Writes through a three node chain in-process while each kind of profile
+        runs, to show what profiling a busy node costs (and that idle profilers cost nothing)
+    '''
+
+    profiler = Profiler()
+    duration = args.step_duration
+
+    async def cpu():
+        await profiler.cpu(duration)
+
+    async def loop():
+        await profiler.loop(duration)
+
+    async def memory():
+        profiler.start_memory()
+        await asyncio.sleep(duration)
+        await profiler.memory_snapshot()
+        profiler.stop_memory()
+
+    for config, (name, profile) in enumerate([("none", None), ("cpu", cpu), ("loop", loop),
+                                              ("memory", memory)]):
+        base = 400 + 10 * config
+        options = {"max_inflight": 0, "max_queued_bytes": 0}
+        nodes = [ChainReplication(base+idx, **options) for idx in range(3)]
+        for idx, node in enumerate(nodes):
+            await node.start(base+idx-1 if idx > 0 else None)
+
+        task = asyncio.create_task(profile()) if profile is not None else None
+        latencies = await _timed_chain_writes(nodes, duration, args.concurrency)
+        if task is not None:
+            await task
+
+        print(f"profile={name:<7} writes/s={len(latencies)/duration:8.1f} "
+              f"p50={percentile(latencies, 50)*1000:7.2f}ms "
+              f"p99={percentile(latencies, 99)*1000:7.2f}ms")
+
+        for node in nodes:
+            await node.stop()
+
+async def bench_mvcc_scans(args):
+    '''
+        Writes through a three node chain in-process while the tail scans all entries
+        over and over, either in one go (like get_all) or from a read view in chunks
+        with other tasks running in between, and compares writer throughput
+    '''
+
+    items = [[f"key{idx}", f"value{idx}"] for idx in range(args.num_keys)]
+    duration = args.step_duration
+
+    for config, mode in enumerate(["none", "blocking", "read-view"]):
+        base = 500 + 10 * config
+        options = {"max_inflight": 0, "max_queued_bytes": 0}
+        nodes = [ChainReplication(base+idx, **options) for idx in range(3)]
+        for idx, node in enumerate(nodes):
+            await node.start(base+idx-1 if idx > 0 else None)
+
+        for start in range(0, len(items), 10000):
+            await nodes[0].bulk_load(items[start:start+10000])
+
+        scans: list[float] = []
+        max_versions = 0
+        stop = asyncio.Event()
+
+        async def scanner():
+            nonlocal max_versions
+            while not stop.is_set():
+                start = monotonic()
+                if mode == "blocking":
+                    count = len(await nodes[-1].get_all())
+                else:
+                    count = 0
+                    with nodes[-1].read_view() as view:
+                        for _ in view.items():
+                            count += 1
+                            if count % SCAN_CHUNK_SIZE == 0:
+                                max_versions = max(max_versions,
+                                                   nodes[-1].object_counts["database_versions"])
+                                await asyncio.sleep(0)
+                assert count == len(items)
+                scans.append(monotonic() - start)
+                await asyncio.sleep(0)
+
+        task = asyncio.create_task(scanner()) if mode != "none" else None
+        latencies = await _timed_chain_writes(nodes, duration, args.concurrency)
+        stop.set()
+        if task is not None:
+            await task
+
+        scan_info = ""
+        if len(scans) > 0:
+            scan_info = f"scans={len(scans)} scan p50={percentile(scans, 50)*1000:7.1f}ms"
+        if mode == "read-view":
+            scan_info += f" max versions={max_versions}"
+        print(f"scans={mode:<9} writes/s={len(latencies)/duration:8.1f} "
+              f"p50={percentile(latencies, 50)*1000:7.2f}ms "
+              f"p99={percentile(latencies, 99)*1000:7.2f}ms {scan_info}")
+
+        for node in nodes:
+            await node.stop()
+
+def _main():
+    benchmarks = {
+        'watch-fanout': bench_watch_fanout,
+        'step-load': bench_step_load,
+        'tracing-overhead': bench_tracing_overhead,
+        'slow-hop': bench_slow_hop,
+        'transports': bench_transports,
+        'snapshot': bench_snapshot,
+        'read-cache': bench_read_cache,
+        'forwarding': bench_forwarding,
+        'hotkeys': bench_hotkeys,
+        'simulated': bench_simulated,
+        'link-shaping': bench_link_shaping,
+        'bulk-load': bench_bulk_load,
+        'coalescing': bench_coalescing,
+        'profiling': bench_profiling,
+        'mvcc-scans': bench_mvcc_scans,
+    }
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=list(benchmarks.keys()) + ["all"])
+    parser.add_argument("--num-ops", default=1000, type=int,
+        help="The number of operations each benchmark issues")
+    parser.add_argument("--watchers", default=1000, type=int,
+        help="The number of concurrent watchers for watch-fanout")
+    parser.add_argument("--rates", default=[100, 200, 400, 800, 1600],
+        type=lambda s: [int(x) for x in s.split(',')],
+        help="Comma-separated offered loads (requests/s) for step-load")
+    parser.add_argument("--step-duration", default=3.0, type=float,
+        help="How many seconds each step of step-load (or configuration of link-shaping"
+             " and profiling) lasts")
+    parser.add_argument("--num-keys", default=1000000, type=int,
+        help="The number of keys to load for the snapshot, bulk-load, and mvcc-scans benchmarks")
+    parser.add_argument("--key-range", default=10000, type=int,
+        help="The number of keys the read-cache and coalescing workloads draw from")
+    parser.add_argument("--zipf-skew", default=1.1, type=float,
+        help="Skew of the Zipfian key popularity for read-cache and coalescing")
+    parser.add_argument("--write-ratio", default=0.01, type=float,
+        help="Fraction of operations that are writes in read-cache")
+    parser.add_argument("--concurrency", default=64, type=int,
+        help="The number of concurrent clients for in-process benchmarks")
+    parser.add_argument("--loglevel", default="warn",
+        help="Set the logging verbosity", choices=["warn", "debug", "info"])
+
+    args = parser.parse_args()
+
+    for name, benchmark in benchmarks.items():
+        if args.benchmark in (name, "all"):
+            print(f'### Running benchmark "{name}" ###')
+            asyncio.run(benchmark(args))
+
+if __name__ == "__main__":
+    _main()
@@ -1,5 +1,6 @@
 ''' Entry point for MiniKV '''
 
+import os
 import logging
 import argparse
 import asyncio
@@ -7,10 +8,15 @@ import asyncio
 from sys import argv
 
 from . import client
-from . import chain_replication
-from . import no_replication
 
 from .client import run as run_client
+from .client.bulk import run as run_bulk
+from .db import Database
+from .tracing import Tracer
+from .constants import (CLIENT_START_PORT, PEER_START_PORT, MAX_INFLIGHT_UPDATES,
+                        MAX_QUEUED_BYTES, TRACE_SAMPLE_RATE, PEER_TRANSPORT, LEASE_DURATION)
+from .networking.transport import TRANSPORTS
+from .networking.shaping import NetworkShape
 
 def run_node():
     ''' Main function that picks a backend, spawns asyncio, and runs the node '''
@@ -19,6 +25,11 @@ def run_node():
     if argv[0] == "-c":
         argv[0] = "python"
 
+    # "minikv load" and "minikv export" run the bulk tool instead of a node
+    if len(argv) > 1 and argv[1] in ("load", "export"):
+        run_bulk()
+        return
+
     parser = argparse.ArgumentParser()
     parser.add_argument('replication_type', default='none',
         choices=['client', 'none', 'chain', 'gossip'])
@@ -27,6 +38,34 @@ def run_node():
         help="Set the logging verbosity", choices=["warn", "debug", "info"])
     parser.add_argument("-C", "--connect-to", default="", required=False,
         help="Addresses of other nodes to connect to, separated by a comma.")
+    parser.add_argument("--client-port-base", type=int, default=CLIENT_START_PORT,
+        help="Node i serves clients on this port plus i")
+    parser.add_argument("--peer-port-base", type=int, default=PEER_START_PORT,
+        help="Node i accepts other nodes on this port plus i")
+    parser.add_argument("--max-inflight", type=int, default=MAX_INFLIGHT_UPDATES,
+        help="Most updates the chain head admits at once (0 for no limit)")
+    parser.add_argument("--max-queued-bytes", type=int, default=MAX_QUEUED_BYTES,
+        help="Most bytes of updates the chain head admits at once (0 for no limit)")
+    parser.add_argument("--coalesce-writes", action="store_true",
+        help="Let the chain head replace queued writes to a key with newer ones")
+    parser.add_argument("--transport", default=PEER_TRANSPORT, choices=TRANSPORTS,
+        help="How to reach other nodes; auto uses Unix domain sockets for local peers")
+    parser.add_argument("--link-shape", action="append", default=[],
+        help="Emulate a slower network to other nodes, e.g., delay=1ms,jitter=100us,"
+             "bandwidth=1gbit,batch=200us; prefix with SRC-DST: for a single link "
+             "(can be given multiple times)")
+    parser.add_argument("--link-shape-file", default=None,
+        help="Read link shapes from a file, one per line")
+    parser.add_argument("--snapshot-path", default=None,
+        help="Where /admin/snapshot writes to (default: minikv-<index>.snap)")
+    parser.add_argument("--restore-from", default=None,
+        help="Start from the specified snapshot file, which is loaded lazily")
+    parser.add_argument("--lease-duration", type=float, default=LEASE_DURATION,
+        help="Seconds a caching client may serve a value it read (0 disables leases)")
+    parser.add_argument("--trace-sample-rate", type=float, default=TRACE_SAMPLE_RATE,
+        help="Fraction of client updates to trace, between 0 and 1")
+    parser.add_argument("--trace-dir", default=".",
+        help="Directory to write the span log (minikv-spans-<index>.jsonl) to")
 
     args = parser.parse_args()
     logging.basicConfig(level=args.loglevel.upper())
@@ -38,16 +77,47 @@ def run_node():
 
     assert args.index >= 0
 
-    asyncio.run(_execute_backend(args.replication_type, args.index, connect_to))
+    asyncio.run(_execute_backend(args, connect_to))
+
+async def _execute_backend(args: argparse.Namespace, connect_to: list[int]):
+    # Imported here, so clients do not pay for loading the server code (and aiohttp)
+    #pylint: disable=import-outside-toplevel
+    from . import chain_replication
+    from . import no_replication
+
+    trace_log = os.path.join(args.trace_dir, f"minikv-spans-{args.index}.jsonl")
+    tracer = Tracer(args.index, args.trace_sample_rate, trace_log)
+
+    snapshot_path = args.snapshot_path or f"minikv-{args.index}.snap"
+    if args.restore_from:
+        database = Database.from_snapshot(args.restore_from)
+        logging.info("Restoring database from %s", args.restore_from)
+    else:
+        database = Database()
+
+    if args.link_shape_file or args.link_shape:
+        shaping = NetworkShape.load(args.link_shape_file) if args.link_shape_file \
+            else NetworkShape()
+        for spec in args.link_shape:
+            shaping.add_spec(spec)
+    else:
+        shaping = None
 
-async def _execute_backend(replication_type: str, index: int, connect_to: list[int]):
-    match replication_type:
+    match args.replication_type:
         case "none":
-            await no_replication.serve(index, connect_to)
+            await no_replication.serve(args.index, connect_to, tracer=tracer,
+                database=database, snapshot_path=snapshot_path,
+                client_port_base=args.client_port_base, lease_duration=args.lease_duration)
         case "chain":
-            await chain_replication.serve(index, connect_to)
+            await chain_replication.serve(args.index, connect_to,
+                max_inflight=args.max_inflight, max_queued_bytes=args.max_queued_bytes,
+                tracer=tracer, transport=args.transport,
+                database=database, snapshot_path=snapshot_path,
+                client_port_base=args.client_port_base, peer_port_base=args.peer_port_base,
+                lease_duration=args.lease_duration, shaping=shaping,
+                coalesce_writes=args.coalesce_writes)
         case _:
-            print(f"Unexpected replication type: {replication_type}")
+            print(f"Unexpected replication type: {args.replication_type}")
 
 if __name__ == '__main__':
     run_node()
@@ -0,0 +1,119 @@
+''' Admission control, so an overloaded node rejects requests instead of queuing them '''
+
+#pylint: disable=too-many-instance-attributes
+
+import math
+
+from time import monotonic
+from contextlib import contextmanager
+
+from .constants import MIN_INFLIGHT_UPDATES
+
+class Overloaded(Exception):
+    ''' The node is at capacity and the client should retry later '''
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Node is overloaded, retry after {retry_after:.3f}s")
+        self._retry_after = retry_after
+
+    @property
+    def retry_after(self) -> float:
+        ''' How many seconds the client should wait before retrying '''
+        return self._retry_after
+
+class AdmissionController:
+    '''
+        Caps the number of in-flight updates and the bytes they occupy.
+
+        The in-flight cap adapts to the measured round-trip time (AIMD):
+        it grows by roughly one per RTT while latency stays close to the
+        best observed RTT, and shrinks multiplicatively (at most once per RTT)
+        when latency inflates because requests start queuing.
+        A limit of 0 disables the respective check.
+    '''
+
+    # Latency above this multiple of the minimum RTT counts as congestion
+    RTT_TOLERANCE = 2.0
+    # Factor the limit shrinks by on congestion
+    BACKOFF = 0.9
+    # Forget the minimum RTT after this many seconds, so we adapt to changes in the chain
+    MIN_RTT_WINDOW = 10.0
+
+    def __init__(self, max_inflight: int, max_queued_bytes: int,
+            min_inflight: int = MIN_INFLIGHT_UPDATES):
+        assert max_inflight >= 0 and max_queued_bytes >= 0
+
+        self._max_inflight = max_inflight
+        self._min_inflight = min(min_inflight, max_inflight)
+        self._max_queued_bytes = max_queued_bytes
+        self._limit = float(max_inflight)
+
+        self._inflight = 0
+        self._queued_bytes = 0
+
+        self._min_rtt = math.inf
+        self._min_rtt_time = 0.0
+        self._smoothed_rtt = 0.0
+        self._last_backoff = 0.0
+
+    @property
+    def limit(self) -> int:
+        ''' The current (adaptive) cap on in-flight updates '''
+        return int(self._limit)
+
+    @property
+    def inflight(self) -> int:
+        ''' How many updates are currently admitted '''
+        return self._inflight
+
+    def _retry_after(self) -> float:
+        # Roughly the time it takes to drain the updates currently in flight
+        if self._smoothed_rtt == 0.0:
+            return 0.01
+        return self._smoothed_rtt * self._inflight / max(1, self.limit)
+
+    def _on_complete(self, rtt: float):
+        now = monotonic()
+
+        if now - self._min_rtt_time > self.MIN_RTT_WINDOW or rtt < self._min_rtt:
+            self._min_rtt = rtt
+            self._min_rtt_time = now
+
+        if self._smoothed_rtt == 0.0:
+            self._smoothed_rtt = rtt
+        else:
+            self._smoothed_rtt = 0.9*self._smoothed_rtt + 0.1*rtt
+
+        if self._max_inflight == 0:
+            return
+
+        if rtt > self.RTT_TOLERANCE * self._min_rtt:
+            if now - self._last_backoff > self._smoothed_rtt:
+                self._limit = max(self._min_inflight, self._limit * self.BACKOFF)
+                self._last_backoff = now
+        else:
+            self._limit = min(self._max_inflight, self._limit + 1.0 / self._limit)
+
+    @contextmanager
+    def admit(self, size: int):
+        '''
+            Admit an update of the specified size for the duration of the context.
+            Raises Overloaded if the node is at capacity.
+        '''
+
+        if self._max_inflight > 0 and self._inflight >= self.limit:
+            raise Overloaded(self._retry_after())
+
+        if 0 < self._max_queued_bytes < self._queued_bytes + size and self._inflight > 0:
+            raise Overloaded(self._retry_after())
+
+        self._inflight += 1
+        self._queued_bytes += size
+        start = monotonic()
+
+        try:
+            yield
+        finally:
+            self._inflight -= 1
+            self._queued_bytes -= size
+            self._on_complete(monotonic() - start)
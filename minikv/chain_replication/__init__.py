@@ -1,5 +1,7 @@
 ''' Implementation for chain-replicated MiniKV '''
 
+#pylint: disable=too-many-arguments,too-many-positional-arguments
+
 import logging
 
 from asyncio import Lock, Condition
@@ -7,12 +9,18 @@ from random import randint
 
 from .. import webserver
 from ..db import Database
-from ..constants import PEER_START_PORT
-from ..networking import Connector, Connection
+from ..constants import CLIENT_START_PORT, PEER_START_PORT, PEER_TRANSPORT, LEASE_DURATION
+from ..networking import Connector, Connection, NetworkShape
+from ..tracing import Tracer
 
 from .logic import ChainReplication
 
-async def serve(index: int, connect_to: list[int]):
+async def serve(index: int, connect_to: list[int], max_inflight: int, max_queued_bytes: int,
+        tracer: Tracer|None = None, transport: str = PEER_TRANSPORT,
+        database: Database|None = None, snapshot_path: str|None = None,
+        client_port_base: int = CLIENT_START_PORT, peer_port_base: int = PEER_START_PORT,
+        lease_duration: float = LEASE_DURATION, shaping: NetworkShape|None = None,
+        coalesce_writes: bool = False):
     ''' Run MiniKV with chain replication '''
 
     assert len(connect_to) <= 1
@@ -22,8 +30,13 @@ async def serve(index: int, connect_to: list[int]):
     else:
         previous = connect_to[0]
 
-    logic = ChainReplication(index)
+    logic = ChainReplication(index, max_inflight=max_inflight,
+            max_queued_bytes=max_queued_bytes, tracer=tracer, transport=transport,
+            database=database, peer_port_base=peer_port_base,
+            client_address=webserver.client_address(index, client_port_base),
+            shaping=shaping, coalesce_writes=coalesce_writes)
     await logic.start(previous)
     print(f"Started MiniKV node with id={index} (chain replication)")
 
-    await webserver.serve(logic, index)
+    await webserver.serve(logic, index, snapshot_path=snapshot_path,
+            client_port_base=client_port_base, lease_duration=lease_duration)
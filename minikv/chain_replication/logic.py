@@ -1,15 +1,25 @@
 ''' The logic for chain-replicated MiniKV '''
 
-#pylint: disable=too-many-instance-attributes
+#pylint: disable=too-many-instance-attributes,too-many-arguments,too-many-positional-arguments
 
+import asyncio
 import logging
+import itertools
 
 from enum import Enum
-from asyncio import Lock, Condition
+from typing import AsyncIterator
+from time import monotonic_ns
+from asyncio import Lock, Event, Future
 
-from ..db import Database
-from ..constants import PEER_START_PORT
-from ..networking import Connector, Connection
+from ..db import Database, ReadView
+from ..changefeed import ChangeLog
+from ..admission import AdmissionController, Overloaded
+from ..tracing import Tracer
+from ..snapshot import fork_snapshot
+from ..dump import fork_export
+from ..constants import (PEER_START_PORT, MAX_INFLIGHT_UPDATES, MAX_QUEUED_BYTES,
+                         DISPATCH_LANES, PEER_TRANSPORT)
+from ..networking import Connector, Connection, NetworkShape
 
 class MessageType(Enum):
     ''' Possible types of messages between two nodes '''
@@ -18,38 +28,148 @@ class MessageType(Enum):
     FORWARD_PASS = 1
     # Acknowledge an update has been applied
     BACKWARD_PASS = 2
+    # Pass a client's update up the chain to the head
+    FORWARD_WRITE = 3
+    # The head could not admit (or failed to replicate) a forwarded update;
+    # passed down to the node it came from
+    WRITE_REJECTED = 4
+    # A new node asks the current tail to be appended to the chain
+    JOIN = 5
+    # The order of nodes in the chain changed
+    TOPOLOGY = 6
+    # Forward a batch of entries from a bulk load
+    BULK_PASS = 7
+    # Acknowledge a batch has been applied (without sending the entries back)
+    BULK_ACK = 8
 
-class ChainReplication:
+class ChainReplication: #pylint: disable=too-many-public-methods
     ''' The main logic for chain-replicated MiniKV '''
 
-    def __init__(self, identifier: int):
+    def __init__(self, identifier: int, max_inflight: int = MAX_INFLIGHT_UPDATES,
+            max_queued_bytes: int = MAX_QUEUED_BYTES, tracer: Tracer|None = None,
+            dispatch_lanes: int = DISPATCH_LANES, transport: str = PEER_TRANSPORT,
+            database: Database|None = None, peer_port_base: int = PEER_START_PORT,
+            client_address: str|None = None, connector_factory=Connector,
+            shaping: NetworkShape|None = None, coalesce_writes: bool = False):
+        '''
+            Set up the node. The connector_factory is called like `Connector`'s
+            constructor, so a simulated network can take the place of the real one.
+            Shaping emulates a slower network to the other nodes (see `NetworkShape`).
+            With coalesce_writes, the head only sends the latest of the writes
+            to a key that pile up while an earlier version of it is in flight.
+        '''
         assert identifier < 1000, "identifier should be a small integer"
 
         self._identifier = identifier
-        self._connector = Connector(identifier,
-                'localhost', PEER_START_PORT+identifier,
-                MessageType, self)
-        self._database = Database()
+        self._peer_port_base = peer_port_base
+        self._connector = connector_factory(identifier,
+                'localhost', peer_port_base+identifier,
+                MessageType, self, dispatch_lanes=dispatch_lanes, transport=transport,
+                shaping=shaping)
+        self._database = database if database is not None else Database()
         self._previous: Connection|None = None
-        self._next = None
+        self._next: Connection|None = None
         self._update_lock = Lock()
-        self._update_cond = Condition(lock = self._update_lock)
-        self._pending_updates: dict[int, dict] = {}
+        self._pending_updates: dict[tuple[int, int], dict] = {}
+        self._changes = ChangeLog()
+        # The head numbers updates for the whole chain. Every node applies them in that
+        # order, so a sequence number refers to the same state on every node.
+        self._last_seq_seen = 0
+        self._join_seq = 0
+        # The last update applied here (None until a joining node knows where to start),
+        # and committed ones that wait for earlier updates, by their sequence number
+        self._start_seq = 0
+        self._applied_seq: int|None = None
+        self._committed: dict[int, tuple] = {}
+        self._admission = AdmissionController(max_inflight, max_queued_bytes)
+        self._tracer = tracer if tracer is not None else Tracer(identifier)
+
+        # Transaction ids are unique across the chain, as updates may originate at any node
+        self._txn_ids = itertools.count()
+        # Updates a client waits for at this node; each is resolved once committed
+        self._waiting: dict[tuple[int, int], Future] = {}
+        self._background_tasks: set[asyncio.Task] = set()
+
+        # Keys with a version in flight, mapped to the batch of writes waiting for it (or None)
+        self._coalesce_writes = coalesce_writes
+        self._open_batches: dict[str, dict|None] = {}
+        self._num_writes = 0
+        self._num_superseded = 0
+
+        self._client_address = client_address
+        self._chain: list[tuple[int, str|None]] = [(identifier, client_address)]
+        self._topology_version = 0
+        self._joined = Event()
 
     async def start(self, previous: int|None):
-        ''' Start the chain replication logic and connec to the previous node '''
+        '''
+            Start the chain replication logic and connect to the previous node.
+            Returns once this node is part of the chain's topology.
+        '''
         await self._connector.start()
 
-        if previous is not None:
+        if previous is None:
+            self._start_seq = self._applied_seq = self._database.last_seq
+            self._last_seq_seen = self._start_seq
+            self._joined.set()
+        else:
             print(f"Connecting to predecessor with id={previous}")
             self._previous = await self._connector.connect_to_peer(hostname='localhost',
-                port=PEER_START_PORT+previous)
+                port=self._peer_port_base+previous)
+            await self._previous.send(MessageType.JOIN,
+                {'id': self._identifier, 'address': self._client_address})
+
+        await self._joined.wait()
+
+    async def stop(self):
+        ''' Disconnect from the chain '''
+        await self._connector.stop()
 
     @property
     def identifier(self) -> int:
         ''' Get the unique id of this node '''
         return self._identifier
 
+    @property
+    def tracer(self) -> Tracer:
+        ''' Records spans of sampled requests '''
+        return self._tracer
+
+    @property
+    def changes(self) -> ChangeLog:
+        ''' The log of updates this node knows to be committed '''
+        return self._changes
+
+    @property
+    def topology_version(self) -> int:
+        ''' Increases every time the order of nodes in the chain changes '''
+        return self._topology_version
+
+    @property
+    def topology(self) -> dict:
+        ''' The order of nodes in the chain (head first) and the version of that view '''
+        return {"version": self._topology_version,
+                "chain": [{"id": node_id, "address": address}
+                          for node_id, address in self._chain]}
+
+    @property
+    def coalescing_stats(self) -> dict:
+        '''
+            How many writes the head replicated, and how many of them were
+            superseded by a newer write before they were sent
+        '''
+        return {"writes": self._num_writes, "superseded": self._num_superseded}
+
+    @property
+    def object_counts(self) -> dict:
+        ''' How many of the objects that make up most of a node's memory it holds right now '''
+        return {"database_entries": len(self._database),
+                "database_versions": self._database.num_versions,
+                "pending_updates": len(self._pending_updates),
+                "unapplied_updates": len(self._committed),
+                "open_batches": len(self._open_batches),
+                "waiting_clients": len(self._waiting)}
+
     def is_tail(self):
         ''' Is this the tail of the chain? '''
         return self._next is None
@@ -63,6 +183,8 @@ class ChainReplication:
         assert self._next is None
         logging.info("Node #%i got a new connection from node #%i",
                      self.identifier, peer.identifier)
+        # Every update we see from now on is passed on to the new node
+        self._join_seq = self._last_seq_seen
         self._next = peer
 
     async def handle_disconnect(self, peer):
@@ -70,67 +192,463 @@ class ChainReplication:
         logging.info("Node #%i lost connection from node #%i",
                      self.identifier, peer.identifier)
 
-    async def handle_message(self, _peer: Connection, msg_type: MessageType, message):
+    def ordering_key(self, _msg_type: MessageType, message):
+        '''
+            Messages about the same key are handled in order, so they do not pile up
+            waiting for each other. Bulk batches carry many keys and share one lane;
+            they still apply in the right order relative to single updates, since
+            every node applies updates in the order of their sequence numbers.
+        '''
+        return message.get('key')
+
+    async def handle_message(self, peer: Connection, msg_type: MessageType, message):
         ''' Process a message from another node '''
 
+        trace_id = message.get('trace_id')
+        self._tracer.record(trace_id, "receive_buffer", peer.received_at, monotonic_ns())
+
+        with self._tracer.span(trace_id, "handle_message"):
+            await self._process_message(peer, msg_type, message, trace_id)
+
+    async def _process_message(self, peer: Connection, msg_type: MessageType, message,
+            trace_id: str|None):
+        #pylint: disable=too-many-branches,too-many-statements
         match msg_type:
             case MessageType.FORWARD_PASS:
-                # TODO add forward/downward pass logic here
-                # Apply the update locally
-                self._database.put(message['key'], message['value'])
-                
+                self._see_seq(message['seq'])
+
+                # Readers only see the update once it committed, so it is applied then
                 if self.is_tail():
+                    # The update is committed once it reaches the tail
+                    self._commit(message['seq'], [(message['key'], message['value'])],
+                                 message['txn_id'], message.get('merged'), trace_id)
+
                     # If this is the tail, start the backward pass
-                    await self._previous.send(MessageType.BACKWARD_PASS, message)
+                    previous = self._previous
+                    assert previous is not None
+                    with self._tracer.span(trace_id, "send"):
+                        await previous.send(MessageType.BACKWARD_PASS, message)
                 else:
                     # Forward the update to the next node
+                    next_node = self._next
+                    assert next_node is not None
                     async with self._update_lock:
                         self._pending_updates[message['txn_id']] = message
-                    await self._next.send(MessageType.FORWARD_PASS, message)
-            
-            
+                    with self._tracer.span(trace_id, "send"):
+                        await next_node.send(MessageType.FORWARD_PASS, message)
+
             case MessageType.BACKWARD_PASS:
-                # TODO add backward/acknowledgement pass logic here
+                # The tail has acknowledged, so the update is committed
+                self._commit(message['seq'], [(message['key'], message['value'])],
+                             message['txn_id'], message.get('merged'), trace_id)
+
                 if self.is_head():
-                    # If this is the head, complete the transaction
+                    # If this is the head, the transaction is complete (see above)
                     async with self._update_lock:
                         self._pending_updates.pop(message['txn_id'], None)
-                        self._update_cond.notify_all()
                 else:
                     # Forward the acknowledgment to the previous node
+                    previous = self._previous
+                    assert previous is not None
                     async with self._update_lock:
                         self._pending_updates.pop(message['txn_id'], None)
-                    await self._previous.send(MessageType.BACKWARD_PASS, message)
+                    with self._tracer.span(trace_id, "send"):
+                        await previous.send(MessageType.BACKWARD_PASS, message)
+
+            case MessageType.FORWARD_WRITE:
+                if self.is_head():
+                    # Do not block the lane while the update travels down the chain
+                    task = asyncio.create_task(self._replicate_forwarded(message))
+                    self._background_tasks.add(task)
+                    task.add_done_callback(self._background_tasks.discard)
+                else:
+                    previous = self._previous
+                    assert previous is not None
+                    with self._tracer.span(trace_id, "send"):
+                        await previous.send(MessageType.FORWARD_WRITE, message)
+
+            case MessageType.WRITE_REJECTED:
+                future = self._waiting.get(message['txn_id'])
+                if future is not None:
+                    if future.done():
+                        pass
+                    elif 'error' in message:
+                        future.set_exception(RuntimeError(message['error']))
+                    else:
+                        future.set_exception(Overloaded(message['retry_after']))
+                elif self._next is not None:
+                    await self._next.send(MessageType.WRITE_REJECTED, message)
+
+            case MessageType.JOIN:
+                # Only once we know where we started can we tell the new node where it starts
+                await self._joined.wait()
+
+                # The new node connected to us, so we are (or were) the tail
+                chain = self._chain + [(message['id'], message['address'])]
+                await self._update_topology(self._topology_version + 1, chain, None,
+                        first_seq=max(self._join_seq, self._start_seq) + 1)
+
+            case MessageType.TOPOLOGY:
+                if 'first_seq' in message and self._applied_seq is None:
+                    self._start_applying(message['first_seq'])
+                await self._update_topology(message['version'], message['chain'], peer)
+
+            case MessageType.BULK_PASS:
+                self._see_seq(message['seq'] + len(message['items']) - 1)
+
+                if self.is_tail():
+                    previous = self._previous
+                    assert previous is not None
+                    self._commit(message['seq'], message['items'], message['txn_id'])
+                    await previous.send(MessageType.BULK_ACK,
+                        {'txn_id': message['txn_id'], 'seq': message['seq']})
+                else:
+                    next_node = self._next
+                    assert next_node is not None
+                    async with self._update_lock:
+                        self._pending_updates[message['txn_id']] = message
+                    await next_node.send(MessageType.BULK_PASS, message)
+
+            case MessageType.BULK_ACK:
+                async with self._update_lock:
+                    batch = self._pending_updates.pop(message['txn_id'])
+                self._commit(message['seq'], batch['items'], message['txn_id'])
+
+                previous = self._previous
+                if previous is not None:
+                    await previous.send(MessageType.BULK_ACK, message)
+
+    def _next_seqs(self, count: int) -> int:
+        ''' The head numbers the next count updates; returns the first of their numbers '''
+
+        first_seq = self._last_seq_seen + 1
+        self._last_seq_seen += count
+        return first_seq
+
+    def _see_seq(self, seq: int):
+        self._last_seq_seen = max(self._last_seq_seen, seq)
+
+    def _commit(self, seq: int, items: list, txn_id=None, merged=None,
+            trace_id: str|None = None):
+        '''
+            Updates with consecutive sequence numbers, starting at seq, committed.
+            They are applied (and their clients woken up) once all earlier ones are,
+            as updates to different keys can commit out of order.
+        '''
+
+        if self._applied_seq is not None and seq <= self._applied_seq:
+            # Committed before this node joined the chain
+            self._complete(txn_id, merged)
+            return
+
+        self._committed[seq] = (items, txn_id, merged, trace_id)
+        self._apply_committed()
+
+    def _apply_committed(self):
+        if self._applied_seq is None:
+            return
+
+        while self._applied_seq + 1 in self._committed:
+            seq = self._applied_seq + 1
+            items, txn_id, merged, trace_id = self._committed.pop(seq)
+
+            if len(items) == 1:
+                key, value = items[0]
+                self._changes.append(key, value, seq)
+                with self._tracer.span(trace_id, "db_put"):
+                    self._database.put(key, value, seq)
+            else:
+                self._changes.extend(items, seq)
+                self._database.put_many(items, seq)
+
+            self._applied_seq = seq + len(items) - 1
+            self._complete(txn_id, merged)
+
+    def _start_applying(self, first_seq: int):
+        '''
+            This node joined the chain, which had numbered its updates up to
+            first_seq-1 by then; it starts out without those
+        '''
+
+        self._start_seq = self._applied_seq = first_seq - 1
+        self._see_seq(self._start_seq)
+        for seq in [seq for seq in self._committed if seq < first_seq]:
+            _, txn_id, merged, _ = self._committed.pop(seq)
+            self._complete(txn_id, merged)
+        self._apply_committed()
+
+    def _complete(self, txn_id, merged=None):
+        '''
+            Wake up the client waiting for this update (if it waits at this node),
+            and those waiting for forwarded updates that were merged into it
+        '''
+
+        if txn_id is None:
+            return
+
+        for done_id in [txn_id] + (merged or []):
+            future = self._waiting.get(done_id)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    async def _update_topology(self, version: int, chain: list, sender: Connection|None,
+            first_seq: int|None = None):
+        '''
+            Adopt a newer view of the chain and pass it on to the neighbors that did not send it.
+            A node that just joined also learns the sequence number it starts at.
+        '''
+
+        if version <= self._topology_version:
+            return
+
+        self._topology_version = version
+        self._chain = [tuple(node) for node in chain]
+        logging.info("Node #%i is now at topology version %i: %s", self.identifier,
+                     version, [node_id for node_id, _ in self._chain])
+
+        if any(node_id == self._identifier for node_id, _ in self._chain):
+            self._joined.set()
+
+        message = {'version': version, 'chain': self._chain}
+        for neighbor in (self._previous, self._next):
+            if neighbor is not None and neighbor is not sender:
+                if neighbor is self._next and first_seq is not None:
+                    await neighbor.send(MessageType.TOPOLOGY, {**message, 'first_seq': first_seq})
+                else:
+                    await neighbor.send(MessageType.TOPOLOGY, message)
+
+    async def _replicate_forwarded(self, message):
+        '''
+            Replicate an update another node forwarded to us (the head).
+            If that fails, the node it came from is told, so its client does not wait forever;
+            this also covers forwarded updates merged into a batch that failed to send.
+        '''
+
+        key, value = message['key'], message['value']
+        trace_id = message.get('trace_id')
+
+        try:
+            if self._coalesce_writes:
+                await self._replicate_coalesced(key, value, trace_id, txn_id=message['txn_id'])
+            else:
+                with self._admission.admit(len(key) + len(str(value))):
+                    await self._replicate(key, value, trace_id, txn_id=message['txn_id'])
+        except Overloaded as err:
+            rejection = {'txn_id': message['txn_id'], 'key': key,
+                         'retry_after': err.retry_after}
+        except Exception as err: #pylint: disable=broad-exception-caught
+            logging.error("Failed to replicate forwarded update %s: %s", message['txn_id'], err)
+            rejection = {'txn_id': message['txn_id'], 'key': key,
+                         'error': f"The head failed to replicate the update: {err}"}
+        else:
+            return
+
+        next_node = self._next
+        if next_node is not None:
+            await next_node.send(MessageType.WRITE_REJECTED, rejection)
 
     async def get_all(self):
         ''' Return all entries in the database '''
         return self._database.get_all()
 
-    async def get(self, key):
-        ''' Read an entry from the database '''
-        return self._database.get(key)
+    async def get(self, key, at: int|None = None):
+        ''' Read an entry from the database (as of a committed sequence number) '''
+        return self._database.get(key, at)
+
+    def read_view(self, at: int|None = None) -> ReadView:
+        ''' A consistent view of the database as of a committed sequence number '''
+        return self._database.read_view(at)
 
-    async def put(self, key, value):
-        ''' Store a new entry on all nodes in the replica set '''
-        assert self.is_head(), "Only the head can receive updates from clients"
+    async def snapshot(self, path: str) -> dict:
+        ''' Write a point-in-time snapshot of this node's database to the specified file '''
+        return await fork_snapshot(self._database, path)
+
+    async def bulk_load(self, items: list) -> int:
+        '''
+            Store a batch of [key, value] pairs on all nodes, in one message per hop.
+            Only the head accepts bulk loads (raises ValueError otherwise).
+            Batches bypass admission control: the loader bounds how many it sends
+            at once, and their long round trips would throttle regular updates.
+        '''
+
+        if not self.is_head():
+            raise ValueError("Bulk loads have to be sent to the head of the chain")
+
+        if len(items) == 0:
+            return 0
 
+        if self.is_tail():
+            self._commit(self._next_seqs(len(items)), items)
+            return len(items)
+
+        next_node = self._next
+        assert next_node is not None
+
+        txn_id = (self._identifier, next(self._txn_ids))
+        message: dict = {'txn_id': txn_id, 'items': items}
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[txn_id] = future
+
+        try:
+            async with self._update_lock:
+                message['seq'] = self._next_seqs(len(items))
+                self._pending_updates[txn_id] = message
+            # Sending a large batch takes a while, and single updates need not wait for it.
+            # They may overtake it, as every node applies updates by their sequence number.
+            await next_node.send(MessageType.BULK_PASS, message)
+            await future
+        finally:
+            del self._waiting[txn_id]
+
+        return len(items)
+
+    def export(self, fmt: str) -> AsyncIterator[bytes]:
+        ''' Stream a consistent copy of this node's entries in the specified dump format '''
+        return fork_export(self._database, fmt)
+
+    async def put(self, key, value, trace_id: str|None = None):
+        '''
+            Store a new entry on all nodes in the replica set.
+            Nodes other than the head forward the update to it.
+            Raises Overloaded if the head cannot admit more updates right now.
+        '''
+
+        if not self.is_head():
+            await self._forward_to_head(key, value, trace_id)
+            return
+
+        if self._coalesce_writes:
+            await self._replicate_coalesced(key, value, trace_id)
+            return
+
+        with self._admission.admit(len(key) + len(str(value))):
+            await self._replicate(key, value, trace_id)
+
+    async def _replicate_coalesced(self, key, value, trace_id: str|None, txn_id=None):
+        '''
+            Replicate an update right away if no other version of its key is in flight.
+            Otherwise, it joins the key's open batch, in which newer writes replace older
+            ones; the batch is sent once the version in flight commits, and all its
+            writers are acknowledged once the batch commits.
+            Only updates that are sent right away go through admission control.
+        '''
+
+        self._num_writes += 1
+
+        if key not in self._open_batches:
+            with self._admission.admit(len(key) + len(str(value))):
+                self._open_batches[key] = None
+                try:
+                    await self._replicate(key, value, trace_id, txn_id=txn_id)
+                finally:
+                    self._send_open_batch(key)
+            return
+
+        batch = self._open_batches[key]
+        if batch is None:
+            batch = {'value': value, 'trace_id': trace_id, 'merged': [],
+                     'done': asyncio.get_running_loop().create_future()}
+            self._open_batches[key] = batch
+        else:
+            batch['value'] = value
+            batch['trace_id'] = trace_id
+            self._num_superseded += 1
+
+        # Forwarded updates are acknowledged by their node once the batch passes through it
+        if txn_id is not None:
+            batch['merged'].append(txn_id)
+
+        await batch['done']
+
+    def _send_open_batch(self, key):
+        ''' The version of the key in flight committed; send its open batch (if any) '''
+
+        batch = self._open_batches.pop(key)
+        if batch is None:
+            return
+
+        # The key stays in flight, so newer writes open the next batch
+        self._open_batches[key] = None
+
+        async def send():
+            try:
+                await self._replicate(key, batch['value'], batch['trace_id'],
+                                      merged=batch['merged'])
+            except Exception as err: #pylint: disable=broad-exception-caught
+                batch['done'].set_exception(err)
+                # Its writers may all have gone away; do not log the error as never retrieved
+                batch['done'].exception()
+            else:
+                batch['done'].set_result(None)
+            finally:
+                self._send_open_batch(key)
+
+        task = asyncio.create_task(send())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _forward_to_head(self, key, value, trace_id: str|None):
+        '''
+            Pass an update up the chain to the head.
+            It is complete once its acknowledgement passes through this node
+            on its way back to the head, so the client waits no longer than if
+            it had sent the update to the head itself.
+        '''
+
+        previous = self._previous
+        assert previous is not None
+
+        txn_id = (self._identifier, next(self._txn_ids))
+        message = {'txn_id': txn_id, 'key': key, 'value': value}
+        if trace_id is not None:
+            message['trace_id'] = trace_id
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[txn_id] = future
+
+        try:
+            with self._tracer.span(trace_id, "send"):
+                await previous.send(MessageType.FORWARD_WRITE, message)
+            await future
+        finally:
+            del self._waiting[txn_id]
+
+    async def _replicate(self, key, value, trace_id: str|None, txn_id=None, merged=None):
         if self.is_tail():
             logging.info("Using fast path to store data. The chain is of length 1.")
-            self._database.put(key, value)
+            self._commit(self._next_seqs(1), [(key, value)], trace_id=trace_id)
         else:
-            # TODO add request to pending_updates and wait for it to complete
-            self._database.put(key, value)
-            
-            txn_id = hash(key)
+            next_node = self._next
+            assert next_node is not None
+
+            if txn_id is None:
+                txn_id = (self._identifier, next(self._txn_ids))
             message = {
                 'txn_id': txn_id,
                 'key': key,
                 'value': value
             }
 
-            async with self._update_lock:
-                self._pending_updates[txn_id] = message
-                await self._next.send(MessageType.FORWARD_PASS, message)
+            # Only sampled updates carry a trace id, so the others stay small
+            if trace_id is not None:
+                message['trace_id'] = trace_id
+            if merged:
+                message['merged'] = merged
+
+            # Only this update's waiter is woken up once it completes, not every pending one
+            future = asyncio.get_running_loop().create_future()
+            self._waiting[txn_id] = future
+
+            try:
+                async with self._update_lock:
+                    # Number updates in the order they are sent
+                    message['seq'] = self._next_seqs(1)
+                    self._pending_updates[txn_id] = message
+                    with self._tracer.span(trace_id, "send"):
+                        await next_node.send(MessageType.FORWARD_PASS, message)
                 # Wait for the update to complete
-                await self._update_cond.wait_for(lambda: txn_id not in self._pending_updates)
+                await future
+            finally:
+                del self._waiting[txn_id]
 
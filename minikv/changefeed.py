@@ -0,0 +1,114 @@
+''' A bounded in-memory log of committed updates that clients can watch '''
+
+import json
+import asyncio
+
+from .constants import CHANGE_LOG_CAPACITY
+
+class CursorExpired(Exception):
+    ''' The requested position has already been evicted from the change log '''
+
+class ChangeLog:
+    '''
+        Keeps the most recent committed updates in a ring buffer.
+
+        Every update gets a sequence number, which watchers use as a cursor.
+        Appending never waits for watchers, so a slow consumer cannot slow down
+        writers; instead it falls behind and eventually gets a CursorExpired.
+        Each entry is serialized once on append and shared by all watchers.
+
+        Updates either get the next sequence number or bring their own, e.g.,
+        one assigned by the head of the chain. Those have to be consecutive,
+        except that an empty log can start at any sequence number.
+    '''
+
+    def __init__(self, capacity: int = CHANGE_LOG_CAPACITY):
+        assert capacity > 0
+
+        self._capacity = capacity
+        self._ring: list[tuple[int, str, bytes]|None] = [None] * capacity
+        self._first_seq = 1
+        self._next_seq = 1
+        self._changed = asyncio.Event()
+
+    @property
+    def next_seq(self) -> int:
+        ''' The sequence number the next committed update will get '''
+        return self._next_seq
+
+    @property
+    def oldest_seq(self) -> int:
+        ''' The sequence number of the oldest update still held in the log '''
+        return max(self._first_seq, self._next_seq - self._capacity)
+
+    def _claim(self, seq: int|None) -> int:
+        if seq is None:
+            return self._next_seq
+
+        if self._next_seq == self._first_seq:
+            # Nothing was recorded yet, so the log can start here
+            self._first_seq = self._next_seq = seq
+        assert seq == self._next_seq, "Sequence numbers have to be consecutive"
+        return seq
+
+    def append(self, key: str, value: str, seq: int|None = None) -> int:
+        '''
+            Record a committed update (with the specified sequence number,
+            the next one by default) and wake up all waiting watchers
+        '''
+
+        seq = self._claim(seq)
+        line = json.dumps({"seq": seq, "key": key, "value": value}) + "\n"
+        self._ring[seq % self._capacity] = (seq, key, line.encode('utf-8'))
+        self._next_seq += 1
+
+        # Swap the event first, so watchers that wake up wait on a fresh one
+        changed = self._changed
+        self._changed = asyncio.Event()
+        changed.set()
+
+        return seq
+
+    def extend(self, items: list, first_seq: int|None = None) -> int:
+        '''
+            Record a batch of committed updates, e.g., from a bulk load, with
+            consecutive sequence numbers starting at first_seq (the next one by default).
+            Only the ones that still fit into the log are serialized; watchers
+            that have not seen the others yet fall behind, as if they were slow.
+            Returns the sequence number of the last update.
+        '''
+
+        start = self._claim(first_seq)
+        skipped = max(0, len(items) - self._capacity)
+
+        for offset in range(skipped, len(items)):
+            key, value = items[offset]
+            seq = start + offset
+            line = json.dumps({"seq": seq, "key": key, "value": value}) + "\n"
+            self._ring[seq % self._capacity] = (seq, key, line.encode('utf-8'))
+
+        self._next_seq += len(items)
+
+        changed = self._changed
+        self._changed = asyncio.Event()
+        changed.set()
+
+        return self._next_seq - 1
+
+    def read(self, cursor: int, limit: int = 1000) -> list[tuple[int, str, bytes]]:
+        '''
+            Get up to limit updates starting at the specified sequence number.
+            Each update is returned as its sequence number, key, and JSON line.
+        '''
+
+        if cursor < self.oldest_seq:
+            raise CursorExpired(f"Sequence number {cursor} is no longer available")
+
+        end = min(self._next_seq, cursor + limit)
+        return [self._ring[seq % self._capacity] for seq in range(cursor, end)] # type: ignore
+
+    async def wait(self, cursor: int):
+        ''' Block until there is an update with a sequence number of at least cursor '''
+
+        while cursor >= self._next_seq:
+            await self._changed.wait()
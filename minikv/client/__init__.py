@@ -1,6 +1,6 @@
 ''' A simple client that fetches data or writes to the database using HTTP '''
 
-#pylint: disable=too-many-branches,too-many-statements
+#pylint: disable=too-many-branches,too-many-statements,too-many-locals
 
 import argparse
 import sys
@@ -8,34 +8,167 @@ import json
 import logging
 
 from sys import argv
+from time import sleep, monotonic
 from string import ascii_lowercase
 from random import randint, choice
 from requests import Session
 
+from .cache import ReadCache
+
 class RequestSender:
-    ''' Maintains a connection to the MiniKV server '''
+    '''
+        Maintains a connection to the MiniKV server.
+
+        Writes go straight to the head of the chain, which is looked up in
+        the (cached) topology; with route_writes=False they go to the node at
+        address instead, which forwards them. Reads go to the node at address,
+        or to the tail with read_from="tail".
+        With a positive cache_size, reads are cached under leases granted by the node.
+    '''
+
+    def __init__(self, address, cache_size=0, read_from="nearest", route_writes=True):
+        assert read_from in ("nearest", "tail")
 
-    def __init__(self, address):
         self._address = address
         self._session = Session()
+        self._read_from = read_from
+        self._route_writes = route_writes
+        self._topology: dict|None = None
+
+        if cache_size > 0:
+            self._cache: ReadCache|None = ReadCache(f"http://{self._read_address()}",
+                                                    cache_size)
+        else:
+            self._cache = None
+
+    @property
+    def cache(self) -> ReadCache|None:
+        ''' The read cache, if enabled '''
+        return self._cache
+
+    def close(self):
+        ''' Close the connection (and stop the read cache) '''
+        if self._cache is not None:
+            self._cache.close()
+        self._session.close()
 
     @property
     def base_url(self) -> str:
-        ''' The start of the URL we use for all requests '''
+        ''' The start of the URL we use for requests to the node we were pointed at '''
         return f"http://{self._address}"
 
-    def write(self, key, value):
-        ''' Write a new entry to the database '''
-        result = self._session.post(f"{self.base_url}/put?key={key}",
-            data=json.dumps({'value': value}), timeout=2.0)
+    @property
+    def topology(self) -> dict:
+        ''' The order of nodes in the chain (head first), fetched when first needed '''
+
+        if self._topology is None:
+            result = self._session.get(f"{self.base_url}/topology", timeout=2.0)
+            result.raise_for_status()
+            self._topology = result.json()
+
+        return self._topology
+
+    def _check_topology(self, result):
+        ''' Drop our view of the topology if a response says it is outdated '''
+
+        version = result.headers.get("X-Topology-Version")
+        if self._topology is not None and version is not None \
+                and int(version) != self._topology["version"]:
+            logging.debug("Topology changed to version %s", version)
+            self._topology = None
+
+    def _write_address(self) -> str:
+        if not self._route_writes:
+            return self._address
+        return self.topology["chain"][0]["address"] or self._address
+
+    def _read_address(self) -> str:
+        if self._read_from == "nearest":
+            return self._address
+        return self.topology["chain"][-1]["address"] or self._address
+
+    def write(self, key, value, max_retries=10):
+        '''
+            Write a new entry to the database.
+            Backs off and retries if the node reports it is overloaded.
+        '''
+        for _ in range(max_retries):
+            result = self._session.post(f"http://{self._write_address()}/put?key={key}",
+                data=json.dumps({'value': value}), timeout=2.0)
+            self._check_topology(result)
+            if result.status_code != 503:
+                break
+            if "X-Retry-After-Ms" in result.headers:
+                sleep(float(result.headers["X-Retry-After-Ms"]) / 1000)
+            else:
+                sleep(float(result.headers.get("Retry-After", 1)))
+
         result.raise_for_status()
 
     def read(self, key) -> str:
-        ''' Read an entry from the database '''
-        result = self._session.get(f"{self.base_url}/get?key={key}",
+        ''' Read an entry from the database (or the cache if it holds a lease on it) '''
+
+        url = f"http://{self._read_address()}/get"
+
+        if self._cache is None:
+            result = self._session.get(url, params={'key': key}, timeout=2.0)
+            self._check_topology(result)
+            result.raise_for_status()
+            return result.json()["value"]
+
+        found, value, token = self._cache.lookup(key)
+        if found:
+            return value # type: ignore
+
+        # A node other than the one the cache listens to grants no lease, so this stays safe
+        start = monotonic()
+        result = self._session.get(url, params={'key': key, 'holder': self._cache.holder},
             timeout=2.0)
+        self._check_topology(result)
         result.raise_for_status()
-        return result.json()["value"]
+
+        body = result.json()
+        self._cache.store(key, body["value"], body.get("lease", 0.0), start, token)
+        return body["value"]
+
+    def watch(self, prefix="", since=None):
+        '''
+            Stream committed updates for all keys starting with prefix.
+            Yields (seq, key, value) tuples; pass seq+1 as since to resume later.
+        '''
+        params = {'prefix': prefix}
+        if since is not None:
+            params['since'] = since
+
+        with self._session.get(f"{self.base_url}/watch", params=params,
+                stream=True, timeout=(2.0, None)) as result:
+            result.raise_for_status()
+            for line in result.iter_lines():
+                if not line:
+                    continue
+                entry = json.loads(line)
+                if "error" in entry:
+                    raise RuntimeError(f"Watch failed: {entry['error']}")
+                yield entry["seq"], entry["key"], entry["value"]
+
+    def bulk_load(self, body: bytes) -> int:
+        '''
+            Store a batch of entries, already serialized as a JSON list of [key, value]
+            pairs, on all nodes. Batches always go to the head. Returns their number.
+        '''
+        result = self._session.post(f"http://{self.topology['chain'][0]['address']}/admin/load",
+            data=body, headers={"Content-Type": "application/json"}, timeout=60.0)
+        self._check_topology(result)
+        result.raise_for_status()
+        return result.json()["loaded"]
+
+    def export(self, fmt="ndjson", chunk_size=64*1024):
+        ''' Stream all entries of the node in the specified dump format, as chunks of bytes '''
+
+        with self._session.get(f"{self.base_url}/admin/export", params={'format': fmt},
+                stream=True, timeout=(2.0, None)) as result:
+            result.raise_for_status()
+            yield from result.iter_content(chunk_size)
 
 def run():
     ''' Main logic of the client '''
@@ -45,14 +178,21 @@ def run():
         argv[0] = "python"
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('mode', choices=['test', 'fill', 'check-values', 'random-ops'])
+    parser.add_argument('mode',
+        choices=['test', 'fill', 'check-values', 'random-ops', 'watch', 'check-cache'])
     parser.add_argument('--server-address', default="127.0.0.1:8080")
+    parser.add_argument('--read-from', default="nearest", choices=["nearest", "tail"],
+            help="Read from the node at --server-address or from the tail of the chain")
+    parser.add_argument('--no-route-writes', action='store_true',
+            help="Send writes to --server-address instead of looking up the head")
     parser.add_argument('--key-offset', default=0, type=int,
             help="Start the key range at an offset, not 0")
     parser.add_argument('--key-range', default=1000, type=int)
     parser.add_argument('--value-prefix', default="value", type=str)
     parser.add_argument('--write-chance', default=50, type=int)
     parser.add_argument('--num-ops', default=1000, type=int)
+    parser.add_argument('--max-staleness', default=5.0, type=float,
+            help="How many seconds check-cache tolerates stale reads after a write")
     parser.add_argument("--loglevel", default="info",
         help="Set the logging verbosity", choices=["warn", "debug", "info"])
 
@@ -72,7 +212,8 @@ def run():
         sys.exit(1)
 
     key_range = range(args.key_offset, args.key_offset+args.key_range)
-    rsender = RequestSender(args.server_address)
+    rsender = RequestSender(args.server_address, read_from=args.read_from,
+            route_writes=not args.no_route_writes)
 
     def make_key(idx):
         ''' Generate an entries key from its index '''
@@ -130,3 +271,54 @@ def run():
                         print(f'Invalid value for key "{key}". '
                               f'Expected "{expected}", but got "{result}".')
                         sys.exit(1)
+
+        case "watch":
+            # Replays the log from the start, so it does not matter if the writes already happened
+            expected_keys = {make_key(i) for i in key_range}
+
+            for _, key, value in rsender.watch(prefix="key", since=1):
+                if key not in expected_keys:
+                    continue
+
+                expected = make_value(int(key[len("key"):]))
+                if value != expected:
+                    print(f'Invalid update for key "{key}". '
+                          f'Expected "{expected}", but got "{value}".')
+                    sys.exit(1)
+
+                expected_keys.discard(key)
+                if len(expected_keys) == 0:
+                    break
+
+        case "check-cache":
+            # Cached reads have to see our own writes within the lease bound
+            csender = RequestSender(args.server_address, cache_size=args.key_range)
+            if not csender.cache.wait_connected(timeout=5.0): # type: ignore
+                print("ERROR: Read cache did not connect to the node")
+                sys.exit(1)
+
+            for i in key_range:
+                key = make_key(i)
+                for _ in range(2):
+                    result = csender.read(key)
+                    if result != make_value(i):
+                        print(f'Invalid value for key "{key}". '
+                              f'Expected "{make_value(i)}", but got "{result}".')
+                        sys.exit(1)
+
+                updated = make_value(i) + "-updated"
+                rsender.write(key, updated)
+                written_at = monotonic()
+
+                while csender.read(key) != updated:
+                    if monotonic() - written_at > args.max_staleness:
+                        print(f'Cache served a stale value for key "{key}" '
+                              f'for more than {args.max_staleness}s')
+                        sys.exit(1)
+                    sleep(0.01)
+
+            if csender.cache.hits == 0: # type: ignore
+                print("ERROR: No read was served from the cache")
+                sys.exit(1)
+
+            csender.close()
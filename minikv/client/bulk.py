@@ -0,0 +1,144 @@
+''' Seeds a cluster from a dump file and exports a node's entries to one '''
+
+#pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+#pylint: disable=consider-using-with
+
+import os
+import sys
+import json
+import logging
+import argparse
+import threading
+import multiprocessing
+
+from sys import argv
+from time import monotonic
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from . import RequestSender
+from .. import dump
+from ..constants import BULK_CHUNK_SIZE
+
+def _parse_batch(chunk: bytes, fmt: str) -> tuple[int, bytes]:
+    ''' Runs in a worker process: turn a chunk of the dump into the body of a load request '''
+    items = dump.parse(chunk, fmt)
+    return len(items), json.dumps(items).encode('utf-8')
+
+def load(address: str, path: str, fmt: str, workers: int, inflight: int = 1,
+        chunk_size: int = BULK_CHUNK_SIZE) -> int:
+    '''
+        Load all entries of a dump into the cluster; returns their number.
+
+        Chunks of the file are parsed by a pool of worker processes, while
+        the parsed batches are sent to the head in file order. With more
+        than one batch in flight, a key that is in multiple batches may end
+        up with either value.
+    '''
+
+    local = threading.local()
+    # Every sending thread gets its own connection; closed once we are done
+    connections: list[RequestSender] = []
+
+    def send(body: bytes) -> int:
+        if not hasattr(local, "sender"):
+            local.sender = RequestSender(address)
+            connections.append(local.sender)
+        return local.sender.bulk_load(body)
+
+    total = 0
+
+    try:
+        with open(path, 'rb') as ifile, multiprocessing.Pool(workers) as pool, \
+                ThreadPoolExecutor(inflight) as senders:
+            # Only parse a few chunks ahead, so a slow cluster does not fill up our memory
+            parsing: deque = deque()
+            sending: deque = deque()
+
+            def send_next():
+                nonlocal total
+                _, body = parsing.popleft().get()
+                sending.append(senders.submit(send, body))
+                while len(sending) >= inflight:
+                    total += sending.popleft().result()
+
+            for chunk in dump.split(ifile, fmt, chunk_size):
+                parsing.append(pool.apply_async(_parse_batch, (chunk, fmt)))
+                if len(parsing) >= 2 * workers:
+                    send_next()
+
+            while len(parsing) > 0:
+                send_next()
+
+            while len(sending) > 0:
+                total += sending.popleft().result()
+    finally:
+        for sender in connections:
+            sender.close()
+
+    return total
+
+def export(address: str, path: str, fmt: str) -> int:
+    '''
+        Write all entries of the node to a file ("-" for stdout); returns the number of bytes.
+        The node serializes the entries in a forked process and streams them as they are ready.
+    '''
+
+    sender = RequestSender(address)
+    written = 0
+
+    # Leave stdout open for whoever writes to it after us
+    output = open(path, 'wb') if path != "-" else nullcontext(sys.stdout.buffer)
+
+    try:
+        with output as ofile:
+            for chunk in sender.export(fmt):
+                ofile.write(chunk)
+                written += len(chunk)
+            ofile.flush()
+    finally:
+        sender.close()
+
+    return written
+
+def run():
+    ''' Main logic of the bulk loader and exporter '''
+
+    # Invoked by test runner?
+    if argv[0] == "-c":
+        argv[0] = "python"
+
+    parser = argparse.ArgumentParser(description="Load a dump into MiniKV or export one")
+    parser.add_argument('mode', choices=['load', 'export'])
+    parser.add_argument('path', help="The dump to read or write (- for stdout)")
+    parser.add_argument('--server-address', default="127.0.0.1:8080",
+            help="Any node; loads are sent to the head of its chain")
+    parser.add_argument('--format', default=None, choices=dump.FORMATS,
+            help="The format of the dump (guessed from the file extension by default)")
+    parser.add_argument('--workers', default=os.cpu_count() or 1, type=int,
+            help="How many processes parse the dump")
+    parser.add_argument('--inflight', default=1, type=int,
+            help="How many batches to send to the head at once")
+    parser.add_argument('--chunk-size', default=BULK_CHUNK_SIZE, type=int,
+            help="About how many bytes of the dump go into each batch")
+    parser.add_argument("--loglevel", default="info",
+        help="Set the logging verbosity", choices=["warn", "debug", "info"])
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel.upper())
+
+    fmt = args.format or dump.guess_format(args.path)
+    start = monotonic()
+
+    try:
+        if args.mode == "load":
+            count = load(args.server_address, args.path, fmt, args.workers,
+                         inflight=args.inflight, chunk_size=args.chunk_size)
+            logging.info("Loaded %i entries in %.2fs", count, monotonic() - start)
+        else:
+            size = export(args.server_address, args.path, fmt)
+            logging.info("Exported %i bytes in %.2fs", size, monotonic() - start)
+    except (OSError, dump.DumpError, ValueError) as err:
+        print(f"ERROR: {err}")
+        sys.exit(1)
@@ -0,0 +1,162 @@
+''' An opt-in client-side read cache that stays fresh through server-granted leases '''
+
+#pylint: disable=too-many-instance-attributes
+
+import json
+import uuid
+import logging
+import threading
+
+from time import monotonic, sleep
+from collections import OrderedDict
+from requests import Session, RequestException
+
+class ReadCache:
+    '''
+        Caches values the node granted a read lease on, bounded by an LRU.
+
+        A background thread listens for invalidations from the node. Values are
+        never served after their lease ran out, so even if an invalidation gets
+        lost, a read is at most one lease duration stale. While the thread is
+        not connected, the node grants no leases and nothing gets cached.
+    '''
+
+    # How long to wait before reconnecting the invalidation stream
+    RECONNECT_DELAY = 0.1
+
+    def __init__(self, base_url: str, capacity: int):
+        assert capacity > 0
+
+        self._base_url = base_url
+        self._capacity = capacity
+        self._holder = uuid.uuid4().hex
+        self._entries: OrderedDict[str, tuple[object, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Bumped on every invalidation, so reads that raced with one are not cached
+        self._generation = 0
+        self._connected = False
+        self._closed = False
+
+        self._hits = 0
+        self._misses = 0
+
+        self._thread = threading.Thread(target=self._listen, daemon=True)
+        self._thread.start()
+
+    @property
+    def holder(self) -> str:
+        ''' The id the node knows this cache by '''
+        return self._holder
+
+    @property
+    def hits(self) -> int:
+        ''' How many reads were served from the cache '''
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        ''' How many reads had to go to the node '''
+        return self._misses
+
+    def wait_connected(self, timeout: float) -> bool:
+        ''' Wait until the node sends us invalidations; returns False on timeout '''
+
+        deadline = monotonic() + timeout
+        while not self._connected:
+            if monotonic() >= deadline:
+                return False
+            sleep(0.01)
+        return True
+
+    def lookup(self, key: str) -> tuple[bool, object, int]:
+        '''
+            Check the cache for a key with an unexpired lease.
+            Returns whether it was found, the value, and a token to pass to store().
+        '''
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                value, expiry = entry
+                if expiry > monotonic():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return True, value, self._generation
+                del self._entries[key]
+
+            self._misses += 1
+            return False, None, self._generation
+
+    def store(self, key: str, value, lease: float, start: float, token: int):
+        '''
+            Cache a value read from the node.
+            The lease counts from when the request was sent (start), which is
+            no later than when the node granted it.
+        '''
+
+        with self._lock:
+            if lease <= 0.0 or not self._connected or token != self._generation:
+                return
+
+            self._entries[key] = (value, start + lease)
+            self._entries.move_to_end(key)
+
+            if len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys: list[str]):
+        ''' Drop the specified keys, which have been updated '''
+
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def _set_connected(self, connected: bool):
+        with self._lock:
+            self._generation += 1
+            self._connected = connected and not self._closed
+            if not connected:
+                # We may have missed invalidations
+                self._entries.clear()
+
+    def _listen(self):
+        session = Session()
+
+        while not self._closed:
+            try:
+                with session.get(f"{self._base_url}/leases", params={'holder': self._holder},
+                        stream=True, timeout=(2.0, None)) as result:
+                    result.raise_for_status()
+                    self._set_connected(True)
+
+                    for line in result.iter_lines():
+                        if self._closed:
+                            break
+                        if not line:
+                            continue
+                        entry = json.loads(line)
+                        if "error" in entry:
+                            logging.warning("Invalidation stream failed: %s", entry["error"])
+                            break
+                        self.invalidate(entry["invalidate"])
+            except RequestException as err:
+                logging.debug("Lost invalidation stream: %s", err)
+
+            self._set_connected(False)
+
+            if not self._closed:
+                sleep(self.RECONNECT_DELAY)
+
+        session.close()
+
+    def close(self):
+        '''
+            Stop caching and drop all cached entries.
+            The (daemon) listener thread exits once it wakes up the next time.
+        '''
+
+        self._closed = True
+        self._set_connected(False)
@@ -2,8 +2,83 @@
 Constant needed in different parts of the codebase
 '''
 
-# The port to listen for client/HTTP connections
+# The default port to listen for client/HTTP connections (node i uses this plus i)
 CLIENT_START_PORT=8080
 
-# The port to listen for other node connections
+# The default port to listen for other node connections (node i uses this plus i)
 PEER_START_PORT=50000
+
+# How many committed updates each node keeps around for watchers
+CHANGE_LOG_CAPACITY=10000
+
+# How many of the most recent sequence numbers each node can still be read at
+# (/get?at=); older versions are only kept while a read view needs them
+MVCC_HISTORY=10000
+
+# How many entries a scan reads before it lets other requests run
+SCAN_CHUNK_SIZE=100
+
+# Default caps on the updates the chain head admits at once (0 disables a cap)
+MAX_INFLIGHT_UPDATES=1024
+MAX_QUEUED_BYTES=64*1024*1024
+
+# The adaptive in-flight cap never shrinks below this
+MIN_INFLIGHT_UPDATES=32
+
+# Fraction of client updates that are traced across the chain by default
+TRACE_SAMPLE_RATE=0.0
+
+# How many handler tasks each peer connection spreads incoming messages over
+# (0 handles messages inline in the socket reader)
+DISPATCH_LANES=16
+
+# How many messages may wait for each handler task before the reader blocks
+DISPATCH_QUEUE_SIZE=1024
+
+# How many seconds a closed connection waits for its queued messages to be handled;
+# the rest is dropped, so a stuck handler does not keep the disconnect from being handled
+DISPATCH_FLUSH_TIMEOUT=5.0
+
+# How nodes reach their peers: "tcp", "unix" (domain sockets), "shm" (experimental
+# shared memory), or "auto" (domain sockets for peers on this host, TCP otherwise)
+PEER_TRANSPORT="auto"
+
+# Size of each of the two rings of a shared-memory peer connection
+SHM_RING_SIZE=1024*1024
+
+# How many seconds a read lease granted to a caching client lasts (0 grants none)
+LEASE_DURATION=1.0
+
+# Size of the Count-Min sketch each node tracks key popularity with (per reads and writes)
+HOTKEY_SKETCH_WIDTH=2048
+HOTKEY_SKETCH_DEPTH=4
+
+# How many of the most popular keys each node keeps exact-ish counts for
+HOTKEY_TOP_K=32
+
+# Accesses count half as much after this many seconds
+HOTKEY_HALF_LIFE=60.0
+
+# How many bytes a shaped (emulated) link holds before senders have to wait,
+# like a socket's send buffer
+SHAPING_BUFFER_SIZE=256*1024
+
+# Largest request body a node accepts, which bounds the batches of a bulk load
+MAX_REQUEST_SIZE=64*1024*1024
+
+# Bulk loads read their input in chunks of about this many bytes;
+# each chunk is parsed on its own and sent to the head as one batch
+BULK_CHUNK_SIZE=1024*1024
+
+# How often a CPU profile samples the stack of the event loop (in seconds)
+PROFILE_SAMPLE_INTERVAL=0.005
+
+# Shortest sampling interval of a CPU profile (the sampler holds the GIL while it walks the stack)
+PROFILE_MIN_INTERVAL=0.001
+
+# Longest a CPU or event-loop profile may run (in seconds)
+PROFILE_MAX_DURATION=60.0
+
+# How many frames of each allocation memory profiles keep; more attribute memory better,
+# but tracing gets slower (the cost of every allocation grows with the depth)
+TRACEMALLOC_FRAMES=4
@@ -1,34 +1,275 @@
 ''' Database logic '''
 
+#pylint: disable=too-many-instance-attributes
+
 import logging
 
 from threading import Lock
+from typing import Iterable, Iterator
+
+from .constants import MVCC_HISTORY
+from .snapshot import SnapshotReader
+
+class VersionExpired(Exception):
+    ''' The requested sequence number is older than the versions the database still keeps '''
 
 class Database:
-    ''' Stores key/value pairs in memory '''
+    '''
+        Stores key/value pairs in memory, keeping multiple versions of each.
+        Can start out from a snapshot, whose entries are then only read on demand.
+
+        Every value is tagged with the sequence number of the committed update that
+        wrote it, so readers can see the database as of any recent sequence number
+        without taking the lock: versions are only ever appended, and a read picks
+        the newest one that is not newer than its sequence number.
+        Old versions are dropped once neither an open read view nor the history
+        window (the last `history` sequence numbers) needs them anymore. Writes do
+        that work a little at a time, so there is no separate collector.
+        Entries of the snapshot the database started from count as sequence number 0.
+    '''
+
+    def __init__(self, base: SnapshotReader|None = None, history: int = MVCC_HISTORY):
+        assert history >= 0
 
-    def __init__(self):
         self._lock = Lock()
-        self._data = {}
+        self._versions: dict[str, list[tuple[int, object]]] = {}
+        self._base = base
+        self._history = history
+        self._last_seq = 0
+        self._horizon = 0
+        self._num_versions = 0
+        # Keys that still had older versions when they were last pruned
+        self._stale: set[str] = set()
+        # Sequence numbers of open read views (and how many are open at each)
+        self._readers: dict[int, int] = {}
 
-    def get(self, key: str) -> str|None:
-        ''' Get the value of the entry with the specified key '''
+    @classmethod
+    def from_snapshot(cls, path: str) -> 'Database':
+        ''' Create a database backed by a (memory-mapped) snapshot file '''
+        return cls(base=SnapshotReader(path))
 
-        with self._lock:
-            result = self._data.get(key, None)
-            logging.debug('Got get request for key "%s". Result was "%s".', key, str(result))
+    @property
+    def last_seq(self) -> int:
+        ''' The sequence number of the newest update in the database '''
+        return self._last_seq
+
+    @property
+    def horizon(self) -> int:
+        ''' The oldest sequence number the database can still be read at '''
+        return self._horizon
+
+    @property
+    def num_versions(self) -> int:
+        ''' How many versions (of all keys) are held in memory '''
+        return self._num_versions
+
+    def __len__(self) -> int:
+        ''' How many entries are held in memory (entries only in the snapshot are not counted) '''
+        return len(self._versions)
+
+    def _value_at(self, key: str, seq: int):
+        versions = self._versions.get(key)
+        if versions is not None:
+            for version_seq, value in reversed(versions):
+                if version_seq <= seq:
+                    return value
+
+        if self._base is not None:
+            return self._base.get(key)
+        return None
+
+    def _check_seq(self, seq: int):
+        if seq > self._last_seq:
+            raise ValueError(f"Sequence number {seq} has not been committed yet")
+        if seq < self._horizon:
+            raise VersionExpired(f"Sequence number {seq} is no longer available")
+
+    def get(self, key: str, at: int|None = None) -> str|None:
+        '''
+            Get the value of the entry with the specified key, as of the specified
+            sequence number (the newest one by default).
+            Raises VersionExpired if the versions at that sequence number are gone.
+        '''
 
-        return result
+        if at is None:
+            versions = self._versions.get(key)
+            result = versions[-1][1] if versions else None
+            if result is None and self._base is not None:
+                result = self._base.get(key)
+        else:
+            self._check_seq(at)
+            result = self._value_at(key, at)
 
-    def put(self, key: str, value: str) -> None:
-        ''' Store a new entry or update an existing one '''
+        logging.debug('Got get request for key "%s". Result was "%s".', key, str(result))
+        return result # type: ignore
+
+    def put(self, key: str, value: str, seq: int|None = None) -> None:
+        '''
+            Store a new version of an entry, written by the update with the specified
+            sequence number (the one after the newest by default).
+            Sequence numbers have to increase with every update.
+        '''
 
         with self._lock:
             logging.debug('Got put request to store "%s" for key "%s"', value, key)
-            self._data[key] = value
+            self._add_version(key, value, self._next_seq(seq))
+            self._collect()
+
+    def put_many(self, items: list, first_seq: int|None = None) -> None:
+        ''' Store a batch of key-value pairs at once, with consecutive sequence numbers '''
+
+        with self._lock:
+            logging.debug('Got request to store a batch of %i entries', len(items))
+            seq = self._next_seq(first_seq)
+            for key, value in items:
+                self._add_version(key, value, seq)
+                seq += 1
+            self._collect()
+
+    def _next_seq(self, seq: int|None) -> int:
+        if seq is None:
+            return self._last_seq + 1
+        assert seq > self._last_seq, "Sequence numbers have to increase"
+        return seq
+
+    def _add_version(self, key: str, value, seq: int):
+        versions = self._versions.get(key)
+        if versions is None:
+            self._versions[key] = [(seq, value)]
+        else:
+            versions.append((seq, value))
+            self._prune(key, versions)
+        self._num_versions += 1
+        self._last_seq = seq
+
+    def _prune(self, key: str, versions: list):
+        ''' Drop the versions of a key that no read can see anymore '''
+
+        # Nobody reads below the horizon, so the newest version at the horizon
+        # is the oldest one that can still be seen
+        end = 0
+        while end + 1 < len(versions) and versions[end + 1][0] <= self._horizon:
+            end += 1
+
+        if end > 0:
+            del versions[:end]
+            self._num_versions -= end
+
+        if len(versions) > 1:
+            self._stale.add(key)
+        else:
+            self._stale.discard(key)
+
+    def _collect(self):
+        ''' Move the horizon forward and prune a few keys that were left with old versions '''
+
+        horizon = max(0, self._last_seq - self._history)
+        if len(self._readers) > 0:
+            horizon = min(horizon, *self._readers)
+        self._horizon = max(self._horizon, horizon)
+
+        # Pruning more keys than a write adds makes sure the backlog shrinks
+        for _ in range(min(2, len(self._stale))):
+            key = self._stale.pop()
+            self._prune(key, self._versions[key])
+
+    def read_view(self, at: int|None = None) -> 'ReadView':
+        '''
+            Get a consistent view of the database as of the specified sequence
+            number (the newest one by default). The versions the view needs are
+            kept until it is closed, so close it once done.
+        '''
+
+        with self._lock:
+            seq = self._last_seq if at is None else at
+            self._check_seq(seq)
+            self._readers[seq] = self._readers.get(seq, 0) + 1
+
+        return ReadView(self, seq)
+
+    def _close_view(self, seq: int):
+        with self._lock:
+            if self._readers[seq] > 1:
+                self._readers[seq] -= 1
+            else:
+                del self._readers[seq]
 
     def get_all(self) -> list[tuple[str, str]]:
         ''' Get a list of all key-value pairs '''
 
-        with self._lock:
-            return list(self._data.items())
+        with self.read_view() as view:
+            return list(view.items()) # type: ignore
+
+    def iter_items_unlocked(self) -> Iterator[tuple[str, str]]:
+        '''
+            Iterate over the newest version of all key-value pairs without taking the lock.
+            Only safe if nobody modifies the database meanwhile, e.g.,
+            in a forked child process.
+        '''
+
+        if self._base is not None:
+            for key, value in self._base.items():
+                if key not in self._versions:
+                    yield key, value # type: ignore
+
+        for key, versions in self._versions.items():
+            yield key, versions[-1][1] # type: ignore
+
+class ReadView:
+    '''
+        The database as of one sequence number. Reads do not take the database's
+        lock and do not see updates that happen meanwhile.
+    '''
+
+    def __init__(self, database: Database, seq: int):
+        self._database = database
+        self._seq = seq
+        self._closed = False
+
+    @property
+    def seq(self) -> int:
+        ''' The sequence number of the newest update this view sees '''
+        return self._seq
+
+    def get(self, key: str):
+        ''' Get the value of a key as of this view (None if it did not exist) '''
+        return self._database._value_at(key, self._seq) #pylint: disable=protected-access
+
+    def get_many(self, keys: Iterable[str]) -> dict:
+        ''' Get the values of multiple keys, all as of this view '''
+        return {key: self.get(key) for key in keys}
+
+    def items(self, prefix: str = "") -> Iterator[tuple[str, object]]:
+        '''
+            Iterate over all entries (whose key starts with prefix) as of this view.
+            Updates can happen between two steps; the entries they create are too new
+            to be part of the view, so iterating over a copy of the keys is enough.
+        '''
+
+        keys = list(self._database._versions) #pylint: disable=protected-access
+        base = self._database._base #pylint: disable=protected-access
+
+        if base is not None:
+            copied = set(keys)
+            for key, value in base.items():
+                if key.startswith(prefix) and key not in copied:
+                    yield key, value
+
+        for key in keys:
+            if key.startswith(prefix):
+                value = self.get(key)
+                if value is not None:
+                    yield key, value
+
+    def close(self):
+        ''' Release the versions this view needs '''
+
+        if not self._closed:
+            self._closed = True
+            self._database._close_view(self._seq) #pylint: disable=protected-access
+
+    def __enter__(self) -> 'ReadView':
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
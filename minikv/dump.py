@@ -0,0 +1,261 @@
+'''
+File formats for bulk loading and exporting entries.
+
+  ndjson  one {"key": ..., "value": ...} object per line
+  csv     key,value rows without a header; values are strings (others are written as JSON)
+  binary  a header (magic), then blocks of records, then an empty block:
+            block:  number of records, length in bytes (both 32-bit little-endian)
+            record: key length, value length, key, value (JSON)
+
+All formats can be split into chunks that are parsed independently, so a
+loader can spread the parsing of a large file over multiple processes.
+Text formats are split at line breaks, so CSV fields must not contain any.
+'''
+
+import os
+import io
+import csv
+import json
+import struct
+import asyncio
+
+from typing import AsyncIterator, BinaryIO, Iterable, Iterator
+
+FORMATS = ["ndjson", "csv", "binary"]
+
+CONTENT_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "binary": "application/octet-stream",
+}
+
+MAGIC = b"MKVDUMP1"
+
+_BLOCK = struct.Struct("<II")
+_RECORD = struct.Struct("<II")
+
+# How many records the binary format puts into one block
+_BLOCK_RECORDS = 1024
+
+class DumpError(Exception):
+    ''' A dump is malformed or could not be written '''
+
+def guess_format(path: str) -> str:
+    ''' Pick the format from a file's extension (NDJSON if unknown) '''
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        return "csv"
+    if ext in (".bin", ".dump"):
+        return "binary"
+    return "ndjson"
+
+def _encode_block(records: list[bytes]) -> bytes:
+    body = b''.join(records)
+    return _BLOCK.pack(len(records), len(body)) + body
+
+def encode(items: Iterable[tuple[str, object]], fmt: str) -> Iterator[bytes]:
+    ''' Serialize entries in the specified format; yields reasonably large pieces '''
+
+    if fmt == "binary":
+        yield MAGIC
+        records = []
+        for key, value in items:
+            key_bytes = key.encode('utf-8')
+            value_bytes = json.dumps(value).encode('utf-8')
+            records.append(_RECORD.pack(len(key_bytes), len(value_bytes))
+                           + key_bytes + value_bytes)
+
+            if len(records) >= _BLOCK_RECORDS:
+                yield _encode_block(records)
+                records = []
+
+        if len(records) > 0:
+            yield _encode_block(records)
+        yield _BLOCK.pack(0, 0)
+
+    elif fmt == "csv":
+        for batch in _batched(items, _BLOCK_RECORDS):
+            out = io.StringIO()
+            writer = csv.writer(out, lineterminator="\n")
+            writer.writerows((key, value if isinstance(value, str) else json.dumps(value))
+                             for key, value in batch)
+            yield out.getvalue().encode('utf-8')
+
+    elif fmt == "ndjson":
+        for batch in _batched(items, _BLOCK_RECORDS):
+            yield ''.join(json.dumps({"key": key, "value": value}) + "\n"
+                          for key, value in batch).encode('utf-8')
+
+    else:
+        raise DumpError(f"Unknown format: {fmt}")
+
+def _batched(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def split(ifile: BinaryIO, fmt: str, chunk_size: int) -> Iterator[bytes]:
+    '''
+        Cut a dump into chunks of about chunk_size bytes that can be parsed
+        on their own (without the header of the binary format)
+    '''
+
+    if fmt == "binary":
+        if ifile.read(len(MAGIC)) != MAGIC:
+            raise DumpError("Not a binary MiniKV dump")
+
+        chunk = []
+        chunk_len = 0
+        while True:
+            header = ifile.read(_BLOCK.size)
+            if len(header) < _BLOCK.size:
+                raise DumpError("Binary dump is truncated")
+
+            count, length = _BLOCK.unpack(header)
+            if count == 0:
+                break
+
+            body = ifile.read(length)
+            if len(body) < length:
+                raise DumpError("Binary dump is truncated")
+
+            chunk += [header, body]
+            chunk_len += len(header) + length
+            if chunk_len >= chunk_size:
+                yield b''.join(chunk)
+                chunk, chunk_len = [], 0
+
+        if chunk_len > 0:
+            yield b''.join(chunk)
+        return
+
+    rest = b''
+    while True:
+        data = ifile.read(chunk_size)
+        if len(data) == 0:
+            break
+
+        data = rest + data
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            rest = data
+            continue
+
+        rest = data[end:]
+        yield data[:end]
+
+    if len(rest.strip()) > 0:
+        yield rest + b"\n"
+
+def _parse_ndjson(chunk: bytes) -> list[list]:
+    lines = [line for line in chunk.splitlines() if line.strip()]
+    entries = json.loads(b"[" + b",".join(lines) + b"]")
+
+    try:
+        return [[entry["key"], entry["value"]] for entry in entries]
+    except (KeyError, TypeError) as err:
+        raise DumpError(f"Every line needs an object with a key and a value ({err!r})") from err
+
+def parse(chunk: bytes, fmt: str) -> list[list]:
+    ''' Parse a chunk produced by split into a list of [key, value] pairs '''
+
+    if fmt == "binary":
+        keys = []
+        values = []
+        offset = 0
+        while offset < len(chunk):
+            count, length = _BLOCK.unpack_from(chunk, offset)
+            offset += _BLOCK.size
+            end = offset + length
+
+            for _ in range(count):
+                key_len, value_len = _RECORD.unpack_from(chunk, offset)
+                start = offset + _RECORD.size
+                keys.append(chunk[start:start+key_len].decode('utf-8'))
+                values.append(chunk[start+key_len:start+key_len+value_len])
+                offset = start + key_len + value_len
+
+            if offset != end:
+                raise DumpError("Malformed block in binary dump")
+
+        # Decoding all values in one go is much faster than one at a time
+        return [list(item) for item in zip(keys, json.loads(b"[" + b",".join(values) + b"]"))]
+
+    if fmt == "csv":
+        items = []
+        for row in csv.reader(io.StringIO(chunk.decode('utf-8'))):
+            if len(row) == 0:
+                continue
+            if len(row) != 2:
+                raise DumpError(f"Expected a key and a value, but got {row}")
+            items.append(row)
+        return items
+
+    if fmt == "ndjson":
+        return _parse_ndjson(chunk)
+
+    raise DumpError(f"Unknown format: {fmt}")
+
+def check_batch(items) -> list[list]:
+    ''' Make sure a batch that is about to be loaded is a list of [key, value] pairs '''
+
+    if not isinstance(items, list) or \
+            not all(isinstance(item, list) and len(item) == 2 and isinstance(item[0], str)
+                    for item in items):
+        raise ValueError("Expected a list of [key, value] pairs")
+    return items
+
+async def fork_export(database, fmt: str, read_size: int = 64*1024) -> AsyncIterator[bytes]:
+    '''
+        Stream all entries of the database in the specified format.
+
+        Like snapshots, a forked child serializes its copy-on-write view of the
+        database, so the export is consistent, nothing is materialized up front,
+        and the node keeps serving requests in the meantime. The child writes
+        into a pipe, which we forward as it fills.
+    '''
+
+    if fmt not in FORMATS:
+        raise DumpError(f"Unknown format: {fmt}")
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+
+    if pid == 0:
+        # Child: never return into the event loop of the parent
+        os.close(read_fd)
+        try:
+            with open(write_fd, 'wb', buffering=read_size) as ofile:
+                for piece in encode(database.iter_items_unlocked(), fmt):
+                    ofile.write(piece)
+            os._exit(0)
+        except BaseException: #pylint: disable=broad-exception-caught
+            os._exit(1)
+
+    os.close(write_fd)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=read_size)
+    # The transport owns the pipe and closes it
+    pipe = open(read_fd, 'rb', buffering=0) #pylint: disable=consider-using-with
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), pipe)
+
+    try:
+        while True:
+            data = await reader.read(read_size)
+            if len(data) == 0:
+                break
+            yield data
+    finally:
+        # If we stop early, the child fails to write to the closed pipe and exits
+        transport.close()
+        _, status = await loop.run_in_executor(None, os.waitpid, pid, 0)
+
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise DumpError(f"Export process failed with status {status}")
@@ -0,0 +1,184 @@
+'''
+Detects hot keys with fixed-size streaming sketches.
+
+Counts decay exponentially over time. Instead of periodically shrinking every
+counter, each access is weighted by 2^(t/half_life) ("forward decay"), and
+counts are divided by the current weight when they are read. When the weights
+grow too large, all counters are rescaled once, which is rare enough not to
+matter on the hot path.
+'''
+
+import heapq
+
+from time import monotonic
+
+from .constants import (HOTKEY_SKETCH_WIDTH, HOTKEY_SKETCH_DEPTH, HOTKEY_TOP_K,
+                        HOTKEY_HALF_LIFE)
+
+class CountMinSketch:
+    '''
+        Estimates how often each key was seen, never underestimating.
+        Uses width*depth counters, no matter how many distinct keys there are.
+        Each row is indexed by a different 16-bit slice of the key's (64-bit) hash,
+        so a single hash computation serves all rows.
+    '''
+
+    def __init__(self, width: int = HOTKEY_SKETCH_WIDTH, depth: int = HOTKEY_SKETCH_DEPTH):
+        assert 0 < width <= (1 << 16) and width & (width - 1) == 0, \
+            "width has to be a power of two of at most 2^16"
+        assert 0 < depth <= 4, "depth can be at most 4"
+
+        self._mask = width - 1
+        self._rows = [(row * width, row * 16) for row in range(depth)]
+        self._counters = [0.0] * (width * depth)
+
+    def _slots(self, key: str) -> list[int]:
+        hashed = hash(key)
+        mask = self._mask
+        return [offset + ((hashed >> shift) & mask) for offset, shift in self._rows]
+
+    def add(self, key: str, weight: float) -> float:
+        ''' Count the key and return its new estimate (conservative update) '''
+
+        counters = self._counters
+        slots = self._slots(key)
+        estimate = min(counters[slot] for slot in slots) + weight
+
+        # Only raise counters that are below the new estimate, which reduces overcounting
+        for slot in slots:
+            if counters[slot] < estimate:
+                counters[slot] = estimate
+
+        return estimate
+
+    def estimate(self, key: str) -> float:
+        ''' How often the key was seen (at least) '''
+        return min(self._counters[slot] for slot in self._slots(key))
+
+    def scale(self, factor: float):
+        ''' Multiply all counters by factor '''
+        self._counters = [count * factor for count in self._counters]
+
+class HeavyHitters:
+    '''
+        Finds the most frequent keys of a stream (Space-Saving).
+
+        At most top_k keys are tracked. A new key only replaces the least
+        frequent tracked one if the sketch estimates it to be more frequent.
+        The least frequent key is found with a min-heap that holds one entry
+        per tracked key. Counts only grow, so entries are allowed to lag behind
+        and are only corrected when they reach the top, which keeps every
+        update at O(log top_k) (amortized). Each tracked key also records
+        the count it took over from the key it replaced, which bounds its
+        overestimate.
+    '''
+
+    def __init__(self, top_k: int = HOTKEY_TOP_K, width: int = HOTKEY_SKETCH_WIDTH,
+            depth: int = HOTKEY_SKETCH_DEPTH):
+        assert top_k > 0
+
+        self._top_k = top_k
+        self._sketch = CountMinSketch(width, depth)
+        # key -> [count, error]
+        self._tracked: dict[str, list[float]] = {}
+        # (count, key) for every tracked key; each count is a lower bound of the key's count
+        self._heap: list[tuple[float, str]] = []
+
+    def _coldest(self) -> tuple[str, float]:
+        ''' The least frequent tracked key and its count '''
+
+        heap = self._heap
+        while True:
+            count, key = heap[0]
+            current = self._tracked[key][0]
+            if current <= count:
+                return key, count
+            heapq.heapreplace(heap, (current, key))
+
+    def add(self, key: str, weight: float):
+        ''' Count an access to the key '''
+
+        estimate = self._sketch.add(key, weight)
+        entry = self._tracked.get(key)
+
+        if entry is not None:
+            entry[0] += weight
+        elif len(self._tracked) < self._top_k:
+            self._tracked[key] = [estimate, 0.0]
+            heapq.heappush(self._heap, (estimate, key))
+        elif estimate > self._heap[0][0]:
+            coldest, lowest = self._coldest()
+
+            if estimate > lowest:
+                del self._tracked[coldest]
+                self._tracked[key] = [estimate, lowest]
+                heapq.heapreplace(self._heap, (estimate, key))
+
+    def top(self, limit: int) -> list[tuple[str, float, float]]:
+        ''' The most frequent keys with their counts and maximum overestimate '''
+
+        ordered = sorted(self._tracked.items(), key=lambda item: item[1][0], reverse=True)
+        return [(key, count, error) for key, (count, error) in ordered[:limit]]
+
+    def scale(self, factor: float):
+        ''' Multiply all counts by factor '''
+
+        self._sketch.scale(factor)
+        for entry in self._tracked.values():
+            entry[0] *= factor
+            entry[1] *= factor
+        # Scaling by a positive factor keeps the order, and thus the heap, intact
+        self._heap = [(count * factor, key) for count, key in self._heap]
+
+class HotKeys:
+    ''' Tracks the most read and most written keys of a node, with time-decayed counts '''
+
+    # Rescale all counts once weights exceed this (about 2^40)
+    MAX_WEIGHT = float(1 << 40)
+
+    def __init__(self, half_life: float = HOTKEY_HALF_LIFE, top_k: int = HOTKEY_TOP_K,
+            width: int = HOTKEY_SKETCH_WIDTH, depth: int = HOTKEY_SKETCH_DEPTH):
+        assert half_life > 0.0
+
+        self._half_life = half_life
+        self._rate = 1.0 / half_life
+        self._reads = HeavyHitters(top_k, width, depth)
+        self._writes = HeavyHitters(top_k, width, depth)
+        self._landmark = monotonic()
+
+    @property
+    def half_life(self) -> float:
+        ''' After how many seconds an access counts half as much '''
+        return self._half_life
+
+    def _weight(self) -> float:
+        weight = 2.0 ** ((monotonic() - self._landmark) * self._rate)
+
+        if weight > self.MAX_WEIGHT:
+            # Move the landmark to now, so weights start over at 1
+            for hitters in (self._reads, self._writes):
+                hitters.scale(1.0 / weight)
+            self._landmark = monotonic()
+            weight = 1.0
+
+        return weight
+
+    def record_read(self, key: str):
+        ''' Count a read of the key '''
+        self._reads.add(key, self._weight())
+
+    def record_write(self, key: str):
+        ''' Count a write to the key '''
+        self._writes.add(key, self._weight())
+
+    def report(self, limit: int = HOTKEY_TOP_K) -> dict:
+        ''' The hottest keys for reads and writes with their decayed counts '''
+
+        weight = self._weight()
+
+        def entries(hitters: HeavyHitters):
+            return [{"key": key, "count": count / weight, "max_error": error / weight}
+                    for key, count, error in hitters.top(limit)]
+
+        return {"half_life": self._half_life,
+                "reads": entries(self._reads), "writes": entries(self._writes)}
@@ -0,0 +1,105 @@
+''' Read leases, which let clients cache values for a bounded amount of time '''
+
+from time import monotonic
+from typing import Iterable
+
+from .constants import LEASE_DURATION
+
+class LeaseManager:
+    '''
+        Tracks which clients hold leases on which keys.
+
+        A holder may serve a key from its cache until the lease expires.
+        Leases are only granted to holders that are connected to receive
+        invalidations, so a committed update reaches their cache early;
+        if an invalidation gets lost, the cached value still expires
+        at the end of the lease.
+    '''
+
+    # Drop expired leases of a holder once it has this many
+    PURGE_THRESHOLD = 1024
+
+    def __init__(self, duration: float = LEASE_DURATION):
+        assert duration >= 0.0
+
+        self._duration = duration
+        self._holders: dict[str, dict[str, float]] = {}
+        self._purge_at: dict[str, int] = {}
+        # How many invalidation streams each holder has open (e.g., while reconnecting)
+        self._streams: dict[str, int] = {}
+
+    @property
+    def duration(self) -> float:
+        ''' How many seconds each lease lasts '''
+        return self._duration
+
+    def connect(self, holder: str):
+        ''' A holder opened a stream to listen for invalidations '''
+
+        if holder in self._streams:
+            self._streams[holder] += 1
+            return
+
+        self._streams[holder] = 1
+        self._holders[holder] = {}
+        self._purge_at[holder] = self.PURGE_THRESHOLD
+
+    def disconnect(self, holder: str):
+        '''
+            A holder closed one of its streams. Once it closed all of them,
+            it must not rely on its leases anymore.
+        '''
+
+        if self._streams.get(holder, 0) > 1:
+            self._streams[holder] -= 1
+            return
+
+        self._streams.pop(holder, None)
+        self._holders.pop(holder, None)
+        self._purge_at.pop(holder, None)
+
+    def num_leases(self) -> int:
+        ''' How many (possibly expired) leases are tracked across all holders '''
+        return sum(len(leases) for leases in self._holders.values())
+
+    def grant(self, holder: str|None, key: str) -> float:
+        ''' Grant a lease on the key and return its duration (0 if none was granted) '''
+
+        leases = self._holders.get(holder) if holder is not None else None
+        if leases is None or self._duration == 0.0:
+            return 0.0
+
+        now = monotonic()
+        leases[key] = now + self._duration
+
+        if len(leases) >= self._purge_at[holder]: # type: ignore
+            for expired in [k for k, expiry in leases.items() if expiry <= now]:
+                del leases[expired]
+            self._purge_at[holder] = max(self.PURGE_THRESHOLD, 2 * len(leases)) # type: ignore
+
+        return self._duration
+
+    def revoke(self, holder: str, keys: Iterable[str]) -> list[str]:
+        '''
+            The specified keys were updated.
+            Returns those the holder has a live lease on and needs to invalidate.
+        '''
+
+        leases = self._holders.get(holder)
+        if leases is None:
+            return []
+
+        now = monotonic()
+
+        # Every stream of the holder has to send the invalidation, so only the
+        # last one could drop the lease; expired leases get purged anyway
+        if self._streams[holder] > 1:
+            return [key for key in keys if leases.get(key, 0.0) > now]
+
+        revoked = []
+        for key in keys:
+            expiry = leases.pop(key, None)
+            if expiry is not None and expiry > now:
+                revoked.append(key)
+
+        return revoked
@@ -5,3 +5,4 @@ and have the talk to each other.
 
 from .connector import Connector
 from .connection import Connection
+from .shaping import NetworkShape, LinkShape
@@ -7,9 +7,13 @@ import asyncio
 import logging
 import struct
 
+from time import monotonic_ns
 from asyncio.streams import StreamReader, StreamWriter
 from asyncio import Lock
 
+from .dispatch import Dispatcher
+from ..constants import DISPATCH_LANES
+
 class Connection:
     ''' Manages the connection to another node '''
 
@@ -21,7 +25,8 @@ class Connection:
             port: int,
             message_type: type,
             protocol_logic,
-            in_data: bytes):
+            in_data: bytes,
+            dispatch_lanes: int = DISPATCH_LANES):
 
         self._identifier = identifier  # Make sure the ID is a string
         self._host = host
@@ -31,6 +36,8 @@ class Connection:
         self._reader = reader
         self._writer = writer
         self._send_lock = Lock()
+        self._received_at = monotonic_ns()
+        self._dispatcher = Dispatcher(self, protocol_logic, dispatch_lanes)
 
         self._receive_task = asyncio.create_task(self._receive_loop(in_data))
 
@@ -49,30 +56,29 @@ class Connection:
         ''' The unqiue identifier of the connected peer '''
         return self._identifier
 
+    @property
+    def received_at(self) -> int:
+        '''
+            Monotonic time (in ns) the message whose handler started last arrived.
+            Handlers have to read this before they first await.
+        '''
+        return self._received_at
+
+    def set_received_at(self, received_at: int):
+        ''' Called by the dispatcher right before it invokes a handler '''
+        self._received_at = received_at
+
     async def _receive_loop(self, in_data: bytes):
         """
            This will check for new data from the connected peer,
            until it disconnects.
         """
         buffer = in_data  # Hold the stream that comes in!
+        received_at = monotonic_ns()
+        header_len = struct.calcsize("IH")
 
-        while not self._reader.at_eof():
-            chunk = b''
-
-            #try:
-            chunk = await self._reader.read(4096)
-            #except Exception as err:
-            #    logging.error(f'Unexpected connection error: {err}')
-            #    break
-
-            if len(chunk) == 0:
-                break
-
-            logging.debug("Got data of length %i", len(chunk))
-
-            buffer += chunk
-            header_len = struct.calcsize("IH")
-
+        while True:
+            # The handshake may already have read the first messages, so parse before reading
             while len(buffer) >= header_len:
                 header = struct.unpack("IH", buffer[:header_len])
                 msg_len = header[0]
@@ -85,8 +91,6 @@ class Connection:
 
                 total_len = header_len+msg_len
 
-                assert total_len <= len(buffer)
-
                 if msg_len > 0:
                     if len(buffer) < total_len:
                         # Did not receive full message yet...
@@ -98,11 +102,32 @@ class Connection:
 
                     msg = pickle.loads(msg)
 
-                    await self._protocol_logic.handle_message(self, msg_type, msg)
+                    await self._dispatcher.dispatch(msg_type, msg, received_at)
                 else:
                     buffer = buffer[header_len:]
-                    await self._protocol_logic.handle_message(self, msg_type, None)
+                    await self._dispatcher.dispatch(msg_type, None, received_at)
+
+            if self._reader.at_eof():
+                break
+
+            #try:
+            chunk = await self._reader.read(4096)
+            #except Exception as err:
+            #    logging.error(f'Unexpected connection error: {err}')
+            #    break
+
+            if len(chunk) == 0:
+                break
+
+            received_at = monotonic_ns()
+
+            logging.debug("Got data of length %i", len(chunk))
+
+            buffer += chunk
 
+        # Handle what the peer sent before it left, unless a handler is stuck
+        await self._dispatcher.flush()
+        self._dispatcher.cancel()
         await self._protocol_logic.handle_disconnect(self)
         logging.debug("Connection to peer closed")
 
@@ -112,6 +137,7 @@ class Connection:
         try:
             self._writer.close()
             self._receive_task.cancel()
+            self._dispatcher.cancel()
             await self._writer.wait_closed()
         except (ConnectionResetError, BrokenPipeError):
             pass
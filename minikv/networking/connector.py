@@ -1,7 +1,9 @@
 ''' All connector-related code resides here '''
 
-#pylint: disable=too-many-arguments,too-many-positional-arguments
+#pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-instance-attributes
 
+import os
+import errno
 import asyncio
 import struct
 import logging
@@ -9,6 +11,10 @@ import logging
 from asyncio.streams import StreamReader, StreamWriter
 
 from .connection import Connection
+from .transport import (TRANSPORTS, unix_socket_path, open_stream, create_ring_pair,
+                        is_ring_path, ShmRing, open_shm_streams)
+from .shaping import NetworkShape
+from ..constants import DISPATCH_LANES, PEER_TRANSPORT
 
 class Connector:
     '''
@@ -21,15 +27,28 @@ class Connector:
             port: int,
             message_type,
             protocol_logic,
+            dispatch_lanes: int = DISPATCH_LANES,
+            transport: str = PEER_TRANSPORT,
+            shaping: NetworkShape|None = None,
         ):
-        ''' Creates the connector and starts listening at the specified port '''
+        '''
+            Creates the connector and starts listening at the specified port.
+            The transport ("tcp", "unix", "shm", or "auto") decides how we reach
+            peers; other than with "tcp", we also accept peers on a Unix domain socket.
+            With shaping, what we send to peers is slowed down like on a real network.
+        '''
+        assert transport in TRANSPORTS
 
         self._identifier = identifier
         self._hostname = hostname
         self._port = port
         self._message_type = message_type
         self._protocol_logic = protocol_logic
+        self._dispatch_lanes = dispatch_lanes
+        self._transport = transport
+        self._shaping = shaping
         self._tcp_server = None
+        self._unix_server = None
         self._peers: dict[str, Connection] = {}
 
     @property
@@ -52,34 +71,117 @@ class Connector:
 
         assert self._tcp_server is None
 
-        self._tcp_server = await asyncio.start_server(self._handle_connection,
-                                                 port=self.port,
-                                                 reuse_port=True,
-                                                 reuse_address=True)
+        # Fail before listening on TCP if another node owns our socket
+        path = unix_socket_path(self.port)
+        if self._transport != "tcp" and os.path.exists(path):
+            await self._remove_stale_socket(path)
+
+        self._tcp_server = await asyncio.start_server(
+                lambda reader, writer: self._handle_connection(reader, writer, False),
+                port=self.port, reuse_port=True, reuse_address=True)
+
+        if self._transport != "tcp":
+            # Only peers on this host can reach the socket, so only they may use shared memory
+            self._unix_server = await asyncio.start_unix_server(
+                lambda reader, writer: self._handle_connection(reader, writer,
+                                                               self._transport == "shm"),
+                path=path)
+
+    @staticmethod
+    async def _remove_stale_socket(path: str):
+        '''
+            Like reuse_address, take over a socket left behind by an earlier run,
+            but not one a running node still listens on
+        '''
+
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            return
+
+        writer.close()
+        raise OSError(errno.EADDRINUSE, f"Another node is listening on {path}")
+
+    async def stop(self):
+        ''' Stop listening and disconnect from all peers '''
+
+        for server in (self._tcp_server, self._unix_server):
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+        self._tcp_server = None
+
+        if self._unix_server is not None:
+            self._unix_server = None
+            try:
+                os.unlink(unix_socket_path(self.port))
+            except FileNotFoundError:
+                pass
+
+        for peer in self._peers.values():
+            await peer.disconnect()
+        self._peers.clear()
 
     async def _handle_connection(self,
             reader: StreamReader,
-            writer: StreamWriter):
+            writer: StreamWriter,
+            allow_shm: bool):
         logging.info("Got new incoming connection")
 
         await self._send_identifier(writer)
-        peer_id, hostname, port, in_data = await self._receive_identifier(reader)
+        peer_id, hostname, port, upgrade, in_data = await self._receive_identifier(reader)
 
         # Cannot connect with yourself
         assert self.identifier != peer_id
 
+        if upgrade.startswith("shm="):
+            # The peer created the rings; its outgoing ring is our incoming one
+            paths = upgrade[len("shm="):].split(",")
+            if not allow_shm or len(paths) != 2 or not all(is_ring_path(p) for p in paths):
+                logging.warning("Rejected shared memory connection from node #%s", peer_id)
+                writer.close()
+                return
+
+            try:
+                in_ring, out_ring = ShmRing(paths[0], False), ShmRing(paths[1], False)
+            except (OSError, ValueError) as err:
+                logging.warning("Could not open the rings of node #%s: %s", peer_id, err)
+                writer.close()
+                return
+
+            in_ring.unlink()
+            out_ring.unlink()
+
+            # Anything else the peer sent over the socket is just a wake-up
+            reader, writer = open_shm_streams(out_ring, in_ring, reader, writer)
+            in_data = b''
+            logging.info("Using shared memory for connection from node #%s", peer_id)
+
         # Check for duplicate connections
         if peer_id in self._peers:
             logging.warning("Node with id=%s is already connected to us", peer_id)
             writer.close()
         else:
+            writer = self._shape(writer, peer_id)
             peer = Connection(int(peer_id), reader, writer, hostname, port,
-                        self._message_type, self._protocol_logic, in_data)
+                        self._message_type, self._protocol_logic, in_data,
+                        self._dispatch_lanes)
             self._peers[peer_id] = peer
             await self._protocol_logic.handle_incoming_connection(peer)
 
-    async def _send_identifier(self, writer):
+    def _shape(self, writer, peer_id: str):
+        if self._shaping is None:
+            return writer
+        return self._shaping.wrap(writer, self.identifier, int(peer_id))
+
+    async def _send_identifier(self, writer, upgrade: str = ""):
         msg = f"{self.identifier}:{self.hostname}:{self.port}"
+        if upgrade:
+            msg += f":{upgrade}"
 
         header = struct.pack("I", len(msg))
         writer.write(header)
@@ -87,21 +189,27 @@ class Connector:
 
         await writer.drain()
 
-    async def _receive_identifier(self, reader) -> tuple[str, str, int, bytes]:
+    async def _receive_identifier(self, reader) -> tuple[str, str, int, str, bytes]:
         in_data = b''
+        header_len = struct.calcsize("I")
 
         while True:
-            in_data += await reader.read(4096)
-            header_len = struct.calcsize("I")
+            chunk = await reader.read(4096)
+            if len(chunk) == 0:
+                raise ConnectionError("Peer disconnected during the handshake")
+            in_data += chunk
+
+            if len(in_data) < header_len:
+                continue
 
-            if len(in_data) >= header_len:
-                header = struct.unpack("I", in_data[:header_len])
-                msg_len = header[0]
-                total_len = header_len+msg_len
+            msg_len = struct.unpack("I", in_data[:header_len])[0]
+            total_len = header_len+msg_len
 
             if len(in_data) >= total_len:
-                identifier, host, port = in_data[header_len:total_len].decode('utf-8').split(':')
-                return identifier, host, int(port), in_data[total_len:]
+                fields = in_data[header_len:total_len].decode('utf-8').split(':', 3)
+                identifier, host, port = fields[:3]
+                upgrade = fields[3] if len(fields) > 3 else ""
+                return identifier, host, int(port), upgrade, in_data[total_len:]
 
     async def connect_to_peer(self, hostname: str, port: int) -> None|Connection:
         """ 
@@ -113,10 +221,15 @@ class Connector:
             return None
 
         #try:
-        reader, writer = await asyncio.open_connection(hostname, port)
-        await self._send_identifier(writer)
+        reader, writer, transport = await open_stream(hostname, port, self._transport)
+
+        if self._transport == "shm" and transport == "unix":
+            out_ring, in_ring = create_ring_pair()
+            await self._send_identifier(writer, f"shm={out_ring.path},{in_ring.path}")
+        else:
+            await self._send_identifier(writer)
 
-        peer_id, hostname, port, in_data = await self._receive_identifier(reader)
+        peer_id, hostname, port, _, in_data = await self._receive_identifier(reader)
 
         # Cannot connect with yourself
         assert self.identifier != peer_id
@@ -124,10 +237,21 @@ class Connector:
         # Check for duplicate connections
         if peer_id in self._peers:
             logging.error("Already connected to node with id=%s", peer_id)
+            if self._transport == "shm" and transport == "unix":
+                out_ring.unlink()
+                in_ring.unlink()
             return self._peers[peer_id]
 
+        if self._transport == "shm" and transport == "unix":
+            reader, writer = open_shm_streams(out_ring, in_ring, reader, writer)
+            in_data = b''
+            transport = "shm"
+
+        logging.info("Connected to node #%s using %s", peer_id, transport)
+
+        writer = self._shape(writer, peer_id)
         peer = Connection(int(peer_id), reader, writer, hostname, port,
-                self._message_type, self._protocol_logic, in_data)
+                self._message_type, self._protocol_logic, in_data, self._dispatch_lanes)
         self._peers[peer_id] = peer
 
         return peer
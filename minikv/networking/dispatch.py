@@ -0,0 +1,78 @@
+''' Decouples reading from a connection from handling the messages read from it '''
+
+import asyncio
+import logging
+
+from ..constants import DISPATCH_QUEUE_SIZE, DISPATCH_FLUSH_TIMEOUT
+
+class Dispatcher:
+    '''
+        Hands incoming messages to the protocol logic without stalling the socket reader.
+
+        Messages are spread over a fixed number of lanes by their ordering key.
+        Each lane has a bounded queue that is drained by its own task, so messages
+        with the same key are handled in order, while unrelated messages proceed
+        even if one handler is blocked (e.g., sending to a slow peer).
+
+        The protocol logic can declare the key by implementing
+        `ordering_key(msg_type, message)`; without it all messages share one lane.
+        With zero lanes, messages are handled inline by the reader.
+    '''
+
+    def __init__(self, connection, protocol_logic, num_lanes: int,
+            queue_size: int = DISPATCH_QUEUE_SIZE):
+        assert num_lanes >= 0
+
+        self._connection = connection
+        self._protocol_logic = protocol_logic
+        self._ordering_key = getattr(protocol_logic, "ordering_key", None)
+        self._queues: list[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size)
+                                             for _ in range(num_lanes)]
+        self._tasks = [asyncio.create_task(self._drain(queue)) for queue in self._queues]
+
+    async def dispatch(self, msg_type, message, received_at: int):
+        '''
+            Queue a message, which arrived at the specified monotonic time, for its handler.
+            Only blocks if the lane of the message is full.
+        '''
+
+        if len(self._queues) == 0:
+            await self._handle(msg_type, message, received_at)
+            return
+
+        if self._ordering_key is None or len(self._queues) == 1:
+            lane = 0
+        else:
+            lane = hash(self._ordering_key(msg_type, message)) % len(self._queues)
+
+        await self._queues[lane].put((msg_type, message, received_at))
+
+    async def _handle(self, msg_type, message, received_at: int):
+        # The handler reads this before its first await, so concurrent lanes do not interfere
+        self._connection.set_received_at(received_at)
+
+        try:
+            await self._protocol_logic.handle_message(self._connection, msg_type, message)
+        except Exception: #pylint: disable=broad-exception-caught
+            logging.exception("Failed to handle message of type %s", msg_type)
+
+    async def _drain(self, queue: asyncio.Queue):
+        while True:
+            msg_type, message, received_at = await queue.get()
+            await self._handle(msg_type, message, received_at)
+            queue.task_done()
+
+    async def flush(self, timeout: float|None = DISPATCH_FLUSH_TIMEOUT):
+        ''' Wait until all queued messages have been handled, or at most timeout seconds '''
+
+        joined = asyncio.gather(*[queue.join() for queue in self._queues])
+        try:
+            await asyncio.wait_for(joined, timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Message handlers are stuck; dropping %i queued messages",
+                            sum(queue.qsize() for queue in self._queues))
+
+    def cancel(self):
+        ''' Stop handling messages, dropping the ones that are still queued '''
+        for task in self._tasks:
+            task.cancel()
@@ -0,0 +1,284 @@
+'''
+Emulates slower networks between nodes, without root privileges or `tc`.
+
+A shape adds delay, jitter, a bandwidth limit, and batching to the bytes a node
+sends to a peer. Shapes apply to the sending side of a link, so each direction
+of a link can be configured separately.
+
+Shapes are written as `[SRC-DST:]option=value,...`, for example
+`delay=1ms,jitter=100us,bandwidth=1gbit` for every link or
+`0-1:delay=10ms` for the link from node 0 to node 1 (either end can be `*`).
+Options:
+  delay      one-way latency added to every byte (s, ms, or us; ms by default)
+  jitter     up to this much extra latency, drawn uniformly per write
+  bandwidth  the link's rate in bit/s (kbit, mbit, or gbit)
+  batch      writes within this window leave together, like with Nagle's
+             algorithm or interrupt coalescing
+'''
+
+#pylint: disable=too-many-instance-attributes
+
+import asyncio
+
+from random import Random
+from collections import deque
+
+from ..constants import SHAPING_BUFFER_SIZE
+
+_TIME_UNITS = {"us": 1e-6, "ms": 1e-3, "s": 1.0}
+_RATE_UNITS = {"kbit": 1e3, "mbit": 1e6, "gbit": 1e9, "bit": 1.0}
+
+def parse_duration(text: str) -> float:
+    ''' Parse a duration like "1.5ms" into seconds; plain numbers are milliseconds '''
+
+    for unit, scale in _TIME_UNITS.items():
+        if text.endswith(unit):
+            return float(text[:-len(unit)]) * scale
+    return float(text) * 1e-3
+
+def parse_rate(text: str) -> float:
+    ''' Parse a rate like "100mbit" into bytes per second; plain numbers are bit/s '''
+
+    for unit, scale in _RATE_UNITS.items():
+        if text.endswith(unit):
+            return float(text[:-len(unit)]) * scale / 8
+    return float(text) / 8
+
+class LinkShape:
+    ''' How the traffic on a link is slowed down '''
+
+    def __init__(self, delay: float = 0.0, jitter: float = 0.0, bandwidth: float = 0.0,
+            batch: float = 0.0):
+        '''
+            The delay, jitter, and batch window are in seconds,
+            the bandwidth in bytes per second (0 for no limit).
+        '''
+
+        assert delay >= 0.0 and jitter >= 0.0 and bandwidth >= 0.0 and batch >= 0.0
+
+        self._delay = delay
+        self._jitter = jitter
+        self._bandwidth = bandwidth
+        self._batch = batch
+
+    @classmethod
+    def parse(cls, options: str) -> 'LinkShape':
+        ''' Create a shape from a list of options like "delay=1ms,bandwidth=1gbit" '''
+
+        args: dict[str, float] = {}
+        for option in options.split(','):
+            name, _, value = option.strip().partition('=')
+            match name:
+                case "delay" | "jitter" | "batch":
+                    args[name] = parse_duration(value)
+                case "bandwidth":
+                    args[name] = parse_rate(value)
+                case _:
+                    raise ValueError(f"Unknown link shape option: {option}")
+
+        return cls(**args)
+
+    @property
+    def delay(self) -> float:
+        ''' One-way latency in seconds '''
+        return self._delay
+
+    @property
+    def jitter(self) -> float:
+        ''' Maximum extra latency in seconds '''
+        return self._jitter
+
+    @property
+    def bandwidth(self) -> float:
+        ''' Bytes per second (0 if unlimited) '''
+        return self._bandwidth
+
+    @property
+    def batch(self) -> float:
+        ''' Seconds that writes are held back to leave together '''
+        return self._batch
+
+    def __repr__(self) -> str:
+        return (f"LinkShape(delay={self._delay}, jitter={self._jitter}, "
+                f"bandwidth={self._bandwidth}, batch={self._batch})")
+
+class NetworkShape:
+    '''
+        The shapes of all links between nodes.
+        More specific specs win: "0-1:" over "0-*:" and "*-1:" over a default.
+    '''
+
+    def __init__(self, seed: int|None = None):
+        self._links: dict[tuple[int|None, int|None], LinkShape] = {}
+        self._rng = Random(seed)
+
+    @classmethod
+    def from_specs(cls, specs: list[str], seed: int|None = None) -> 'NetworkShape':
+        ''' Parse a list of specs (see the module documentation) '''
+
+        shape = cls(seed)
+        for spec in specs:
+            shape.add_spec(spec)
+        return shape
+
+    @classmethod
+    def load(cls, path: str, seed: int|None = None) -> 'NetworkShape':
+        ''' Read one spec per line from a file; empty lines and comments (#) are skipped '''
+
+        with open(path, encoding='utf-8') as ifile:
+            specs = [line.split('#', 1)[0].strip() for line in ifile]
+        return cls.from_specs([spec for spec in specs if spec], seed)
+
+    def add_spec(self, spec: str):
+        ''' Add a single spec; it replaces an earlier one for the same link '''
+
+        link, sep, options = spec.partition(':')
+        if not sep:
+            self.set_link(None, None, LinkShape.parse(link))
+            return
+
+        src, _, dst = link.partition('-')
+        if not dst:
+            raise ValueError(f"Expected SRC-DST before the colon in {spec}")
+
+        self.set_link(None if src == '*' else int(src), None if dst == '*' else int(dst),
+                      LinkShape.parse(options))
+
+    def set_link(self, src: int|None, dst: int|None, shape: LinkShape):
+        ''' Shape the traffic from src to dst; None matches any node '''
+        self._links[(src, dst)] = shape
+
+    def lookup(self, src: int, dst: int) -> LinkShape|None:
+        ''' Find the shape of the link from src to dst (None if it is not shaped) '''
+
+        for link in [(src, dst), (src, None), (None, dst), (None, None)]:
+            if link in self._links:
+                return self._links[link]
+        return None
+
+    def wrap(self, writer, src: int, dst: int):
+        ''' Shape what is written to the writer, if the link from src to dst has a shape '''
+
+        shape = self.lookup(src, dst)
+        if shape is None:
+            return writer
+        return ShapedStreamWriter(writer, shape, Random(self._rng.getrandbits(64)))
+
+class ShapedStreamWriter:
+    '''
+        Wraps a stream writer and holds back written data until the link would
+        have delivered it.
+
+        Each write is timestamped with when its last byte would arrive at the peer:
+        it leaves once the link finished sending earlier data (and its batch window
+        closed), takes size/bandwidth to send, and then travels for the delay plus
+        jitter. Data never overtakes earlier data, like on a TCP connection.
+        A background task hands everything that arrived to the real writer at once,
+        so the peer reads it in one go, just like a burst of packets.
+    '''
+
+    def __init__(self, writer, shape: LinkShape, rng: Random,
+            buffer_size: int = SHAPING_BUFFER_SIZE):
+        self._writer = writer
+        self._shape = shape
+        self._rng = rng
+        self._buffer_size = buffer_size
+
+        self._queue: deque[tuple[float, bytes]] = deque()
+        self._queued_bytes = 0
+        self._link_free_at = 0.0
+        self._batch_until = 0.0
+        self._last_arrival = 0.0
+        self._error: Exception|None = None
+
+        self._data_event = asyncio.Event()
+        self._space_event = asyncio.Event()
+        self._pump_task = asyncio.create_task(self._pump())
+
+    @property
+    def shape(self) -> LinkShape:
+        ''' How this writer shapes its traffic '''
+        return self._shape
+
+    def _arrival_time(self, size: int) -> float:
+        now = asyncio.get_running_loop().time()
+        shape = self._shape
+
+        depart = now
+        if shape.batch > 0.0:
+            if now >= self._batch_until:
+                self._batch_until = now + shape.batch
+            depart = self._batch_until
+
+        depart = max(depart, self._link_free_at)
+        if shape.bandwidth > 0.0:
+            depart += size / shape.bandwidth
+        self._link_free_at = depart
+
+        arrival = depart + shape.delay
+        if shape.jitter > 0.0:
+            arrival += self._rng.uniform(0.0, shape.jitter)
+
+        self._last_arrival = max(arrival, self._last_arrival)
+        return self._last_arrival
+
+    def write(self, data: bytes):
+        ''' Queue data; it reaches the underlying writer once the link delivered it '''
+
+        if len(data) == 0:
+            return
+
+        self._queue.append((self._arrival_time(len(data)), bytes(data)))
+        self._queued_bytes += len(data)
+        self._data_event.set()
+
+    async def drain(self):
+        ''' Wait until the link has room for more data, like a full socket buffer '''
+
+        while self._queued_bytes > self._buffer_size and self._error is None:
+            self._space_event.clear()
+            await self._space_event.wait()
+
+        if self._error is not None:
+            raise self._error
+
+    async def _pump(self):
+        loop = asyncio.get_running_loop()
+
+        try:
+            while True:
+                while len(self._queue) == 0:
+                    self._data_event.clear()
+                    await self._data_event.wait()
+
+                # The loop's timers are only as precise as epoll (about a millisecond);
+                # that inaccuracy simply adds to the jitter
+                deadline = self._queue[0][0]
+                remaining = deadline - loop.time()
+                if remaining > 0.0:
+                    await asyncio.sleep(remaining)
+
+                # The timer may fire a little early; the data is due nonetheless
+                now = max(loop.time(), deadline)
+                chunks = []
+                while len(self._queue) > 0 and self._queue[0][0] <= now:
+                    chunks.append(self._queue.popleft()[1])
+
+                data = b''.join(chunks)
+                self._queued_bytes -= len(data)
+                self._space_event.set()
+
+                self._writer.write(data)
+                await self._writer.drain()
+        except (ConnectionError, OSError) as err:
+            self._error = err
+            self._space_event.set()
+
+    def close(self):
+        ''' Close the connection; data the link has not delivered yet is lost '''
+        self._pump_task.cancel()
+        self._writer.close()
+
+    async def wait_closed(self):
+        ''' Wait until the underlying writer is closed '''
+        await self._writer.wait_closed()
@@ -0,0 +1,307 @@
+'''
+An in-memory network for running many nodes in one process.
+
+Simulated connectors and connections offer the same interface as
+`Connector` and `Connection`, but messages are handed over through the event
+loop after a delay drawn from a seeded random number generator. Together with
+`VirtualTimeLoop`, which skips ahead instead of sleeping, runs are fast and
+reproducible.
+'''
+
+#pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-instance-attributes
+#pylint: disable=duplicate-code
+#pylint: disable=protected-access
+
+import pickle
+import asyncio
+import logging
+import selectors
+
+from collections import deque
+from random import Random
+from time import monotonic_ns
+
+from .dispatch import Dispatcher
+from ..constants import DISPATCH_LANES
+
+class SimulationStalled(RuntimeError):
+    ''' Every task waits for something, but no message or timer is pending '''
+
+class _VirtualClockSelector(selectors.BaseSelector):
+    ''' Never reports I/O; "waiting" for a timeout just moves the loop's clock forward '''
+
+    def __init__(self, loop: 'VirtualTimeLoop'):
+        self._loop = loop
+        self._map: dict = {}
+
+    def register(self, fileobj, events, data=None):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        key = selectors.SelectorKey(fileobj, fd, events, data)
+        self._map[fileobj] = key
+        return key
+
+    def unregister(self, fileobj):
+        return self._map.pop(fileobj)
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise SimulationStalled("No task can make progress")
+        self._loop.advance(timeout)
+        return []
+
+    def get_map(self):
+        return self._map
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    '''
+        An event loop whose clock only moves when all tasks wait for a timer.
+        asyncio.sleep() and other timeouts then take no real time, and runs
+        do not depend on how fast the machine is. There must not be any real I/O.
+    '''
+
+    def __init__(self):
+        self._now = 0.0
+        super().__init__(selector=_VirtualClockSelector(self))
+
+    def time(self) -> float:
+        ''' The virtual time in seconds '''
+        return self._now
+
+    def advance(self, seconds: float):
+        ''' Move the clock forward '''
+        self._now += seconds
+
+class SimulatedNetwork:
+    '''
+        Connects simulated nodes with each other.
+
+        Every message is delayed by a random amount between min_delay and
+        max_delay. Links deliver in order, unless reorder > 0; then each
+        message may overtake earlier ones with that probability.
+    '''
+
+    def __init__(self, seed: int = 0, min_delay: float = 0.0, max_delay: float = 0.0,
+            reorder: float = 0.0):
+        assert 0.0 <= min_delay <= max_delay
+        assert 0.0 <= reorder <= 1.0
+
+        self._rng = Random(seed)
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._reorder = reorder
+        self._listeners: dict[int, 'SimulatedConnector'] = {}
+        self._num_messages = 0
+
+    @property
+    def num_messages(self) -> int:
+        ''' How many messages were sent so far '''
+        return self._num_messages
+
+    def connector(self, identifier: int, hostname: str, port: int, message_type,
+            protocol_logic, dispatch_lanes: int = DISPATCH_LANES,
+            transport: str|None = None, shaping=None) -> 'SimulatedConnector':
+        '''
+            Create a connector; has the same signature as the one of `Connector`.
+            The simulated network draws its own delays, so shaping is ignored.
+        '''
+        #pylint: disable=unused-argument
+        return SimulatedConnector(self, identifier, hostname, port, message_type,
+                                  protocol_logic, dispatch_lanes)
+
+    def delay(self) -> float:
+        ''' Draw how long the next message takes '''
+        return self._rng.uniform(self._min_delay, self._max_delay)
+
+    def overtakes(self) -> bool:
+        ''' Draw whether the next message may overtake earlier ones '''
+        return self._reorder > 0.0 and self._rng.random() < self._reorder
+
+    def count_message(self):
+        ''' Keep track of the number of messages '''
+        self._num_messages += 1
+
+    def listen(self, port: int, connector: 'SimulatedConnector'):
+        ''' Accept connections to the port '''
+        assert port not in self._listeners, f"Port {port} is already in use"
+        self._listeners[port] = connector
+
+    def unlisten(self, port: int):
+        ''' Stop accepting connections to the port '''
+        self._listeners.pop(port, None)
+
+    def lookup(self, port: int) -> 'SimulatedConnector':
+        ''' Who listens on this port? '''
+        if port not in self._listeners:
+            raise ConnectionRefusedError(f"Nobody listens on port {port}")
+        return self._listeners[port]
+
+class SimulatedConnection:
+    ''' One end of a simulated link; used like a `Connection` '''
+
+    def __init__(self, network: SimulatedNetwork, identifier: int, hostname: str, port: int,
+            message_type, protocol_logic, dispatch_lanes: int):
+        self._network = network
+        self._identifier = identifier
+        self._host = hostname
+        self._port = port
+        self._message_type = message_type
+        self._protocol_logic = protocol_logic
+        self._remote: SimulatedConnection|None = None
+        self._last_delivery = 0.0
+        self._received_at = monotonic_ns()
+        self._arrived: deque = deque()
+        self._arrival = asyncio.Event()
+        self._dispatcher = Dispatcher(self, protocol_logic, dispatch_lanes)
+        self._receive_task = asyncio.create_task(self._receive_loop())
+
+    def attach(self, remote: 'SimulatedConnection'):
+        ''' Connect this end to the other one '''
+        self._remote = remote
+
+    @property
+    def hostname(self) -> str:
+        ''' The hostname of the connected peer '''
+        return self._host
+
+    @property
+    def port(self) -> int:
+        ''' The port of the connected peer '''
+        return self._port
+
+    @property
+    def identifier(self) -> int:
+        ''' The unique identifier of the connected peer '''
+        return self._identifier
+
+    @property
+    def received_at(self) -> int:
+        ''' Monotonic time (in ns) the message whose handler started last arrived '''
+        return self._received_at
+
+    def set_received_at(self, received_at: int):
+        ''' Called by the dispatcher right before it invokes a handler '''
+        self._received_at = received_at
+
+    def _arrive(self, item):
+        self._arrived.append(item)
+        self._arrival.set()
+
+    async def _receive_loop(self):
+        # Like a socket reader, handle everything that arrived since we last woke up
+        closed = False
+        while not closed:
+            await self._arrival.wait()
+            self._arrival.clear()
+
+            while len(self._arrived) > 0:
+                msg_type, message = self._arrived.popleft()
+                if msg_type is None:
+                    closed = True
+                    break
+                await self._dispatcher.dispatch(msg_type, message, monotonic_ns())
+
+        await self._dispatcher.flush()
+        self._dispatcher.cancel()
+        await self._protocol_logic.handle_disconnect(self)
+
+    def _schedule(self, item):
+        ''' Hand an item to the other end after a simulated delay '''
+
+        assert self._remote is not None
+        loop = asyncio.get_running_loop()
+        deliver_at = loop.time() + self._network.delay()
+
+        if not self._network.overtakes() and deliver_at <= self._last_delivery:
+            # Timers with the same deadline may fire in any order, so keep them apart
+            deliver_at = self._last_delivery + 1e-9
+        self._last_delivery = max(self._last_delivery, deliver_at)
+
+        if deliver_at <= loop.time():
+            # Without a delay, skip the timer heap
+            self._remote._arrive(item)
+        else:
+            loop.call_at(deliver_at, self._remote._arrive, item)
+
+    async def send(self, msg_type, payload):
+        ''' Send a message to the connected peer '''
+
+        # Peers must never share objects, just like with a real connection
+        payload = pickle.loads(pickle.dumps(payload))
+        self._network.count_message()
+        self._schedule((msg_type, payload))
+
+    async def disconnect(self):
+        ''' Close the link; the other end notices after the usual delay '''
+
+        if self._remote is not None:
+            self._schedule((None, None))
+        self._receive_task.cancel()
+        self._dispatcher.cancel()
+
+class SimulatedConnector:
+    ''' Accepts and establishes simulated connections; used like a `Connector` '''
+
+    def __init__(self, network: SimulatedNetwork, identifier: int, hostname: str, port: int,
+            message_type, protocol_logic, dispatch_lanes: int = DISPATCH_LANES):
+        self._network = network
+        self._identifier = identifier
+        self._hostname = hostname
+        self._port = port
+        self._message_type = message_type
+        self._protocol_logic = protocol_logic
+        self._dispatch_lanes = dispatch_lanes
+        self._peers: dict[int, SimulatedConnection] = {}
+
+    @property
+    def identifier(self) -> int:
+        ''' The unique identifier of this node '''
+        return self._identifier
+
+    @property
+    def hostname(self) -> str:
+        ''' The hostname we pretend to listen on '''
+        return self._hostname
+
+    @property
+    def port(self) -> int:
+        ''' The port we listen on in the simulated network '''
+        return self._port
+
+    async def start(self):
+        ''' Start accepting connections '''
+        self._network.listen(self._port, self)
+
+    async def stop(self):
+        ''' Stop accepting connections and disconnect from all peers '''
+
+        self._network.unlisten(self._port)
+        for peer in self._peers.values():
+            await peer.disconnect()
+        self._peers.clear()
+
+    def _open(self, peer_id: int, hostname: str, port: int) -> SimulatedConnection:
+        return SimulatedConnection(self._network, peer_id, hostname, port,
+                self._message_type, self._protocol_logic, self._dispatch_lanes)
+
+    async def _accept(self, peer: SimulatedConnection):
+        self._peers[peer.identifier] = peer
+        await self._protocol_logic.handle_incoming_connection(peer)
+
+    async def connect_to_peer(self, hostname: str, port: int) -> SimulatedConnection:
+        ''' Establish a connection to another node (after one simulated round trip) '''
+
+        remote = self._network.lookup(port)
+
+        local_end = self._open(remote.identifier, hostname, port)
+        remote_end = remote._open(self._identifier, self._hostname, self._port)
+        local_end.attach(remote_end)
+        remote_end.attach(local_end)
+
+        # The handshake
+        await asyncio.sleep(self._network.delay())
+        await remote._accept(remote_end)
+        await asyncio.sleep(self._network.delay())
+
+        logging.info("Connected to node #%s using the simulated network", remote.identifier)
+        self._peers[remote.identifier] = local_end
+        return local_end
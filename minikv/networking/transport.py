@@ -0,0 +1,345 @@
+'''
+Transports to reach other nodes: TCP, Unix domain sockets for peers on the
+same host, and an experimental shared-memory ring buffer.
+
+All of them hand out an asyncio stream reader/writer pair, so the rest
+of the networking code does not care how the bytes get to the peer.
+'''
+
+#pylint: disable=too-many-instance-attributes
+
+import os
+import re
+import mmap
+import uuid
+import struct
+import asyncio
+import tempfile
+import threading
+
+from ..constants import SHM_RING_SIZE
+
+TRANSPORTS = ["tcp", "unix", "shm", "auto"]
+
+# What the rings of a shared-memory connection are called (see create_ring_pair)
+_RING_NAME = re.compile(r"minikv-[0-9a-f]{32}-[ab]")
+
+# Taking a lock is a full memory barrier, which Python does not offer otherwise
+_FENCE = threading.Lock()
+
+def _memory_fence():
+    with _FENCE:
+        pass
+
+def unix_socket_path(port: int) -> str:
+    ''' The Unix domain socket a node listening on the specified port also accepts peers on '''
+    return os.path.join(tempfile.gettempdir(), f"minikv-{port}.sock")
+
+def is_local(hostname: str) -> bool:
+    ''' Does the hostname refer to this machine? '''
+    return hostname in ("localhost", "127.0.0.1", "::1")
+
+async def open_stream(hostname: str, port: int, transport: str):
+    '''
+        Connect to a peer using the specified transport.
+        Returns the reader, the writer, and the name of the transport actually used.
+        "auto" (and "shm", whose handshake runs over a socket) picks a Unix domain
+        socket if the peer runs on this host and listens on one, and TCP otherwise.
+    '''
+
+    assert transport in TRANSPORTS
+
+    if transport != "tcp" and is_local(hostname):
+        path = unix_socket_path(port)
+        if os.path.exists(path):
+            reader, writer = await asyncio.open_unix_connection(path)
+            return reader, writer, "unix"
+
+        if transport == "unix":
+            raise ConnectionError(f"Peer at port {port} does not listen on {path}")
+
+    reader, writer = await asyncio.open_connection(hostname, port)
+    return reader, writer, "tcp"
+
+class ShmRing:
+    '''
+        A single-producer single-consumer byte ring in a shared memory file.
+
+        The header holds the (ever-increasing) write and read positions
+        and flags that tell the other side it is waiting to be woken up.
+    '''
+
+    HEADER = struct.Struct("QQII")
+    HEADER_SIZE = 64
+
+    def __init__(self, path: str, create: bool, capacity: int = SHM_RING_SIZE):
+        self._path = path
+
+        if create:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+            os.ftruncate(fd, self.HEADER_SIZE + capacity)
+        else:
+            # The peer names the file, so do not follow it anywhere else
+            fd = os.open(path, os.O_RDWR | os.O_NOFOLLOW)
+
+        try:
+            size = os.fstat(fd).st_size
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self._capacity = size - self.HEADER_SIZE
+
+    @property
+    def path(self) -> str:
+        ''' Where the ring lives in the file system (until it is unlinked) '''
+        return self._path
+
+    def _load(self):
+        return self.HEADER.unpack_from(self._map, 0)
+
+    def _store_pos(self, offset: int, value: int):
+        struct.pack_into("Q", self._map, offset, value)
+
+    def set_waiting(self, reader: bool, waiting: bool):
+        ''' Flag (or unflag) the reader or writer side as waiting for a wake-up '''
+        struct.pack_into("I", self._map, 16 if reader else 20, int(waiting))
+
+    def is_waiting(self, reader: bool) -> bool:
+        ''' Is the reader or writer side waiting for a wake-up? '''
+        return self._load()[2 if reader else 3] != 0
+
+    def readable(self) -> int:
+        ''' How many bytes can be read right now '''
+        write_pos, read_pos, _, _ = self._load()
+        return write_pos - read_pos
+
+    def writable(self) -> int:
+        ''' How many bytes can be written right now '''
+        return self._capacity - self.readable()
+
+    def write(self, data) -> int:
+        ''' Copy as much of data into the ring as fits; returns the number of bytes written '''
+
+        write_pos, read_pos, _, _ = self._load()
+        length = min(len(data), self._capacity - (write_pos - read_pos))
+
+        start = write_pos % self._capacity
+        first = min(length, self._capacity - start)
+        base = self.HEADER_SIZE
+        self._map[base+start:base+start+first] = data[:first]
+        self._map[base:base+length-first] = data[first:length]
+
+        # Publish the data only after it has been copied
+        self._store_pos(0, write_pos + length)
+        return length
+
+    def read(self, max_len: int) -> bytes:
+        ''' Take up to max_len bytes out of the ring '''
+
+        write_pos, read_pos, _, _ = self._load()
+        length = min(max_len, write_pos - read_pos)
+
+        start = read_pos % self._capacity
+        first = min(length, self._capacity - start)
+        base = self.HEADER_SIZE
+        data = self._map[base+start:base+start+first] + self._map[base:base+length-first]
+
+        self._store_pos(8, read_pos + length)
+        return data
+
+    def unlink(self):
+        ''' Remove the ring from the file system; existing mappings stay valid '''
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        ''' Unmap the ring '''
+        self._map.close()
+
+def ring_directory() -> str:
+    ''' Where the rings of shared-memory connections live (without symlinks) '''
+    return os.path.realpath("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+
+def is_ring_path(path: str) -> bool:
+    '''
+        Does the path name a ring that create_ring_pair could have made?
+        Peers tell us which files to map (and unlink), so nothing else may be accepted.
+    '''
+
+    if os.path.realpath(path) != path:
+        return False
+
+    directory, name = os.path.split(path)
+    return directory == ring_directory() and _RING_NAME.fullmatch(name) is not None
+
+def create_ring_pair() -> tuple[ShmRing, ShmRing]:
+    ''' Create an outgoing and an incoming ring for a new shared-memory connection '''
+
+    directory = ring_directory()
+    name = uuid.uuid4().hex
+    return (ShmRing(os.path.join(directory, f"minikv-{name}-a"), True),
+            ShmRing(os.path.join(directory, f"minikv-{name}-b"), True))
+
+class ShmChannel:
+    '''
+        Moves data through a pair of shared-memory rings.
+
+        The socket the handshake ran over stays open, but only carries one-byte
+        wake-ups: b'd' when data was added to a ring whose reader sleeps, and
+        b's' when space was freed in a ring whose writer sleeps. A side that is
+        about to sleep flags itself and checks the ring once more, and the other
+        side checks the flag after updating the ring, with a memory barrier in
+        between on both sides, so one of them always notices the other.
+        An idle connection therefore does not wake up at all, apart from a
+        rare safety net in case the barrier is not enough on some CPU.
+    '''
+
+    DATA = b'd'
+    SPACE = b's'
+    # Upper bound on how long a lost wake-up could delay us
+    WAKEUP_TIMEOUT = 1.0
+
+    def __init__(self, out_ring: ShmRing, in_ring: ShmRing,
+            reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._out = out_ring
+        self._in = in_ring
+        self._sock_reader = reader
+        self._sock_writer = writer
+        self._data_event = asyncio.Event()
+        self._space_event = asyncio.Event()
+        self._closed = False
+        self._notify_task = asyncio.create_task(self._receive_notifications())
+
+    async def _receive_notifications(self):
+        while True:
+            data = await self._sock_reader.read(4096)
+            if len(data) == 0:
+                break
+            if self.DATA in data:
+                self._data_event.set()
+            if self.SPACE in data:
+                self._space_event.set()
+
+        self._closed = True
+        self._data_event.set()
+        self._space_event.set()
+
+    def _notify(self, ring: ShmRing, reader: bool, signal: bytes):
+        # The ring was just updated; make sure that is visible before reading the flag
+        _memory_fence()
+        if ring.is_waiting(reader):
+            ring.set_waiting(reader, False)
+            self._sock_writer.write(signal)
+
+    async def _wait(self, event: asyncio.Event):
+        try:
+            await asyncio.wait_for(event.wait(), self.WAKEUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    def at_eof(self) -> bool:
+        ''' Did the peer go away and we consumed everything it sent? '''
+        return self._closed and self._in.readable() == 0
+
+    async def read(self, max_len: int) -> bytes:
+        ''' Read up to max_len bytes; returns b'' once the peer disconnected '''
+
+        while self._in.readable() == 0:
+            if self._closed:
+                return b''
+
+            self._in.set_waiting(True, True)
+            _memory_fence()
+            if self._in.readable() > 0:
+                break
+            await self._wait(self._data_event)
+
+        self._in.set_waiting(True, False)
+        data = self._in.read(max_len)
+        self._notify(self._in, False, self.SPACE)
+        return data
+
+    async def write_all(self, data: bytes):
+        ''' Write all of data, waiting for the peer to make room if needed '''
+
+        view = memoryview(data)
+        while len(view) > 0:
+            if self._closed:
+                raise ConnectionResetError("Peer closed the shared memory connection")
+
+            written = self._out.write(view)
+            view = view[written:]
+
+            if written > 0:
+                self._notify(self._out, True, self.DATA)
+
+            if len(view) > 0:
+                self._out.set_waiting(False, True)
+                _memory_fence()
+                if self._out.writable() == 0:
+                    await self._wait(self._space_event)
+                self._out.set_waiting(False, False)
+
+        await self._sock_writer.drain()
+
+    def close(self):
+        ''' Close the connection and release the rings '''
+
+        self._sock_writer.close()
+        self._notify_task.cancel()
+        self._out.unlink()
+        self._in.unlink()
+
+    async def wait_closed(self):
+        ''' Wait until the underlying socket is closed '''
+        await self._sock_writer.wait_closed()
+
+class ShmStreamReader:
+    ''' The reading half of a shared-memory connection, used like a StreamReader '''
+
+    def __init__(self, channel: ShmChannel):
+        self._channel = channel
+
+    def at_eof(self) -> bool:
+        ''' Did the peer disconnect and we read everything? '''
+        return self._channel.at_eof()
+
+    async def read(self, max_len: int) -> bytes:
+        ''' Read up to max_len bytes '''
+        return await self._channel.read(max_len)
+
+class ShmStreamWriter:
+    ''' The writing half of a shared-memory connection, used like a StreamWriter '''
+
+    def __init__(self, channel: ShmChannel):
+        self._channel = channel
+        self._pending: list[bytes] = []
+
+    def write(self, data: bytes):
+        ''' Queue data to be sent on the next drain '''
+        self._pending.append(data)
+
+    async def drain(self):
+        ''' Move all queued data into the ring '''
+        data = b''.join(self._pending)
+        self._pending.clear()
+        await self._channel.write_all(data)
+
+    def close(self):
+        ''' Close the connection '''
+        self._channel.close()
+
+    async def wait_closed(self):
+        ''' Wait until the connection is closed '''
+        await self._channel.wait_closed()
+
+def open_shm_streams(out_ring: ShmRing, in_ring: ShmRing,
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    ''' Layer a shared-memory connection over an established local socket '''
+
+    channel = ShmChannel(out_ring, in_ring, reader, writer)
+    return ShmStreamReader(channel), ShmStreamWriter(channel)
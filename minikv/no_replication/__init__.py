@@ -1,33 +1,96 @@
 ''' The logic for non-replicated MiniKV '''
 
+#pylint: disable=too-many-arguments,too-many-positional-arguments
+
+from typing import AsyncIterator
+
 from .. import webserver
-from ..db import Database
+from ..db import Database, ReadView
+from ..constants import CLIENT_START_PORT, LEASE_DURATION
+from ..changefeed import ChangeLog
+from ..tracing import Tracer
+from ..snapshot import fork_snapshot
+from ..dump import fork_export
 
 class NoReplication:
     ''' The logic for non-replicated MiniKV '''
 
-    def __init__(self):
-        self._database = Database()
+    def __init__(self, tracer: Tracer|None = None, database: Database|None = None,
+            client_address: str|None = None):
+        self._database = database if database is not None else Database()
+        self._client_address = client_address
+        self._changes = ChangeLog()
+        self._tracer = tracer if tracer is not None else Tracer(0)
+
+    @property
+    def tracer(self) -> Tracer:
+        ''' Records spans of sampled requests '''
+        return self._tracer
+
+    @property
+    def changes(self) -> ChangeLog:
+        ''' The log of committed updates '''
+        return self._changes
+
+    @property
+    def topology_version(self) -> int:
+        ''' A single node never changes its topology '''
+        return 0
+
+    @property
+    def topology(self) -> dict:
+        ''' This node is the only one '''
+        return {"version": 0, "chain": [{"id": 0, "address": self._client_address}]}
+
+    @property
+    def object_counts(self) -> dict:
+        ''' How many of the objects that make up most of a node's memory it holds right now '''
+        return {"database_entries": len(self._database),
+                "database_versions": self._database.num_versions}
 
     async def get_all(self):
         ''' Return all entries in the database '''
         return self._database.get_all()
 
-    async def get(self, key):
-        ''' Read an entry from the database '''
-        return self._database.get(key)
+    async def get(self, key, at: int|None = None):
+        ''' Read an entry from the database (as of a committed sequence number) '''
+        return self._database.get(key, at)
+
+    def read_view(self, at: int|None = None) -> ReadView:
+        ''' A consistent view of the database as of a committed sequence number '''
+        return self._database.read_view(at)
+
+    async def snapshot(self, path: str) -> dict:
+        ''' Write a point-in-time snapshot of the database to the specified file '''
+        return await fork_snapshot(self._database, path)
+
+    async def bulk_load(self, items: list) -> int:
+        ''' Store a batch of [key, value] pairs '''
+        last_seq = self._changes.extend(items)
+        self._database.put_many(items, last_seq - len(items) + 1)
+        return len(items)
+
+    def export(self, fmt: str) -> AsyncIterator[bytes]:
+        ''' Stream a consistent copy of the database in the specified dump format '''
+        return fork_export(self._database, fmt)
 
-    async def put(self, key, value):
+    async def put(self, key, value, trace_id: str|None = None):
         ''' Store a new entry to the database '''
-        return self._database.put(key, value)
+        seq = self._changes.append(key, value)
+        with self._tracer.span(trace_id, "db_put"):
+            self._database.put(key, value, seq)
 
-async def serve(index: int, connect_to: list[int]):
+async def serve(index: int, connect_to: list[int], tracer: Tracer|None = None,
+        database: Database|None = None, snapshot_path: str|None = None,
+        client_port_base: int = CLIENT_START_PORT, lease_duration: float = LEASE_DURATION):
     ''' Run MiniKV with no replication '''
 
     assert index == 0
     assert len(connect_to) == 0
 
-    logic = NoReplication()
+    logic = NoReplication(tracer=tracer, database=database,
+            client_address=webserver.client_address(index, client_port_base))
     print("Started MiniKV (no replication)")
 
-    await webserver.serve(logic, index)
+    await webserver.serve(logic, index, snapshot_path=snapshot_path,
+            client_port_base=client_port_base, lease_duration=lease_duration)
@@ -0,0 +1,329 @@
+'''
+On-demand profiling of a running node.
+
+Nothing here costs anything until it is asked for: CPU profiles sample the
+event loop's stack from another thread for a limited time, memory profiles
+only trace allocations between start and stop, and the loop monitor only
+times callbacks while it runs.
+'''
+
+import os
+import sys
+import heapq
+import marshal
+import asyncio
+import threading
+import tracemalloc
+
+from time import monotonic, perf_counter, sleep
+from collections import Counter, defaultdict
+
+from .constants import (PROFILE_SAMPLE_INTERVAL, PROFILE_MIN_INTERVAL, PROFILE_MAX_DURATION,
+                        TRACEMALLOC_FRAMES)
+
+# Callbacks are counted in buckets up to these durations (in ms)
+LOOP_BUCKETS_MS = [0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 50.0, 100.0, 500.0, float("inf")]
+
+# Memory is attributed to the innermost frame of the first of these that matches
+_SUBSYSTEMS = [
+    ("database", (os.path.join("minikv", "db.py"), os.path.join("minikv", "snapshot.py"))),
+    ("replication", (os.path.join("minikv", "chain_replication", ""),
+                     os.path.join("minikv", "no_replication", ""))),
+    ("connections", (os.path.join("minikv", "networking", ""),)),
+    ("aiohttp", (os.path.join("aiohttp", ""), os.path.join("multidict", ""),
+                 os.path.join("yarl", ""))),
+    ("minikv (other)", (os.path.join("minikv", ""),)),
+]
+
+class ProfilerBusy(Exception):
+    ''' A profile of the same kind is already running (or memory tracing is not started) '''
+
+Stack = tuple[tuple[str, int, str], ...]
+
+def _sample_stacks(thread_id: int, duration: float, interval: float) -> Counter[Stack]:
+    ''' Runs in a helper thread: periodically record the stack of the specified thread '''
+
+    samples: Counter[Stack] = Counter()
+    end = monotonic() + duration
+
+    while monotonic() < end:
+        frame = sys._current_frames().get(thread_id) #pylint: disable=protected-access
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+
+        samples[tuple(reversed(stack))] += 1
+        sleep(interval)
+
+    return samples
+
+def _label(func: tuple[str, int, str]) -> str:
+    filename, line, name = func
+    short = os.path.join(*filename.split(os.sep)[-2:]) if os.sep in filename else filename
+    return f"{name} ({short}:{line})"
+
+def to_collapsed(samples: Counter[Stack]) -> str:
+    ''' One line per stack, outermost frame first, as used by flame graph tools '''
+
+    return "".join(f"{';'.join(_label(func) for func in stack)} {count}\n"
+                   for stack, count in samples.most_common())
+
+def to_pstats(samples: Counter[Stack], interval: float) -> bytes:
+    '''
+        Convert samples into the (marshalled) format of `pstats`.
+        Each sample counts as one call that took one sampling interval.
+    '''
+
+    stats: dict = {}
+    callers: dict = defaultdict(Counter)
+
+    for stack, count in samples.items():
+        if len(stack) == 0:
+            continue
+
+        for func in set(stack):
+            calls, _, own, total = stats.get(func, (0, 0, 0.0, 0.0))
+            stats[func] = (calls + count, calls + count, own, total + count * interval)
+
+        leaf = stack[-1]
+        calls, prim, own, total = stats[leaf]
+        stats[leaf] = (calls, prim, own + count * interval, total)
+
+        for caller, callee in set(zip(stack, stack[1:])):
+            callers[callee][caller] += count
+
+    return marshal.dumps({func: (prim, calls, own, total, dict(callers[func]))
+                          for func, (calls, prim, own, total) in stats.items()})
+
+def _subsystem(traceback: tracemalloc.Traceback) -> str:
+    for frame in reversed(traceback):
+        for name, patterns in _SUBSYSTEMS:
+            if any(pattern in frame.filename for pattern in patterns):
+                return name
+    return "other"
+
+def _breakdown(snapshot: tracemalloc.Snapshot) -> dict[str, dict]:
+    ''' Total size and number of blocks allocated by each subsystem '''
+
+    result: dict[str, dict] = defaultdict(lambda: {"size": 0, "count": 0})
+    for stat in snapshot.statistics('traceback'):
+        entry = result[_subsystem(stat.traceback)]
+        entry["size"] += stat.size
+        entry["count"] += stat.count
+    return dict(result)
+
+class _LoopMonitor:
+    '''
+        Times every callback the event loop runs, by wrapping `Handle._run`
+        for as long as it is installed, and probes how long a ready callback
+        waits before it gets to run.
+
+        `Handle._run` is shared by all event loops of the process, so it is
+        wrapped once for all installed monitors, and restored once the last
+        of them is uninstalled (in whatever order that happens).
+    '''
+
+    SLOWEST = 10
+    PROBE_INTERVAL = 0.01
+
+    # The monitors that are installed right now, and what the wrapper replaced
+    _installed: set['_LoopMonitor'] = set()
+    _original_run = None
+
+    def __init__(self):
+        self.buckets = [0] * len(LOOP_BUCKETS_MS)
+        self.slowest: list[tuple[float, int, str]] = []
+        self.lags: list[float] = []
+
+    def _record(self, handle, duration: float):
+        ms = duration * 1000
+        for idx, bound in enumerate(LOOP_BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[idx] += 1
+                break
+
+        if len(self.slowest) < self.SLOWEST or ms > self.slowest[0][0]:
+            entry = (ms, id(handle), _describe(handle))
+            if len(self.slowest) < self.SLOWEST:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heapreplace(self.slowest, entry)
+
+    def install(self):
+        ''' Start timing callbacks '''
+
+        installed = _LoopMonitor._installed
+        if len(installed) == 0:
+            original = asyncio.events.Handle._run #pylint: disable=protected-access
+
+            def timed_run(handle):
+                start = perf_counter()
+                original(handle)
+                duration = perf_counter() - start
+                for monitor in list(installed):
+                    monitor._record(handle, duration) #pylint: disable=protected-access
+
+            _LoopMonitor._original_run = original
+            asyncio.events.Handle._run = timed_run #pylint: disable=protected-access
+
+        installed.add(self)
+
+    def uninstall(self):
+        ''' Stop timing callbacks '''
+
+        installed = _LoopMonitor._installed
+        installed.discard(self)
+        original = _LoopMonitor._original_run
+        if len(installed) == 0 and original is not None:
+            asyncio.events.Handle._run = original #pylint: disable=protected-access
+            _LoopMonitor._original_run = None
+
+    async def probe(self, duration: float):
+        ''' Measure how long a callback scheduled with call_soon waits to run '''
+
+        loop = asyncio.get_running_loop()
+        end = monotonic() + duration
+
+        while monotonic() < end:
+            ran = loop.create_future()
+            scheduled = perf_counter()
+            loop.call_soon(lambda: ran.set_result(perf_counter() - scheduled))
+            self.lags.append(await ran)
+            await asyncio.sleep(self.PROBE_INTERVAL)
+
+def _describe(handle) -> str:
+    ''' Name what a slow callback ran: the coroutine of a task, or the function '''
+
+    callback = getattr(handle, "_callback", None)
+    owner = getattr(callback, "__self__", None)
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro()
+        return f"task {getattr(coro, '__qualname__', repr(coro))}"
+    return getattr(callback, "__qualname__", repr(callback))
+
+def _percentile(values: list[float], pct: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+class Profiler:
+    ''' Runs the profiles a node's admin endpoints ask for; one of each kind at a time '''
+
+    def __init__(self, max_duration: float = PROFILE_MAX_DURATION):
+        self._max_duration = max_duration
+        self._cpu_running = False
+        self._loop_running = False
+        self._memory_baseline: tracemalloc.Snapshot|None = None
+        self._memory_breakdown: dict[str, dict] = {}
+
+    def _check_duration(self, seconds: float):
+        if not 0 < seconds <= self._max_duration:
+            raise ValueError(f"Profiles last between 0 and {self._max_duration} seconds")
+
+    async def cpu(self, seconds: float,
+            interval: float = PROFILE_SAMPLE_INTERVAL) -> Counter[Stack]:
+        '''
+            Sample the stack of the event loop's thread for the specified time.
+            The loop keeps running; samples are taken from a helper thread.
+        '''
+
+        self._check_duration(seconds)
+        if interval < PROFILE_MIN_INTERVAL:
+            raise ValueError(f"Sampling intervals are at least {PROFILE_MIN_INTERVAL} seconds")
+        if self._cpu_running:
+            raise ProfilerBusy("A CPU profile is already running")
+
+        self._cpu_running = True
+        try:
+            return await asyncio.to_thread(_sample_stacks, threading.get_ident(),
+                                           seconds, interval)
+        finally:
+            self._cpu_running = False
+
+    async def loop(self, seconds: float) -> dict:
+        '''
+            Time every callback of the event loop for the specified time and report
+            a histogram of their durations, the slowest ones, and how long ready
+            callbacks had to wait (the loop's lag)
+        '''
+
+        self._check_duration(seconds)
+        if self._loop_running:
+            raise ProfilerBusy("The event loop is already being profiled")
+
+        self._loop_running = True
+        monitor = _LoopMonitor()
+        monitor.install()
+        try:
+            await monitor.probe(seconds)
+        finally:
+            monitor.uninstall()
+            self._loop_running = False
+
+        return {
+            "callbacks": sum(monitor.buckets),
+            "histogram": [{"le_ms": bound if bound != float("inf") else None, "count": count}
+                          for bound, count in zip(LOOP_BUCKETS_MS, monitor.buckets)],
+            "slowest": [{"ms": ms, "callback": name}
+                        for ms, _, name in sorted(monitor.slowest, reverse=True)],
+            "lag_ms": {"p50": _percentile(monitor.lags, 50) * 1000,
+                       "p99": _percentile(monitor.lags, 99) * 1000,
+                       "max": max(monitor.lags, default=0.0) * 1000},
+        }
+
+    def start_memory(self, frames: int = TRACEMALLOC_FRAMES) -> dict:
+        ''' Start tracing allocations; only memory allocated from now on is accounted for '''
+
+        if tracemalloc.is_tracing():
+            raise ProfilerBusy("Memory tracing is already running")
+
+        tracemalloc.start(frames)
+        self._memory_baseline = tracemalloc.take_snapshot()
+        self._memory_breakdown = {}
+        return {"tracing": True, "frames": frames}
+
+    async def memory_snapshot(self, limit: int = 10) -> dict:
+        '''
+            Take a snapshot of the traced allocations and compare it to the previous one.
+            Reports the memory held per subsystem and the allocation sites that grew most.
+        '''
+
+        if not tracemalloc.is_tracing() or self._memory_baseline is None:
+            raise ProfilerBusy("Memory tracing is not running")
+
+        snapshot = tracemalloc.take_snapshot()
+        # Grouping all traces takes a while, so do not stall the loop meanwhile
+        breakdown = await asyncio.to_thread(_breakdown, snapshot)
+        top = await asyncio.to_thread(snapshot.compare_to, self._memory_baseline, 'lineno')
+
+        previous = self._memory_breakdown
+        subsystems = {name: {**entry,
+                             "size_diff": entry["size"] - previous.get(name, {}).get("size", 0)}
+                      for name, entry in breakdown.items()}
+
+        self._memory_baseline = snapshot
+        self._memory_breakdown = breakdown
+
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "traced_bytes": current,
+            "peak_bytes": peak,
+            "subsystems": subsystems,
+            "top": [{"location": str(stat.traceback[-1]), "size": stat.size,
+                     "size_diff": stat.size_diff, "count_diff": stat.count_diff}
+                    for stat in top[:limit]],
+        }
+
+    def stop_memory(self) -> dict:
+        ''' Stop tracing allocations and free the traces '''
+
+        if not tracemalloc.is_tracing():
+            raise ProfilerBusy("Memory tracing is not running")
+
+        tracemalloc.stop()
+        self._memory_baseline = None
+        self._memory_breakdown = {}
+        return {"tracing": False}
@@ -0,0 +1,101 @@
+'''
+Runs a whole MiniKV cluster inside one process on a simulated network.
+
+    async def main():
+        cluster = SimulatedCluster(5, network=SimulatedNetwork(seed=42, max_delay=0.001))
+        await cluster.start()
+        await cluster.put("foo", "bar", node=3)
+        ...
+
+    run_simulation(main)
+'''
+
+import asyncio
+
+from typing import Any, Awaitable, Callable
+
+from .chain_replication.logic import ChainReplication
+from .no_replication import NoReplication
+from .networking.simulated import SimulatedNetwork, VirtualTimeLoop
+
+class SimulatedCluster:
+    '''
+        N ChainReplication nodes (or a single NoReplication node) that talk over
+        a simulated network. Keyword arguments are passed on to every node.
+    '''
+
+    def __init__(self, num_nodes: int, replication: str = "chain",
+            network: SimulatedNetwork|None = None, **node_args):
+        assert num_nodes > 0
+        assert replication in ("chain", "none")
+        assert replication == "chain" or num_nodes == 1, "No replication means a single node"
+
+        self._network = network if network is not None else SimulatedNetwork()
+
+        if replication == "chain":
+            self._nodes: list = [ChainReplication(index, client_address=f"sim:{index}",
+                                    connector_factory=self._network.connector, **node_args)
+                                 for index in range(num_nodes)]
+        else:
+            self._nodes = [NoReplication(client_address="sim:0", **node_args)]
+
+    @property
+    def network(self) -> SimulatedNetwork:
+        ''' The network the nodes talk over '''
+        return self._network
+
+    @property
+    def nodes(self) -> list:
+        ''' All nodes, head first '''
+        return self._nodes
+
+    async def start(self):
+        ''' Start all nodes, each connecting to its predecessor '''
+
+        for index, node in enumerate(self._nodes):
+            if isinstance(node, ChainReplication):
+                await node.start(index - 1 if index > 0 else None)
+
+    async def stop(self):
+        ''' Disconnect all nodes '''
+
+        for node in self._nodes:
+            if isinstance(node, ChainReplication):
+                await node.stop()
+
+    async def put(self, key: str, value, node: int = 0):
+        ''' Write through the specified node '''
+        await self._nodes[node].put(key, value)
+
+    async def bulk_load(self, items: list) -> int:
+        ''' Load a batch of [key, value] pairs through the head '''
+        return await self._nodes[0].bulk_load(items)
+
+    async def get(self, key: str, node: int = -1):
+        ''' Read from the specified node (the tail by default) '''
+        return await self._nodes[node].get(key)
+
+    async def get_all(self, node: int) -> list[tuple[str, Any]]:
+        ''' All entries of a node, sorted by key '''
+        return sorted(await self._nodes[node].get_all())
+
+def run_simulation(main: Callable[[], Awaitable[Any]]) -> Any:
+    '''
+        Run main() to completion on a virtual-time event loop and return its result.
+        Raises SimulationStalled if the nodes deadlock.
+    '''
+
+    loop = VirtualTimeLoop()
+    try:
+        return loop.run_until_complete(main())
+    finally:
+        # Node-internal tasks (e.g., message handlers) run forever; stop them
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+
+        async def wait_cancelled():
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        loop.run_until_complete(wait_cancelled())
+        loop.close()
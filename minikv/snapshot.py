@@ -0,0 +1,190 @@
+'''
+Point-in-time snapshots of a node's database.
+
+A snapshot file is laid out as follows (all integers little-endian):
+  header:  magic, version, number of entries, offset of the index, CRC32 of the body
+  records: key length, value length, CRC32 of key and value, key, value (JSON)
+  index:   (64-bit key hash, record offset) pairs, sorted by hash
+
+The index lets a node serve reads straight from the mmapped file,
+so restarting from a snapshot does not have to load every entry first.
+'''
+
+import os
+import mmap
+import json
+import zlib
+import struct
+import asyncio
+import hashlib
+
+from time import monotonic
+from typing import Iterable, Iterator
+
+MAGIC = b"MKVSNAP1"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sIQQI")
+_RECORD = struct.Struct("<III")
+_INDEX_ENTRY = struct.Struct("<QQ")
+
+class SnapshotError(Exception):
+    ''' A snapshot file is malformed or corrupted '''
+
+def key_hash(key: bytes) -> int:
+    ''' The 64-bit hash records are indexed by '''
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+def write_snapshot(path: str, items: Iterable[tuple[str, object]]) -> int:
+    '''
+        Write all key-value pairs to a new snapshot file and return their number.
+        The file is written next to the destination and renamed, so readers
+        never see a partial snapshot.
+    '''
+
+    tmp_path = path + ".tmp"
+    index: list[tuple[int, int]] = []
+    checksum = 0
+
+    with open(tmp_path, 'wb') as ofile:
+        ofile.write(b'\0' * _HEADER.size)
+        offset = _HEADER.size
+
+        for key, value in items:
+            key_bytes = key.encode('utf-8')
+            value_bytes = json.dumps(value).encode('utf-8')
+            crc = zlib.crc32(value_bytes, zlib.crc32(key_bytes))
+
+            record = _RECORD.pack(len(key_bytes), len(value_bytes), crc) + key_bytes + value_bytes
+            ofile.write(record)
+            checksum = zlib.crc32(record, checksum)
+
+            index.append((key_hash(key_bytes), offset))
+            offset += len(record)
+
+        index.sort()
+        index_bytes = b''.join(_INDEX_ENTRY.pack(h, o) for h, o in index)
+        ofile.write(index_bytes)
+        checksum = zlib.crc32(index_bytes, checksum)
+
+        ofile.seek(0)
+        ofile.write(_HEADER.pack(MAGIC, VERSION, len(index), offset, checksum))
+        ofile.flush()
+        os.fsync(ofile.fileno())
+
+    os.replace(tmp_path, path)
+    return len(index)
+
+class SnapshotReader:
+    '''
+        Serves lookups from a memory-mapped snapshot file.
+        Pages are only read from disk once a key on them is accessed.
+    '''
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as ifile:
+            self._map = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < _HEADER.size:
+            raise SnapshotError(f"{path} is too short to be a snapshot")
+
+        magic, version, count, index_offset, checksum = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError(f"{path} is not a (supported) snapshot")
+        if index_offset + count * _INDEX_ENTRY.size != len(self._map):
+            raise SnapshotError(f"{path} is truncated")
+
+        self._count = count
+        self._index_offset = index_offset
+        self._checksum = checksum
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _index_entry(self, pos: int) -> tuple[int, int]:
+        return _INDEX_ENTRY.unpack_from(self._map, self._index_offset + pos * _INDEX_ENTRY.size)
+
+    def _record(self, offset: int) -> tuple[bytes, bytes]:
+        key_len, value_len, crc = _RECORD.unpack_from(self._map, offset)
+        start = offset + _RECORD.size
+        key = self._map[start:start+key_len]
+        value = self._map[start+key_len:start+key_len+value_len]
+
+        if zlib.crc32(value, zlib.crc32(key)) != crc:
+            raise SnapshotError(f"Record at offset {offset} is corrupted")
+
+        return key, value
+
+    def get(self, key: str) -> object|None:
+        ''' Look up a key (binary search on the index); returns None if it is not stored '''
+
+        key_bytes = key.encode('utf-8')
+        wanted = key_hash(key_bytes)
+
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self._index_entry(mid)[0] < wanted:
+                low = mid + 1
+            else:
+                high = mid
+
+        # Walk over all entries with this hash, in case of collisions
+        while low < self._count:
+            entry_hash, offset = self._index_entry(low)
+            if entry_hash != wanted:
+                break
+            stored_key, value = self._record(offset)
+            if stored_key == key_bytes:
+                return json.loads(value)
+            low += 1
+
+        return None
+
+    def items(self) -> Iterator[tuple[str, object]]:
+        ''' Iterate over all entries in file order '''
+
+        offset = _HEADER.size
+        while offset < self._index_offset:
+            key, value = self._record(offset)
+            yield key.decode('utf-8'), json.loads(value)
+            offset += _RECORD.size + len(key) + len(value)
+
+    def verify(self):
+        ''' Check the checksum of the entire file; raises SnapshotError on a mismatch '''
+
+        body = memoryview(self._map)[_HEADER.size:]
+        try:
+            if zlib.crc32(body) != self._checksum:
+                raise SnapshotError("Snapshot checksum mismatch")
+        finally:
+            body.release()
+
+async def fork_snapshot(database, path: str) -> dict:
+    '''
+        Write a snapshot of the database without pausing the node.
+
+        A forked child writes the file from its copy-on-write view of memory,
+        so the parent only pauses for the fork itself and keeps serving
+        (and modifying) its own copy in the meantime.
+    '''
+
+    start = monotonic()
+    pid = os.fork()
+
+    if pid == 0:
+        # Child: never return into the event loop of the parent
+        try:
+            write_snapshot(path, database.iter_items_unlocked())
+            os._exit(0)
+        except BaseException: #pylint: disable=broad-exception-caught
+            os._exit(1)
+
+    fork_time = monotonic() - start
+
+    _, status = await asyncio.get_running_loop().run_in_executor(None, os.waitpid, pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise SnapshotError(f"Snapshot process failed with status {status}")
+
+    return {"path": path, "fork_ms": fork_time * 1000,
+            "duration_ms": (monotonic() - start) * 1000}
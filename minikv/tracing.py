@@ -0,0 +1,126 @@
+''' Sampled request tracing across the nodes of a chain '''
+
+#pylint: disable=consider-using-with
+
+import sys
+import json
+import argparse
+
+from time import monotonic_ns
+from typing import TextIO
+from random import random, getrandbits
+from contextlib import contextmanager
+from collections import defaultdict
+
+class Tracer:
+    '''
+        Records spans of sampled requests to a local JSONL file.
+
+        Timestamps come from the monotonic clock, which all processes
+        on the same host share, so logs from co-located nodes line up.
+    '''
+
+    def __init__(self, node_id: int, sample_rate: float = 0.0, path: str|None = None):
+        assert 0.0 <= sample_rate <= 1.0
+
+        self._node_id = node_id
+        self._sample_rate = sample_rate
+
+        if sample_rate > 0.0:
+            assert path is not None, "Need a span log to sample requests"
+            self._file: TextIO|None = open(path, 'a', encoding='utf-8', buffering=1)
+        else:
+            self._file = None
+
+    @property
+    def enabled(self) -> bool:
+        ''' Does this tracer sample any requests at all? '''
+        return self._file is not None
+
+    def new_trace(self) -> str|None:
+        ''' Start a new trace if the request is sampled; returns its id or None '''
+
+        if self._file is None or random() >= self._sample_rate:
+            return None
+        return f"{getrandbits(64):016x}"
+
+    def record(self, trace_id: str|None, name: str, start: int, end: int):
+        ''' Write a span that began and ended at the specified monotonic times (in ns) '''
+
+        if trace_id is None or self._file is None:
+            return
+
+        span = {"trace": trace_id, "node": self._node_id, "span": name,
+                "start": start, "end": end}
+        self._file.write(json.dumps(span) + "\n")
+
+    @contextmanager
+    def span(self, trace_id: str|None, name: str):
+        ''' Record the time spent inside the context as a span (if the request is sampled) '''
+
+        if trace_id is None:
+            yield
+            return
+
+        start = monotonic_ns()
+        try:
+            yield
+        finally:
+            self.record(trace_id, name, start, monotonic_ns())
+
+def _load_spans(paths: list[str]) -> dict[str, list[dict]]:
+    traces = defaultdict(list)
+
+    for path in paths:
+        with open(path, encoding='utf-8') as ifile:
+            for line in ifile:
+                if line.strip():
+                    span = json.loads(line)
+                    traces[span["trace"]].append(span)
+
+    return traces
+
+def print_waterfall(trace_id: str, spans: list[dict], width: int = 50):
+    ''' Print the spans of a single request as a waterfall diagram '''
+
+    spans = sorted(spans, key=lambda s: (s["start"], -s["end"]))
+    begin = spans[0]["start"]
+    total = max(s["end"] for s in spans) - begin
+    scale = width / max(1, total)
+
+    print(f"trace {trace_id} ({total/1e6:.3f}ms)")
+
+    for span in spans:
+        offset = int((span["start"] - begin) * scale)
+        length = max(1, int((span["end"] - span["start"]) * scale))
+        timeline = " " * offset + "=" * length
+        print(f"  node{span['node']:<3} {span['span']:<16} |{timeline:<{width}}| "
+              f"+{(span['start']-begin)/1e6:.3f}ms {(span['end']-span['start'])/1e6:.3f}ms")
+
+def run_stitch():
+    ''' Merge the span logs of all nodes and print per-request waterfalls '''
+
+    parser = argparse.ArgumentParser(description=run_stitch.__doc__)
+    parser.add_argument("span_logs", nargs='+', help="The JSONL span logs of the nodes")
+    parser.add_argument("--trace", help="Only show the trace with this id")
+    parser.add_argument("--slowest", type=int, default=0,
+        help="Only show the N slowest traces")
+
+    args = parser.parse_args()
+    traces = _load_spans(args.span_logs)
+
+    if args.trace:
+        if args.trace not in traces:
+            print(f"No spans for trace {args.trace}")
+            sys.exit(1)
+        traces = {args.trace: traces[args.trace]}
+
+    def duration(spans):
+        return max(s["end"] for s in spans) - min(s["start"] for s in spans)
+
+    ordered = sorted(traces.items(), key=lambda t: duration(t[1]), reverse=True)
+    if args.slowest > 0:
+        ordered = ordered[:args.slowest]
+
+    for trace_id, spans in ordered:
+        print_waterfall(trace_id, spans)
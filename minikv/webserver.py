@@ -1,12 +1,37 @@
 ''' Simple HTTP interface to int'''
 
 import json
+import math
 import asyncio
 import logging
 
+from contextlib import aclosing
+
 from aiohttp import web
 
-from .constants import CLIENT_START_PORT
+from .constants import (CLIENT_START_PORT, LEASE_DURATION, MAX_REQUEST_SIZE,
+        PROFILE_SAMPLE_INTERVAL, TRACEMALLOC_FRAMES, SCAN_CHUNK_SIZE)
+from .db import VersionExpired
+from .changefeed import CursorExpired
+from .admission import Overloaded
+from .snapshot import SnapshotError
+from .leases import LeaseManager
+from .hotkeys import HotKeys
+from .dump import FORMATS, CONTENT_TYPES, DumpError, check_batch
+from .profiling import Profiler, ProfilerBusy, to_collapsed, to_pstats
+
+def client_address(index: int, client_port_base: int = CLIENT_START_PORT) -> str:
+    ''' The address clients reach the node with the specified index at '''
+    return f"localhost:{client_port_base+index}"
+
+def _topology_header(logic) -> dict[str, str]:
+    # Lets clients notice a changed topology without polling /topology
+    return {"X-Topology-Version": str(logic.topology_version)}
+
+def _error(status: int, err: Exception, headers: dict[str, str]|None = None) -> web.Response:
+    # Every failed request reports what went wrong the same way
+    return web.Response(status=status, text=json.dumps({"error": str(err)}), headers=headers,
+            content_type="application/json")
 
 async def handle_default(logic, _request):
     ''' Handle a request to the main page '''
@@ -28,39 +53,366 @@ async def handle_default(logic, _request):
 
     return web.Response(text=text, content_type="text/html")
 
-async def handle_get(logic, request):
-    ''' Fetches an entry from the database (if it exists) '''
+def _read_at(request) -> int|None:
+    ''' The committed sequence number a read asks for (None for the newest) '''
+    return int(request.query["at"]) if "at" in request.query else None
+
+def _version_error(err: Exception) -> web.Response:
+    # Like an expired watch cursor, an expired version cannot be read anymore
+    return _error(410 if isinstance(err, VersionExpired) else 400, err)
+
+async def handle_get(logic, leases, hotkeys, request):
+    '''
+        Fetches an entry from the database (if it exists), as of a committed
+        sequence number (?at=) or the newest one.
+        Caching clients pass their holder id and get a lease (in seconds) on the value.
+    '''
 
     key = request.query["key"]
-    value = await logic.get(key)
-    return web.Response(text=json.dumps({"value": value}),
+    hotkeys.record_read(key)
+
+    try:
+        at = _read_at(request)
+        value = await logic.get(key, at)
+    except (ValueError, VersionExpired) as err:
+        return _version_error(err)
+    result = {"value": value}
+
+    if at is None and "holder" in request.query:
+        result["lease"] = leases.grant(request.query["holder"], key)
+
+    return web.Response(text=json.dumps(result), headers=_topology_header(logic),
             content_type="application/json")
 
-async def handle_put(logic, request):
+async def handle_put(logic, hotkeys, request):
     ''' Stores a new key/value-pair in the database '''
 
-    key = request.query["key"]
-    value = (await request.json())["value"]
+    trace_id = logic.tracer.new_trace()
 
-    await logic.put(key, value)
+    with logic.tracer.span(trace_id, "http_put"):
+        key = request.query["key"]
+        value = (await request.json())["value"]
+
+        try:
+            await logic.put(key, value, trace_id=trace_id)
+        except Overloaded as err:
+            # Fail fast, so clients back off instead of piling up in our queues
+            return _error(503, err,
+                    headers={"Retry-After": str(max(1, math.ceil(err.retry_after))),
+                             # Retry-After only allows whole seconds; this is the precise hint
+                             "X-Retry-After-Ms": str(math.ceil(err.retry_after * 1000))})
+
+        # Only count writes that were accepted, so an overload does not make keys look hot
+        hotkeys.record_write(key)
 
     # Returns an empty OK
-    return web.Response(text=json.dumps({}),
+    return web.Response(text=json.dumps({}), headers=_topology_header(logic),
             content_type="application/json")
 
-async def serve(logic, index: int):
+async def handle_mget(logic, hotkeys, request):
+    '''
+        Fetches multiple entries (?key=a&key=b) as of the same committed
+        sequence number, which is returned alongside them
+    '''
+
+    keys = request.query.getall("key", [])
+    for key in keys:
+        hotkeys.record_read(key)
+
+    try:
+        with logic.read_view(_read_at(request)) as view:
+            result = {"seq": view.seq, "values": view.get_many(keys)}
+    except (ValueError, VersionExpired) as err:
+        return _version_error(err)
+
+    return web.Response(text=json.dumps(result), headers=_topology_header(logic),
+            content_type="application/json")
+
+async def handle_scan(logic, request):
+    '''
+        Streams all entries whose key starts with ?prefix= as newline-delimited JSON,
+        as of one committed sequence number (sent in the X-Snapshot-Seq header).
+        Other requests run between chunks, and updates do not change what the scan sees.
+    '''
+
+    prefix = request.query.get("prefix", "")
+
+    try:
+        view = logic.read_view(_read_at(request))
+    except (ValueError, VersionExpired) as err:
+        return _version_error(err)
+
+    with view:
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson",
+                                               "X-Snapshot-Seq": str(view.seq)})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        lines = []
+        try:
+            for key, value in view.items(prefix):
+                lines.append(json.dumps({"key": key, "value": value}) + "\n")
+                if len(lines) >= SCAN_CHUNK_SIZE:
+                    await response.write(''.join(lines).encode('utf-8'))
+                    lines = []
+                    # Writing does not wait if the client keeps up, so yield explicitly
+                    await asyncio.sleep(0)
+
+            await response.write(''.join(lines).encode('utf-8'))
+        except ConnectionResetError:
+            logging.debug("Client stopped the scan")
+
+    return response
+
+async def _follow_changes(changes, cursor: int, response: web.StreamResponse):
+    '''
+        Yields batches of committed updates, starting at cursor, until the
+        client falls too far behind; then it is told so and has to start over
+    '''
+
+    while True:
+        try:
+            entries = changes.read(cursor)
+        except CursorExpired:
+            error = {"error": "cursor expired", "oldest": changes.oldest_seq}
+            await response.write((json.dumps(error) + "\n").encode('utf-8'))
+            return
+
+        if len(entries) == 0:
+            await changes.wait(cursor)
+            continue
+
+        cursor = entries[-1][0] + 1
+        yield entries
+
+async def handle_watch(logic, request):
+    ''' Streams committed updates as newline-delimited JSON '''
+
+    prefix = request.query.get("prefix", "")
+    changes = logic.changes
+
+    if "since" in request.query:
+        try:
+            cursor = int(request.query["since"])
+        except ValueError:
+            return _error(400, ValueError("since has to be a sequence number"))
+    else:
+        cursor = changes.next_seq
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    try:
+        async for entries in _follow_changes(changes, cursor, response):
+            lines = b''.join(line for _, key, line in entries if key.startswith(prefix))
+
+            if len(lines) > 0:
+                await response.write(lines)
+    except ConnectionResetError:
+        logging.debug("Watcher disconnected")
+
+    return response
+
+async def handle_leases(logic, leases, request):
+    '''
+        Streams invalidations to a caching client as newline-delimited JSON.
+        The client only gets leases while this stream is open.
+    '''
+
+    holder = request.query["holder"]
+    changes = logic.changes
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    response.enable_chunked_encoding()
+
+    # Start following before the first lease can be granted, so no update is missed
+    cursor = changes.next_seq
+    leases.connect(holder)
+
+    try:
+        await response.prepare(request)
+
+        async for entries in _follow_changes(changes, cursor, response):
+            keys = leases.revoke(holder, (key for _, key, _ in entries))
+
+            if len(keys) > 0:
+                line = json.dumps({"invalidate": keys}) + "\n"
+                await response.write(line.encode('utf-8'))
+    except ConnectionResetError:
+        logging.debug("Lease holder %s disconnected", holder)
+    finally:
+        leases.disconnect(holder)
+
+    return response
+
+async def handle_snapshot(logic, _request, path: str):
+    '''
+        Writes a snapshot of the database to the configured path in the background
+        and reports how long it took. Clients cannot pick the path, as that would
+        let them overwrite any file the node may write.
+    '''
+
+    try:
+        result = await logic.snapshot(path)
+    except (SnapshotError, OSError) as err:
+        return _error(500, err)
+
+    return web.Response(text=json.dumps(result), content_type="application/json")
+
+async def handle_load(logic, request):
+    '''
+        Stores a batch of entries, sent as a JSON list of [key, value] pairs, on all nodes.
+        Meant to seed a cluster: updates to the same keys should not happen meanwhile.
+    '''
+
+    try:
+        items = check_batch(await request.json())
+        count = await logic.bulk_load(items)
+    except ValueError as err:
+        return _error(400, err)
+
+    return web.Response(text=json.dumps({"loaded": count}), headers=_topology_header(logic),
+            content_type="application/json")
+
+async def handle_export(logic, request):
+    ''' Streams a consistent copy of all entries as NDJSON, CSV, or a binary dump '''
+
+    fmt = request.query.get("format", "ndjson")
+    if fmt not in FORMATS:
+        return _error(400, ValueError(f"Unknown format: {fmt}"))
+
+    response = web.StreamResponse(headers={"Content-Type": CONTENT_TYPES[fmt]})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    try:
+        async with aclosing(logic.export(fmt)) as chunks:
+            async for chunk in chunks:
+                await response.write(chunk)
+    except ConnectionResetError:
+        logging.debug("Client stopped the export")
+    except DumpError as err:
+        # Too late to change the status; the client notices the truncated stream
+        logging.error("Export failed: %s", err)
+        raise
+
+    return response
+
+async def handle_topology(logic, _request):
+    ''' Publishes the order of nodes in the chain, head first, and the version of that view '''
+
+    return web.Response(text=json.dumps(logic.topology),
+            content_type="application/json")
+
+async def handle_hotkeys(hotkeys, request):
+    ''' Reports the most read and written keys of this node, with time-decayed counts '''
+
+    limit = request.query.get("limit", "10")
+    if not limit.isdecimal():
+        return _error(400, ValueError("limit has to be a non-negative number"))
+
+    return web.Response(text=json.dumps(hotkeys.report(int(limit))),
+            content_type="application/json")
+
+async def handle_profile_cpu(profiler, request):
+    '''
+        Samples where the event loop spends its time for a few seconds.
+        Returns collapsed stacks (for flame graphs) or a file that `pstats` can load.
+    '''
+
+    fmt = request.query.get("format", "collapsed")
+    if fmt not in ("collapsed", "pstats"):
+        return _error(400, ValueError(f"Unknown format: {fmt}"))
+
+    try:
+        seconds = float(request.query.get("seconds", 5))
+        interval = float(request.query.get("interval", PROFILE_SAMPLE_INTERVAL))
+        samples = await profiler.cpu(seconds, interval)
+    except ValueError as err:
+        return _error(400, err)
+    except ProfilerBusy as err:
+        return _error(409, err)
+
+    if fmt == "pstats":
+        return web.Response(body=to_pstats(samples, interval),
+                content_type="application/octet-stream")
+    return web.Response(text=to_collapsed(samples), content_type="text/plain")
+
+async def handle_profile_loop(profiler, request):
+    ''' Reports how long the event loop's callbacks took for a few seconds, and its lag '''
+
+    try:
+        result = await profiler.loop(float(request.query.get("seconds", 5)))
+    except ValueError as err:
+        return _error(400, err)
+    except ProfilerBusy as err:
+        return _error(409, err)
+
+    return web.Response(text=json.dumps(result), content_type="application/json")
+
+async def handle_memory(logic, profiler, action: str, request):
+    '''
+        Starts tracing allocations, reports what was allocated since the last
+        report (per subsystem and allocation site), or stops tracing
+    '''
+
+    try:
+        if action == "start":
+            result = profiler.start_memory(int(request.query.get("frames", TRACEMALLOC_FRAMES)))
+        elif action == "snapshot":
+            result = await profiler.memory_snapshot(int(request.query.get("limit", 10)))
+            result["objects"] = logic.object_counts
+        else:
+            result = profiler.stop_memory()
+    except ValueError as err:
+        return _error(400, err)
+    except ProfilerBusy as err:
+        return _error(409, err)
+
+    return web.Response(text=json.dumps(result), content_type="application/json")
+
+async def handle_health(_logic, _request):
+    ''' Readiness probe; the web server only starts once the node is fully set up '''
+
+    return web.Response(text=json.dumps({"status": "ok"}),
+            content_type="application/json")
+
+async def serve(logic, index: int, snapshot_path: str|None = None,
+        client_port_base: int = CLIENT_START_PORT, lease_duration: float = LEASE_DURATION):
     ''' Main function that runs the web server '''
 
-    app = web.Application()
+    snapshot_path = snapshot_path or f"minikv-{index}.snap"
+    leases = LeaseManager(lease_duration)
+    hotkeys = HotKeys()
+    profiler = Profiler()
+
+    app = web.Application(client_max_size=MAX_REQUEST_SIZE)
     app.add_routes([
         web.get('/', lambda r: handle_default(logic, r)),
-        web.get('/get', lambda r: handle_get(logic, r)),
-        web.post('/put', lambda r: handle_put(logic, r))])
+        web.get('/get', lambda r: handle_get(logic, leases, hotkeys, r)),
+        web.get('/mget', lambda r: handle_mget(logic, hotkeys, r)),
+        web.get('/scan', lambda r: handle_scan(logic, r)),
+        web.post('/put', lambda r: handle_put(logic, hotkeys, r)),
+        web.get('/health', lambda r: handle_health(logic, r)),
+        web.get('/topology', lambda r: handle_topology(logic, r)),
+        web.get('/watch', lambda r: handle_watch(logic, r)),
+        web.get('/leases', lambda r: handle_leases(logic, leases, r)),
+        web.get('/debug/hotkeys', lambda r: handle_hotkeys(hotkeys, r)),
+        web.post('/admin/snapshot', lambda r: handle_snapshot(logic, r, snapshot_path)),
+        web.post('/admin/load', lambda r: handle_load(logic, r)),
+        web.get('/admin/export', lambda r: handle_export(logic, r)),
+        web.post('/admin/profile/cpu', lambda r: handle_profile_cpu(profiler, r)),
+        web.post('/admin/profile/loop', lambda r: handle_profile_loop(profiler, r)),
+        web.post('/admin/memory/start', lambda r: handle_memory(logic, profiler, "start", r)),
+        web.post('/admin/memory/snapshot',
+                 lambda r: handle_memory(logic, profiler, "snapshot", r)),
+        web.post('/admin/memory/stop', lambda r: handle_memory(logic, profiler, "stop", r))])
 
 
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, 'localhost', CLIENT_START_PORT+index)
+    site = web.TCPSite(runner, 'localhost', client_port_base+index)
 
     await site.start()
     print("Waiting for Ctrl+C")
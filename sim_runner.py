@@ -0,0 +1,181 @@
+#! /bin/env python3
+
+# pylint: disable=too-many-locals
+
+''' Runs randomized protocol runs of MiniKV on a simulated network '''
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+import itertools
+import contextlib
+
+from io import StringIO
+from time import monotonic
+from random import Random
+from collections import defaultdict
+
+from minikv.constants import DISPATCH_LANES
+from minikv.networking.simulated import SimulatedNetwork, SimulationStalled
+from minikv.simulation import SimulatedCluster, run_simulation
+
+class CheckFailed(Exception):
+    ''' A run violated one of the protocol's guarantees '''
+
+def _committed(node) -> dict[str, list]:
+    ''' The values of each key in the order the node committed them '''
+
+    history = defaultdict(list)
+    for _, key, line in node.changes.read(node.changes.oldest_seq, limit=1 << 30):
+        history[key].append(json.loads(line)["value"])
+    return history
+
+def _numbered(node) -> list[bytes]:
+    ''' The node's change log, in which every update carries its sequence number '''
+    return [line for _, _, line in node.changes.read(node.changes.oldest_seq, limit=1 << 30)]
+
+async def _random_run(seed: int, args) -> dict:
+    '''
+        Let a few clients write to and read from random nodes of a chain of
+        random length, then check that all nodes agree
+    '''
+
+    rng = Random(seed)
+    num_nodes = rng.randint(1, args.max_nodes)
+    network = SimulatedNetwork(seed=seed, max_delay=args.max_delay, reorder=args.reorder)
+    coalesce = rng.random() < args.coalesce
+    cluster = SimulatedCluster(num_nodes, network=network,
+            dispatch_lanes=rng.choice([0, 1, DISPATCH_LANES]), coalesce_writes=coalesce)
+    await cluster.start()
+
+    written: dict[str, set] = defaultdict(set)
+    # When each write started and finished, counted in operations
+    started: dict[str, int] = {}
+    finished: dict[str, int] = {}
+    clock = itertools.count()
+
+    def check_at_tail(key: str, value: str):
+        # Acknowledged updates have to be committed at the tail, unless a
+        # concurrent write to the key superseded them at the head
+        history = _committed(cluster.nodes[-1])[key]
+        if value not in history and not (coalesce and any(
+                finished.get(other, started[value]) >= started[value]
+                for other in history)):
+            raise CheckFailed(f"Acknowledged update {key}={value} is not at the tail")
+
+    async def client(client_id: int):
+        for op in range(args.ops_per_client):
+            key = f"key{rng.randrange(args.key_range)}"
+            node = rng.randrange(num_nodes)
+
+            if rng.random() < args.bulk_ratio:
+                # Bulk loads overlap with concurrent puts to the same keys
+                keys = rng.sample(range(args.key_range), rng.randint(1, args.key_range))
+                items = [(f"key{idx}", f"{client_id}-{op}-bulk") for idx in keys]
+                for item_key, value in items:
+                    written[item_key].add(value)
+                started[items[0][1]] = next(clock)
+                await cluster.bulk_load(items)
+                finished[items[0][1]] = next(clock)
+
+                for item_key, value in items:
+                    check_at_tail(item_key, value)
+            elif rng.random() < args.write_ratio:
+                value = f"{client_id}-{op}"
+                written[key].add(value)
+                started[value] = next(clock)
+                await cluster.put(key, value, node=node)
+                finished[value] = next(clock)
+                check_at_tail(key, value)
+            else:
+                await cluster.get(key, node=node)
+
+            await asyncio.sleep(rng.uniform(0.0, args.max_delay))
+
+    await asyncio.gather(*[client(idx) for idx in range(args.clients)])
+
+    # Let the last acknowledgements reach the head
+    await asyncio.sleep(1.0)
+
+    contents = [await cluster.get_all(idx) for idx in range(num_nodes)]
+    histories = [_committed(node) for node in cluster.nodes]
+
+    for idx in range(1, num_nodes):
+        if contents[idx] != contents[0]:
+            raise CheckFailed(f"Node {idx} and the head disagree")
+        if histories[idx] != histories[0]:
+            raise CheckFailed(f"Node {idx} committed updates in a different order than the head")
+        if _numbered(cluster.nodes[idx]) != _numbered(cluster.nodes[0]):
+            raise CheckFailed(f"Node {idx} numbered updates differently than the head")
+
+    for key, value in contents[0]:
+        if value not in written[key]:
+            raise CheckFailed(f"{key}={value} was never written")
+        if histories[0][key][-1] != value:
+            raise CheckFailed(f"{key}={value} is not the last committed update")
+
+    if len(contents[0]) != len(written):
+        raise CheckFailed("Some written keys are missing")
+
+    await cluster.stop()
+    return {"nodes": num_nodes, "messages": network.num_messages}
+
+def _main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", default=1000, type=int,
+        help="How many randomized runs to do")
+    parser.add_argument("--seed", default=0, type=int,
+        help="Seed of the first run; run i uses seed+i")
+    parser.add_argument("--max-nodes", default=5, type=int)
+    parser.add_argument("--clients", default=4, type=int,
+        help="Concurrent clients per run")
+    parser.add_argument("--ops-per-client", default=10, type=int)
+    parser.add_argument("--key-range", default=5, type=int,
+        help="A small key range makes concurrent updates to the same key likely")
+    parser.add_argument("--write-ratio", default=0.7, type=float)
+    parser.add_argument("--bulk-ratio", default=0.1, type=float,
+        help="Fraction of operations that bulk load some keys through the head")
+    parser.add_argument("--max-delay", default=0.001, type=float,
+        help="Most (simulated) seconds a message takes")
+    parser.add_argument("--reorder", default=0.0, type=float,
+        help="Probability that a message overtakes earlier ones on the same link")
+    parser.add_argument("--coalesce", default=0.5, type=float,
+        help="Fraction of runs in which the head coalesces writes")
+    parser.add_argument("--fail-early", action='store_true',
+        help="Stop after encountering the first failure")
+
+    args = parser.parse_args()
+
+    # Message handlers are spread over lanes by hash(key), so runs are only
+    # reproducible with a fixed hash seed
+    if os.environ.get("PYTHONHASHSEED") is None:
+        os.environ["PYTHONHASHSEED"] = "0"
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    failures = 0
+    start = monotonic()
+
+    for seed in range(args.seed, args.seed + args.runs):
+        # Nodes print their progress, which is just noise here
+        with contextlib.redirect_stdout(StringIO()):
+            try:
+                run_simulation(lambda seed=seed: _random_run(seed, args))
+                error = None
+            except (CheckFailed, SimulationStalled) as err:
+                error = f"{type(err).__name__}: {err}"
+
+        if error is not None:
+            failures += 1
+            print(f"Run with --seed={seed} failed: {error}")
+            if args.fail_early:
+                break
+
+    elapsed = monotonic() - start
+    print(f"### {args.runs} runs, {failures} failed "
+          f"({args.runs / elapsed * 60:.0f} runs per minute)")
+    sys.exit(min(failures, 1))
+
+if __name__ == "__main__":
+    _main()
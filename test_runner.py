@@ -4,31 +4,71 @@
 
 ''' Runs the integration tests for MiniKV '''
 
+import os
 import sys
 import json
+import uuid
+import socket
+import struct
+import pstats
+import shutil
 import argparse
+import tempfile
 
-from subprocess import CalledProcessError, check_call, Popen
-from time import sleep
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import CalledProcessError, TimeoutExpired, check_call, check_output, Popen
+from time import sleep, monotonic
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+
+# The ports used by the first job; every further job gets its own range above them
+CLIENT_PORT_BASE = 8080
+PEER_PORT_BASE = 50000
+PORTS_PER_JOB = 100
+
+# How long to wait for a node to report that it is ready
+READY_TIMEOUT = 60.0
+
+# The cap on in-flight updates in the admission control test
+ADMISSION_LIMIT = 4
+
+# The latency the link shaping test adds to one link (which is capped at 8mbit, or 1MB/s)
+SHAPED_DELAY_MS = 100
 
 class TestError(Exception):
     ''' An error indicating a test failed '''
 
-class TestRunner:
+class TestRunner: #pylint: disable=too-many-instance-attributes
     ''' Sets up the replica set for us to run the test on '''
 
-    def __init__(self, num_replicas: int, replication_type: str, loglevel: str):
+    def __init__(self, num_replicas: int, replication_type: str, loglevel: str,
+            extra_args: list[str]|None = None, slot: int = 0):
+        '''
+            Start the nodes. In extra_args, {workdir} stands for a directory
+            only this test uses, and {index} for the index of the node.
+        '''
         self._log: list[str] = []
+        self._num_replicas = num_replicas
+        self._replication_type = replication_type
+        self._loglevel = loglevel
+        self._extra_args = extra_args or []
+        self._client_port_base = CLIENT_PORT_BASE + slot * PORTS_PER_JOB
+        self._peer_port_base = PEER_PORT_BASE + slot * PORTS_PER_JOB
+        self._servers: list[Popen] = []
+        self.workdir = tempfile.mkdtemp(prefix="minikv-test-")
 
         self.log("Started Test Runner")
 
         assert num_replicas > 0
-        servers = []
+        assert num_replicas <= PORTS_PER_JOB
+
+        self._start_servers(self._extra_args)
 
-        # Start all servers
-        for index in range(num_replicas):
+    def _start_servers(self, extra_args: list[str]):
+        for index in range(self._num_replicas):
             if index > 0:
-                if replication_type == "chain":
+                if self._replication_type == "chain":
                     connect_to = f"-C{index-1}"
                 else:
                     raise RuntimeError("No supported")
@@ -36,17 +76,52 @@ class TestRunner:
                 connect_to = None
 
             server_args = ["python3", "-c" , "import minikv; minikv.run_node();",
-                replication_type, "--loglevel="+loglevel, f"--index={index}"]
+                self._replication_type, "--loglevel="+self._loglevel, f"--index={index}",
+                f"--client-port-base={self._client_port_base}",
+                f"--peer-port-base={self._peer_port_base}"]
 
             if connect_to:
                 server_args += [connect_to]
+            server_args += [arg.format(workdir=self.workdir, index=index) for arg in extra_args]
+
+            self._servers.append(Popen(server_args))
+
+            # The next node connects to this one, so it has to be up first
+            self._wait_until_ready(index)
+
+        self.log(f"Started {self._num_replicas} replicas")
+
+    def restart(self, extra_args: list[str]):
+        ''' Kill all nodes and start them again, with some more arguments '''
+
+        self._stop_servers()
+        self._start_servers(self._extra_args + extra_args)
+
+    def _wait_until_ready(self, index: int):
+        deadline = monotonic() + READY_TIMEOUT
+
+        while monotonic() < deadline:
+            if self._servers[index].poll() is not None:
+                self.shutdown()
+                raise TestError(f"Node with id={index} exited during startup")
+            try:
+                with urlopen(f"http://{self.address(index)}/health", timeout=1.0) as resp:
+                    if resp.status == 200:
+                        return
+            except (URLError, ConnectionError):
+                pass
+            sleep(0.01)
 
-            servers.append(Popen(server_args))
-            sleep(0.1)
+        self.shutdown()
+        raise TestError(f"Node with id={index} did not become ready")
 
-        self.log(f"Started {num_replicas} replicas")
+    def address(self, index: int) -> str:
+        ''' The address clients reach the node with the specified index at '''
+        return f"localhost:{self._client_port_base + index}"
 
-        self._servers = servers
+    def peer_port(self, index: int) -> int:
+        ''' The port the node with the specified index accepts other nodes on '''
+        return self._peer_port_base + index
 
     def log(self, msg):
         ''' Print a new log message '''
@@ -57,11 +132,16 @@ class TestRunner:
         ''' Get a log messages as a string '''
         return '\n'.join(self._log)
 
-    def shutdown(self):
-        ''' Shut down the test and all servers we set up for it '''
+    def _stop_servers(self):
         for server in self._servers:
             server.kill()
             server.wait()
+        self._servers.clear()
+
+    def shutdown(self):
+        ''' Shut down the test and all servers we set up for it '''
+        self._stop_servers()
+        shutil.rmtree(self.workdir, ignore_errors=True)
 
 def _main():
     parser = argparse.ArgumentParser()
@@ -74,12 +154,17 @@ def _main():
     parser.add_argument("--loglevel", default="warn",
         help="Set the logging verbosity", choices=["warn", "debug", "info"])
     parser.add_argument("--gradescope", action='store_true')
+    parser.add_argument("-j", "--jobs", default=1, type=int,
+        help="How many tests to run in parallel (each on its own set of ports)")
 
     args = parser.parse_args()
 
     if args.scale_factor <= 0:
         raise TestError("Invalid scale factor")
 
+    if args.jobs <= 0:
+        raise TestError("Invalid number of jobs")
+
     configs = {
         "One Replica": { "num-replicas": 1, },
         "Five Replicas": { "num-replicas": 5, },
@@ -89,6 +174,30 @@ def _main():
         'Insert (Single Client)': test_insert_single_client,
         'Insert (Multi Client)': test_insert_multi_client,
         'Update': test_update,
+        'Watch': test_watch,
+        'Read Cache': test_read_cache,
+        'Any Node Accepts Writes': test_write_anywhere,
+        'Hot Keys': test_hot_keys,
+        'Bulk Load': test_bulk_load,
+        'Profiling': test_profiling,
+        'Snapshot Reads': test_snapshot_reads,
+        'Shared Memory Transport': test_shm_transport,
+        'Tracing': test_tracing,
+        'Snapshot and Restore': test_snapshot_restore,
+        'Admission Control': test_admission,
+        'Link Shaping': test_link_shaping,
+    }
+
+    # Extra arguments the nodes of some tests are started with
+    node_args = {
+        'Shared Memory Transport': ["--transport=shm"],
+        'Tracing': ["--trace-sample-rate=1", "--trace-dir={workdir}"],
+        'Snapshot and Restore': ["--snapshot-path={workdir}/minikv-{index}.snap"],
+        # Slow links keep updates in flight long enough to hit the limit
+        'Admission Control': [f"--max-inflight={ADMISSION_LIMIT}", "--link-shape=delay=20ms"],
+        # Only the link from node 1 to node 2 is slow; traces show when updates arrive
+        'Link Shaping': [f"--link-shape=1-2:delay={SHAPED_DELAY_MS}ms,bandwidth=8mbit",
+                         "--trace-sample-rate=1", "--trace-dir={workdir}"],
     }
 
     output = {
@@ -100,46 +209,76 @@ def _main():
         }
     }
 
-    success_count = 0
-    failed_tests = []
-
+    jobs = []
     for conf_name, conf_values in configs.items():
-        if args.fail_early and len(failed_tests) > 0:
-            break
-
         if conf_values['num-replicas'] > 1 and args.replication_type == 'none':
             # Skip...
             continue
 
         for name, test in tests.items():
+            jobs.append((conf_name, conf_values, name, test))
 
-            print(f'### Running test "{name}" for config "{conf_name}" ###')
-            success = True
+    # Every job running at the same time gets its own range of ports
+    free_slots: Queue = Queue()
+    for slot in range(args.jobs):
+        free_slots.put(slot)
 
-            runner = TestRunner(conf_values["num-replicas"], args.replication_type, args.loglevel)
+    failed_tests: list[str] = []
 
-            try:
-                test(runner, conf_values, args)
-            except Exception as err:
-                runner.log(f"ERROR: {err}")
-                success = False
-
-            runner.shutdown()
-            if success:
-                runner.log(f'>> Test "{name}" passed')
-                success_count += 1
-            else:
-                runner.log(f'>> Test "{name}" failed')
-                failed_tests.append(name)
-
-            output['tests'].append({
-                'name': conf_name + ": " + name,
-                'output': runner.get_output(),
-                'output_format': 'text',
-                'status': 'passed' if success else 'failed',
-                'max_score': 10.0,
-                'score': 10.0 if success else 0.0,
-            })
+    def run_job(conf_name, conf_values, name, test):
+        if args.fail_early and len(failed_tests) > 0:
+            return None
+
+        slot = free_slots.get()
+        print(f'### Running test "{name}" for config "{conf_name}" ###')
+        success = True
+
+        try:
+            runner = TestRunner(conf_values["num-replicas"], args.replication_type,
+                                args.loglevel, extra_args=node_args.get(name), slot=slot)
+        except TestError as err:
+            free_slots.put(slot)
+            print(f"ERROR: {err}")
+            failed_tests.append(name)
+            return (conf_name, name, False, str(err))
+
+        try:
+            test(runner, conf_values, args)
+        except Exception as err:
+            runner.log(f"ERROR: {err}")
+            success = False
+
+        runner.shutdown()
+        free_slots.put(slot)
+
+        if success:
+            runner.log(f'>> Test "{name}" passed')
+        else:
+            runner.log(f'>> Test "{name}" failed')
+            failed_tests.append(name)
+
+        return (conf_name, name, success, runner.get_output())
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(lambda job: run_job(*job), jobs))
+
+    success_count = 0
+    for result in results:
+        if result is None:
+            continue
+
+        conf_name, name, success, test_output = result
+        if success:
+            success_count += 1
+
+        output['tests'].append({
+            'name': conf_name + ": " + name,
+            'output': test_output,
+            'output_format': 'text',
+            'status': 'passed' if success else 'failed',
+            'max_score': 10.0,
+            'score': 10.0 if success else 0.0,
+        })
 
     print(f"### {success_count} tests passed, {len(failed_tests)} failed")
 
@@ -161,7 +300,7 @@ def test_insert_single_client(runner, conf_values, args):
     # Load data into the replica cluster
     try:
         check_call(["python3", "-c", "import minikv; minikv.run_client();",
-                "fill", "--loglevel="+args.loglevel,
+                "fill", "--loglevel="+args.loglevel, f"--server-address={runner.address(0)}",
                 f"--key-range={num_keys}"])
     except CalledProcessError:
         raise TestError("Failed to load data")
@@ -175,7 +314,7 @@ def test_insert_single_client(runner, conf_values, args):
         try:
             check_call(["python3", "-c", "import minikv; minikv.run_client();",
                         "check-values", "--loglevel="+args.loglevel,
-                        f"--server-address=localhost:{8080+idx}",
+                        f"--server-address={runner.address(idx)}",
                         f"--key-range={num_keys}"])
         except CalledProcessError:
             raise TestError("Check failed")
@@ -187,13 +326,13 @@ def test_update(runner, conf_values, args):
     value = "therearethreersinstrawberry"
 
     check_call(["python3", "-c", "import minikv; minikv.run_client();",
-                "fill", "--loglevel="+args.loglevel,
+                "fill", "--loglevel="+args.loglevel, f"--server-address={runner.address(0)}",
                 f"--key-range={num_keys}", "--value-prefix=foobar"])
 
     runner.log("First pass of data written to MiniKV")
 
     check_call(["python3", "-c", "import minikv; minikv.run_client();",
-                "fill", "--loglevel="+args.loglevel,
+                "fill", "--loglevel="+args.loglevel, f"--server-address={runner.address(0)}",
                 f"--key-range={num_keys}", f"--value-prefix={value}"])
 
     runner.log("Second pass of data written to MiniKV")
@@ -205,7 +344,7 @@ def test_update(runner, conf_values, args):
         try:
             check_call(["python3", "-c", "import minikv; minikv.run_client();",
                     "check-values", "--loglevel="+args.loglevel,
-                    f"--server-address=localhost:{8080+idx}",
+                    f"--server-address={runner.address(idx)}",
                     f"--key-range={num_keys}", f"--value-prefix={value}"])
         except CalledProcessError:
             raise TestError("Check failed")
@@ -229,7 +368,8 @@ def test_insert_multi_client(runner, conf_values, args):
     clients = []
     for i in range(num_clients):
         proc = Popen(["python3", "-c", "import minikv; minikv.run_client();",
-                "fill", "--loglevel="+args.loglevel, f"--key-range={sub_range}",
+                "fill", "--loglevel="+args.loglevel, f"--server-address={runner.address(0)}",
+                f"--key-range={sub_range}",
                 f"--key-offset={sub_range * i}"])
         clients.append(proc)
 
@@ -248,7 +388,7 @@ def test_insert_multi_client(runner, conf_values, args):
         for i in range(num_clients):
             client = Popen(["python3", "-c", "import minikv; minikv.run_client();",
                 "check-values", "--loglevel="+args.loglevel,
-                f"--server-address=localhost:{8080+idx}",
+                f"--server-address={runner.address(idx)}",
                 f"--key-range={sub_range}",
                 f"--key-offset={sub_range * i}"])
             clients.append(client)
@@ -258,5 +398,520 @@ def test_insert_multi_client(runner, conf_values, args):
         if client.returncode != 0:
             raise TestError("Check failed")
 
+def test_watch(runner, conf_values, args):
+    ''' Test that every node streams the committed updates to watchers '''
+
+    num_keys = args.scale_factor * 10
+
+    check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                "fill", "--loglevel="+args.loglevel, f"--server-address={runner.address(0)}",
+                f"--key-range={num_keys}"])
+
+    runner.log("All data written to MiniKV")
+
+    for idx in range(conf_values["num-replicas"]):
+        runner.log(f"Watching node with id={idx}")
+
+        try:
+            check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                    "watch", "--loglevel="+args.loglevel,
+                    f"--server-address={runner.address(idx)}",
+                    f"--key-range={num_keys}"], timeout=60)
+        except CalledProcessError:
+            raise TestError("Watch failed")
+        except TimeoutExpired:
+            raise TestError("Watch did not see all updates in time")
+
+def test_write_anywhere(runner, conf_values, args):
+    ''' Test writing through the last node, which forwards to the head or looks it up '''
+
+    num_keys = args.scale_factor * 10
+    last = conf_values["num-replicas"] - 1
+
+    for value_prefix, extra_args in [("forwarded", ["--no-route-writes"]), ("routed", [])]:
+        try:
+            check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                    "fill", "--loglevel="+args.loglevel, f"--server-address={runner.address(last)}",
+                    f"--key-range={num_keys}", f"--value-prefix={value_prefix}"] + extra_args)
+        except CalledProcessError:
+            raise TestError(f"Failed to write {value_prefix} data")
+
+        runner.log(f"All {value_prefix} data written to MiniKV")
+
+        for idx in range(conf_values["num-replicas"]):
+            runner.log(f"Checking node with id={idx}")
+
+            try:
+                check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                        "check-values", "--loglevel="+args.loglevel,
+                        f"--server-address={runner.address(idx)}",
+                        f"--key-range={num_keys}", f"--value-prefix={value_prefix}"])
+            except CalledProcessError:
+                raise TestError("Check failed")
+
+def test_hot_keys(runner, conf_values, args):
+    ''' Test that nodes report a key that is read over and over as the hottest one '''
+
+    num_keys = args.scale_factor * 10
+    last = conf_values["num-replicas"] - 1
+
+    check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                "fill", "--loglevel="+args.loglevel, f"--server-address={runner.address(0)}",
+                f"--key-range={num_keys}"])
+
+    # Only reads key0
+    check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                "random-ops", "--loglevel="+args.loglevel,
+                f"--server-address={runner.address(last)}",
+                "--key-range=1", "--write-chance=0", "--num-ops=100"])
+
+    with urlopen(f"http://{runner.address(last)}/debug/hotkeys", timeout=2.0) as resp:
+        report = json.load(resp)
+
+    if len(report["reads"]) == 0 or report["reads"][0]["key"] != "key0":
+        raise TestError(f"Expected key0 to be the hottest key, but got {report['reads']}")
+
+    with urlopen(f"http://{runner.address(0)}/debug/hotkeys", timeout=2.0) as resp:
+        report = json.load(resp)
+
+    if len(report["writes"]) != min(num_keys, 10):
+        raise TestError(f"Expected the written keys to be reported, but got {report['writes']}")
+
+def test_read_cache(runner, _conf_values, args):
+    ''' Test that cached reads see updates once the lease or an invalidation ends them '''
+
+    num_keys = args.scale_factor * 10
+
+    check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                "fill", "--loglevel="+args.loglevel, f"--server-address={runner.address(0)}",
+                f"--key-range={num_keys}"])
+
+    runner.log("All data written to MiniKV")
+
+    try:
+        check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                "check-cache", "--loglevel="+args.loglevel,
+                f"--server-address={runner.address(0)}",
+                f"--key-range={num_keys}"], timeout=60)
+    except CalledProcessError:
+        raise TestError("Read cache check failed")
+    except TimeoutExpired:
+        raise TestError("Read cache check did not finish in time")
+
+def test_bulk_load(runner, conf_values, args):
+    ''' Test loading a dump through the last node and exporting it from every node '''
+
+    num_keys = args.scale_factor * 100
+    last = conf_values["num-replicas"] - 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "dump.ndjson")
+        with open(path, 'w', encoding='utf-8') as ofile:
+            for idx in range(num_keys):
+                ofile.write(json.dumps({"key": f"key{idx}", "value": f"value{idx}"}) + "\n")
+
+        try:
+            # Small chunks, so the load takes multiple batches
+            check_call(["python3", "-c", "import minikv; minikv.run_bulk();",
+                    "load", path, "--loglevel="+args.loglevel, "--chunk-size=1000",
+                    f"--server-address={runner.address(last)}"], timeout=60)
+        except (CalledProcessError, TimeoutExpired):
+            raise TestError("Bulk load failed")
+
+        runner.log("All data loaded into MiniKV")
+
+        for idx in range(conf_values["num-replicas"]):
+            runner.log(f"Checking node with id={idx}")
+
+            try:
+                check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                        "check-values", "--loglevel="+args.loglevel,
+                        f"--server-address={runner.address(idx)}",
+                        f"--key-range={num_keys}"])
+            except CalledProcessError:
+                raise TestError("Check failed")
+
+            export_path = os.path.join(tmp_dir, f"export{idx}.ndjson")
+            try:
+                check_call(["python3", "-c", "import minikv; minikv.run_bulk();",
+                        "export", export_path, "--loglevel="+args.loglevel,
+                        f"--server-address={runner.address(idx)}"], timeout=60)
+            except (CalledProcessError, TimeoutExpired):
+                raise TestError("Export failed")
+
+            with open(export_path, encoding='utf-8') as ifile:
+                exported = {entry["key"]: entry["value"] for entry in map(json.loads, ifile)}
+
+            if exported != {f"key{i}": f"value{i}" for i in range(num_keys)}:
+                raise TestError(f"Export of node {idx} does not match what was loaded")
+
+def _admin_post(address: str, path: str) -> bytes:
+    with urlopen(Request(f"http://{address}{path}", data=b"", method="POST"),
+                 timeout=30.0) as resp:
+        return resp.read()
+
+def test_profiling(runner, _conf_values, args):
+    ''' Test the CPU, event-loop, and memory profiles of a node that is handling writes '''
+
+    num_keys = args.scale_factor * 100
+    address = runner.address(0)
+
+    _admin_post(address, "/admin/memory/start")
+
+    check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                "fill", "--loglevel="+args.loglevel, f"--server-address={address}",
+                f"--key-range={num_keys}"])
+
+    report = json.loads(_admin_post(address, "/admin/memory/snapshot"))
+    if report["objects"]["database_entries"] != num_keys:
+        raise TestError(f"Expected {num_keys} entries, but got {report['objects']}")
+    if report["subsystems"].get("database", {}).get("size", 0) <= 0:
+        raise TestError(f"No memory was attributed to the database: {report['subsystems']}")
+
+    _admin_post(address, "/admin/memory/stop")
+    try:
+        _admin_post(address, "/admin/memory/stop")
+        raise TestError("Stopping memory tracing twice should fail")
+    except HTTPError as err:
+        if err.code != 409:
+            raise TestError(f"Expected status 409, but got {err.code}")
+
+    # Keep the node busy (writing the same values again) while profiling it
+    client = Popen(["python3", "-c", "import minikv; minikv.run_client();",
+                    "fill", "--loglevel="+args.loglevel, f"--server-address={address}",
+                    f"--key-range={num_keys}"])
+    try:
+        collapsed = _admin_post(address, "/admin/profile/cpu?seconds=1").decode('utf-8')
+        loop = json.loads(_admin_post(address, "/admin/profile/loop?seconds=1"))
+        profile = _admin_post(address, "/admin/profile/cpu?seconds=0.5&format=pstats")
+    finally:
+        client.wait()
+
+    if not collapsed or not all(line.rsplit(" ", 1)[1].isdigit()
+                                for line in collapsed.splitlines()):
+        raise TestError("CPU profile is not in collapsed-stack format")
+
+    if loop["callbacks"] == 0 or sum(b["count"] for b in loop["histogram"]) != loop["callbacks"]:
+        raise TestError(f"Event loop profile is inconsistent: {loop}")
+
+    with tempfile.NamedTemporaryFile(suffix=".prof") as ofile:
+        ofile.write(profile)
+        ofile.flush()
+        if pstats.Stats(ofile.name).total_tt <= 0:
+            raise TestError("pstats profile is empty")
+
+def test_snapshot_reads(runner, conf_values, args):
+    ''' Test reading and scanning as of an older sequence number after the values changed '''
+
+    num_keys = args.scale_factor * 10
+    last = conf_values["num-replicas"] - 1
+    keys = "&".join(f"key=key{idx}" for idx in range(num_keys))
+
+    def get_json(path):
+        with urlopen(f"http://{runner.address(last)}{path}", timeout=5.0) as resp:
+            return json.load(resp)
+
+    def fill(prefix):
+        check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                    "fill", "--loglevel="+args.loglevel, f"--server-address={runner.address(0)}",
+                    f"--key-range={num_keys}", f"--value-prefix={prefix}"])
+
+    fill("old")
+    before = get_json(f"/mget?{keys}")
+    fill("new")
+
+    old = {f"key{idx}": f"old{idx}" for idx in range(num_keys)}
+    if before["values"] != old:
+        raise TestError(f"Expected the old values, but got {before['values']}")
+
+    seq = before["seq"]
+    result = get_json(f"/mget?{keys}&at={seq}")
+    if result != {"seq": seq, "values": old}:
+        raise TestError(f"Read at sequence number {seq} returned {result}")
+
+    if get_json(f"/get?key=key0&at={seq}")["value"] != "old0":
+        raise TestError("Single read at an older sequence number returned a newer value")
+
+    with urlopen(f"http://{runner.address(last)}/scan?prefix=key&at={seq}", timeout=5.0) as resp:
+        if int(resp.headers["X-Snapshot-Seq"]) != seq:
+            raise TestError("Scan did not run at the requested sequence number")
+        scanned = {entry["key"]: entry["value"] for entry in map(json.loads, resp)}
+
+    if scanned != old:
+        raise TestError(f"Scan at sequence number {seq} returned {scanned}")
+
+    current = get_json(f"/mget?{keys}")
+    if current["values"] != {f"key{idx}": f"new{idx}" for idx in range(num_keys)}:
+        raise TestError(f"Expected the new values, but got {current['values']}")
+
+    try:
+        get_json(f"/get?key=key0&at={current['seq'] + 1000}")
+        raise TestError("Reading at a sequence number that was not committed yet should fail")
+    except HTTPError as err:
+        if err.code != 400:
+            raise TestError(f"Expected status 400, but got {err.code}")
+
+def test_tracing(runner, conf_values, args):
+    ''' Test that every node records spans of traced updates, and that they can be stitched '''
+
+    num_keys = args.scale_factor * 10
+
+    try:
+        check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                "fill", "--loglevel="+args.loglevel, f"--server-address={runner.address(0)}",
+                f"--key-range={num_keys}"])
+    except CalledProcessError:
+        raise TestError("Failed to load data")
+
+    logs = [os.path.join(runner.workdir, f"minikv-spans-{idx}.jsonl")
+            for idx in range(conf_values["num-replicas"])]
+
+    # Every update is sampled, so every node saw all of them
+    traces: dict[str, set] = {}
+    for path in logs:
+        if not os.path.exists(path):
+            raise TestError(f"No span log at {path}")
+        with open(path, encoding='utf-8') as ifile:
+            for line in ifile:
+                span = json.loads(line)
+                if span["end"] < span["start"]:
+                    raise TestError(f"Span ends before it starts: {span}")
+                traces.setdefault(span["trace"], set()).add(span["node"])
+
+    if len(traces) < num_keys:
+        raise TestError(f"Expected at least {num_keys} traces, but got {len(traces)}")
+
+    all_nodes = set(range(conf_values["num-replicas"]))
+    for trace_id, nodes in traces.items():
+        if nodes != all_nodes:
+            raise TestError(f"Trace {trace_id} only has spans of nodes {sorted(nodes)}")
+
+    runner.log(f"Got spans of {len(traces)} traces from all nodes")
+
+    trace_id = next(iter(traces))
+    try:
+        output = check_output(["python3", "-c",
+                               "import minikv.tracing; minikv.tracing.run_stitch()",
+                               "--trace", trace_id] + logs, text=True)
+    except CalledProcessError:
+        raise TestError("Failed to stitch the span logs")
+
+    if f"trace {trace_id}" not in output:
+        raise TestError(f"Stitched output does not show trace {trace_id}")
+    for idx in all_nodes:
+        if f"node{idx} " not in output:
+            raise TestError(f"Stitched output does not show node {idx}")
+
+def test_snapshot_restore(runner, conf_values, args):
+    ''' Test that nodes restarted from their snapshots have all data, and take new updates '''
+
+    num_keys = args.scale_factor * 10
+    num_replicas = conf_values["num-replicas"]
+
+    def fill_and_check(value_prefix: str):
+        try:
+            check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                    "fill", "--loglevel="+args.loglevel, f"--server-address={runner.address(0)}",
+                    f"--key-range={num_keys}", f"--value-prefix={value_prefix}"])
+        except CalledProcessError:
+            raise TestError(f"Failed to write {value_prefix} data")
+
+        check_all(value_prefix)
+
+    def check_all(value_prefix: str):
+        for idx in range(num_replicas):
+            try:
+                check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                        "check-values", "--loglevel="+args.loglevel,
+                        f"--server-address={runner.address(idx)}",
+                        f"--key-range={num_keys}", f"--value-prefix={value_prefix}"])
+            except CalledProcessError:
+                raise TestError(f"Node with id={idx} does not have the {value_prefix} data")
+
+    fill_and_check("before")
+
+    # Every update committed on all nodes, so their snapshots are of the same state
+    for idx in range(num_replicas):
+        try:
+            result = json.loads(_admin_post(runner.address(idx), "/admin/snapshot"))
+        except HTTPError as err:
+            raise TestError(f"Snapshot of node with id={idx} failed: {err.read()!r}")
+        runner.log(f"Node with id={idx} wrote a snapshot: {result}")
+
+    runner.restart(["--restore-from={workdir}/minikv-{index}.snap"])
+    runner.log("Restarted all nodes from their snapshots")
+
+    check_all("before")
+    fill_and_check("after")
+
+def _put(address: str, key: str, value) -> tuple[int, dict]:
+    ''' Store a value; returns the status and the headers of the response '''
+
+    request = Request(f"http://{address}/put?key={key}", method="POST",
+                      data=json.dumps({"value": value}).encode('utf-8'),
+                      headers={"Content-Type": "application/json"})
+    try:
+        with urlopen(request, timeout=30.0) as resp:
+            return resp.status, dict(resp.headers)
+    except HTTPError as err:
+        return err.code, dict(err.headers)
+
+def test_admission(runner, conf_values, args):
+    '''
+        Test that the head turns away updates beyond its limit with 503 and a hint
+        when to retry, and admits them again once the updates in flight completed
+    '''
+
+    if args.replication_type != "chain" or conf_values["num-replicas"] < 2:
+        runner.log("Skipped: updates to a single node complete right away")
+        return
+
+    num_updates = ADMISSION_LIMIT * 10
+    with ThreadPoolExecutor(max_workers=num_updates) as executor:
+        results = list(executor.map(lambda i: _put(runner.address(0), f"flood{i}", i),
+                                    range(num_updates)))
+
+    statuses = [status for status, _ in results]
+    rejected = [headers for status, headers in results if status == 503]
+    runner.log(f"{statuses.count(200)} updates were admitted, {len(rejected)} rejected")
+
+    if statuses.count(200) + len(rejected) != num_updates:
+        raise TestError(f"Unexpected status codes: {sorted(set(statuses))}")
+    if len(rejected) == 0:
+        raise TestError(f"None of {num_updates} concurrent updates was rejected")
+    if statuses.count(200) < ADMISSION_LIMIT:
+        raise TestError(f"Only {statuses.count(200)} updates were admitted")
+
+    for headers in rejected:
+        if int(headers.get("Retry-After", 0)) < 1 or "X-Retry-After-Ms" not in headers:
+            raise TestError(f"Rejected update without a hint when to retry: {headers}")
+
+    # Once the flood is over, a full set of concurrent updates gets in again
+    sleep(max(int(headers["X-Retry-After-Ms"]) for headers in rejected) / 1000)
+    with ThreadPoolExecutor(max_workers=ADMISSION_LIMIT) as executor:
+        statuses = list(executor.map(lambda i: _put(runner.address(0), f"after{i}", i)[0],
+                                     range(ADMISSION_LIMIT)))
+
+    if statuses != [200] * ADMISSION_LIMIT:
+        raise TestError(f"Updates after the flood were not admitted: {statuses}")
+
+def _hop_times(runner, num_replicas: int) -> dict[str, list[float]]:
+    '''
+        For every traced update, the milliseconds it took from arriving at
+        one node to arriving at the next, down the chain
+    '''
+
+    arrivals: dict[str, dict[int, int]] = {}
+    for idx in range(num_replicas):
+        path = os.path.join(runner.workdir, f"minikv-spans-{idx}.jsonl")
+        with open(path, encoding='utf-8') as ifile:
+            for line in ifile:
+                span = json.loads(line)
+                if span["span"] in ("http_put", "receive_buffer"):
+                    # The forward pass reaches a node before the acknowledgement
+                    first = arrivals.setdefault(span["trace"], {})
+                    first[idx] = min(first.get(idx, span["start"]), span["start"])
+
+    return {trace_id: [(nodes[idx+1] - nodes[idx]) / 1e6 for idx in range(num_replicas - 1)]
+            for trace_id, nodes in arrivals.items() if len(nodes) == num_replicas}
+
+def test_link_shaping(runner, conf_values, args):
+    ''' Test that a shaped link adds latency and caps bandwidth, and that other links do not '''
+
+    num_replicas = conf_values["num-replicas"]
+    if args.replication_type != "chain" or num_replicas < 3:
+        runner.log("Skipped: needs a chain with links before and after the shaped one")
+        return
+
+    for idx in range(10):
+        if _put(runner.address(0), f"small{idx}", idx)[0] != 200:
+            raise TestError("Failed to write a small value")
+    small = _hop_times(runner, num_replicas)
+
+    # Takes about 300ms at 1MB/s
+    if _put(runner.address(0), "large", "x" * 300_000)[0] != 200:
+        raise TestError("Failed to write a large value")
+    large = [hops for trace_id, hops in _hop_times(runner, num_replicas).items()
+             if trace_id not in small]
+
+    if len(small) != 10 or len(large) != 1:
+        raise TestError(f"Expected 11 complete traces, but got {len(small) + len(large)}")
+
+    def median(values):
+        return sorted(values)[len(values) // 2]
+
+    hops = [median([times[idx] for times in small.values()]) for idx in range(num_replicas - 1)]
+    runner.log(f"Median milliseconds per hop: {hops}; of the large value: {large[0]}")
+
+    if hops[1] < SHAPED_DELAY_MS:
+        raise TestError(f"The shaped link took {hops[1]:.1f}ms, less than its delay")
+    if large[0][1] < SHAPED_DELAY_MS + 250:
+        raise TestError(f"The large value took {large[0][1]:.1f}ms on the shaped link, "
+                        "more than its bandwidth allows")
+
+    for idx in range(num_replicas - 1):
+        if idx != 1 and (hops[idx] > SHAPED_DELAY_MS / 2 or large[0][idx] > 200):
+            raise TestError(f"The link from node {idx} to {idx+1} is slowed down as well")
+
+def _peer_handshake(sock: socket.socket, upgrade: str):
+    ''' Introduce ourselves to a node like another node would '''
+
+    msg = f"999:localhost:1:{upgrade}".encode('utf-8')
+    sock.sendall(struct.pack("I", len(msg)) + msg)
+    sock.settimeout(5.0)
+    try:
+        while sock.recv(4096):
+            pass
+    except TimeoutError:
+        pass
+
+def test_shm_transport(runner, conf_values, args):
+    '''
+        Test a chain whose nodes talk over shared memory, and that no peer can make
+        a node map (and unlink) files other than shared-memory rings of local peers
+    '''
+
+    if args.replication_type != "chain":
+        runner.log("Skipped: only chain replication has peers")
+        return
+
+    test_insert_single_client(runner, conf_values, args)
+
+    ring_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    victims = [os.path.join(ring_dir, f"minikv-{uuid.uuid4().hex}-{side}") for side in "ab"]
+    outside = tempfile.NamedTemporaryFile(prefix="minikv-victim-")
+
+    try:
+        for path in victims:
+            with open(path, 'wb') as ofile:
+                ofile.write(b"\0" * 4096)
+
+        # Well-formed ring names, but over TCP
+        with socket.create_connection(("localhost", runner.peer_port(0)), timeout=5.0) as sock:
+            _peer_handshake(sock, f"shm={victims[0]},{victims[1]}")
+
+        # A local peer, but files outside of the ring directory
+        unix_path = os.path.join(tempfile.gettempdir(), f"minikv-{runner.peer_port(0)}.sock")
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(unix_path)
+            _peer_handshake(sock, f"shm={outside.name},{outside.name}")
+
+        if not all(os.path.exists(path) for path in victims + [outside.name]):
+            raise TestError("A peer made the node unlink a file it should not have touched")
+    finally:
+        outside.close()
+        for path in victims:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    # The node is still fine
+    try:
+        check_call(["python3", "-c", "import minikv; minikv.run_client();",
+                    "check-values", "--loglevel="+args.loglevel,
+                    f"--server-address={runner.address(0)}",
+                    f"--key-range={args.scale_factor * 10}"])
+    except CalledProcessError:
+        raise TestError("Check failed after the rejected connections")
+
 if __name__ == "__main__":
     _main()